@@ -47,6 +47,10 @@
 # tag name. For example:
 # 'EXIF DateTimeOriginal', 'Image Orientation', 'MakerNote FocusMode'
 #
+# 'JPEGThumbnail' and 'TIFFThumbnail' are Thumbnail handles, their bytes
+# are only read when asked for, from the same file or a reopened one:
+#    data = tags['JPEGThumbnail'].read(f)
+#
 # Copyright (c) 2002-2007 Gene Cash All rights reserved
 # Copyright (c) 2007-2008 Ianaré Sévi All rights reserved
 #
@@ -82,6 +86,15 @@
 # ----- See 'changes.txt' file for all contributors and changes ----- #
 #
 
+import array
+import calendar
+import itertools
+import os
+import struct
+import sys
+import time
+from datetime import datetime, timedelta, tzinfo
+
 
 # Don't throw an exception when given an out of range character.
 def make_string(seq):
@@ -230,6 +243,9 @@ EXIF_TAGS = {
     0x9000: ('ExifVersion', make_string),
     0x9003: ('DateTimeOriginal', ),
     0x9004: ('DateTimeDigitized', ),
+    0x9010: ('OffsetTime', ),
+    0x9011: ('OffsetTimeOriginal', ),
+    0x9012: ('OffsetTimeDigitized', ),
     0x9101: ('ComponentsConfiguration',
              {0: '',
               1: 'Y',
@@ -418,757 +434,6 @@ GPS_TAGS = {
 # 0x9286 is user comment
 IGNORE_TAGS=(0x9286, 0x927C)
 
-# http://tomtia.plala.jp/DigitalCamera/MakerNote/index.asp
-def nikon_ev_bias(seq):
-    # First digit seems to be in steps of 1/6 EV.
-    # Does the third value mean the step size?  It is usually 6,
-    # but it is 12 for the ExposureDifference.
-    #
-    # Check for an error condition that could cause a crash.
-    # This only happens if something has gone really wrong in
-    # reading the Nikon MakerNote.
-    if len( seq ) < 4 : return ""
-    #
-    if seq == [252, 1, 6, 0]:
-        return "-2/3 EV"
-    if seq == [253, 1, 6, 0]:
-        return "-1/2 EV"
-    if seq == [254, 1, 6, 0]:
-        return "-1/3 EV"
-    if seq == [0, 1, 6, 0]:
-        return "0 EV"
-    if seq == [2, 1, 6, 0]:
-        return "+1/3 EV"
-    if seq == [3, 1, 6, 0]:
-        return "+1/2 EV"
-    if seq == [4, 1, 6, 0]:
-        return "+2/3 EV"
-    # Handle combinations not in the table.
-    a = seq[0]
-    # Causes headaches for the +/- logic, so special case it.
-    if a == 0:
-        return "0 EV"
-    if a > 127:
-        a = 256 - a
-        ret_str = "-"
-    else:
-        ret_str = "+"
-    b = seq[2]	# Assume third value means the step size
-    whole = a / b
-    a = a % b
-    if whole != 0:
-        ret_str = ret_str + str(whole) + " "
-    if a == 0:
-        ret_str = ret_str + "EV"
-    else:
-        r = Ratio(a, b)
-        ret_str = ret_str + r.__repr__() + " EV"
-    return ret_str
-
-# Nikon E99x MakerNote Tags
-MAKERNOTE_NIKON_NEWER_TAGS={
-    0x0001: ('MakernoteVersion', make_string),	# Sometimes binary
-    0x0002: ('ISOSetting', make_string),
-    0x0003: ('ColorMode', ),
-    0x0004: ('Quality', ),
-    0x0005: ('Whitebalance', ),
-    0x0006: ('ImageSharpening', ),
-    0x0007: ('FocusMode', ),
-    0x0008: ('FlashSetting', ),
-    0x0009: ('AutoFlashMode', ),
-    0x000B: ('WhiteBalanceBias', ),
-    0x000C: ('WhiteBalanceRBCoeff', ),
-    0x000D: ('ProgramShift', nikon_ev_bias),
-    # Nearly the same as the other EV vals, but step size is 1/12 EV (?)
-    0x000E: ('ExposureDifference', nikon_ev_bias),
-    0x000F: ('ISOSelection', ),
-    0x0011: ('NikonPreview', ),
-    0x0012: ('FlashCompensation', nikon_ev_bias),
-    0x0013: ('ISOSpeedRequested', ),
-    0x0016: ('PhotoCornerCoordinates', ),
-    # 0x0017: Unknown, but most likely an EV value
-    0x0018: ('FlashBracketCompensationApplied', nikon_ev_bias),
-    0x0019: ('AEBracketCompensationApplied', ),
-    0x001A: ('ImageProcessing', ),
-    0x001B: ('CropHiSpeed', ),
-    0x001D: ('SerialNumber', ),	# Conflict with 0x00A0 ?
-    0x001E: ('ColorSpace', ),
-    0x001F: ('VRInfo', ),
-    0x0020: ('ImageAuthentication', ),
-    0x0022: ('ActiveDLighting', ),
-    0x0023: ('PictureControl', ),
-    0x0024: ('WorldTime', ),
-    0x0025: ('ISOInfo', ),
-    0x0080: ('ImageAdjustment', ),
-    0x0081: ('ToneCompensation', ),
-    0x0082: ('AuxiliaryLens', ),
-    0x0083: ('LensType', ),
-    0x0084: ('LensMinMaxFocalMaxAperture', ),
-    0x0085: ('ManualFocusDistance', ),
-    0x0086: ('DigitalZoomFactor', ),
-    0x0087: ('FlashMode',
-             {0x00: 'Did Not Fire',
-              0x01: 'Fired, Manual',
-              0x07: 'Fired, External',
-              0x08: 'Fired, Commander Mode ',
-              0x09: 'Fired, TTL Mode'}),
-    0x0088: ('AFFocusPosition',
-             {0x0000: 'Center',
-              0x0100: 'Top',
-              0x0200: 'Bottom',
-              0x0300: 'Left',
-              0x0400: 'Right'}),
-    0x0089: ('BracketingMode',
-             {0x00: 'Single frame, no bracketing',
-              0x01: 'Continuous, no bracketing',
-              0x02: 'Timer, no bracketing',
-              0x10: 'Single frame, exposure bracketing',
-              0x11: 'Continuous, exposure bracketing',
-              0x12: 'Timer, exposure bracketing',
-              0x40: 'Single frame, white balance bracketing',
-              0x41: 'Continuous, white balance bracketing',
-              0x42: 'Timer, white balance bracketing'}),
-    0x008A: ('AutoBracketRelease', ),
-    0x008B: ('LensFStops', ),
-    0x008C: ('NEFCurve1', ),	# ExifTool calls this 'ContrastCurve'
-    0x008D: ('ColorMode', ),
-    0x008F: ('SceneMode', ),
-    0x0090: ('LightingType', ),
-    0x0091: ('ShotInfo', ),	# First 4 bytes are a version number in ASCII
-    0x0092: ('HueAdjustment', ),
-    # ExifTool calls this 'NEFCompression', should be 1-4
-    0x0093: ('Compression', ),
-    0x0094: ('Saturation',
-             {-3: 'B&W',
-              -2: '-2',
-              -1: '-1',
-              0: '0',
-              1: '1',
-              2: '2'}),
-    0x0095: ('NoiseReduction', ),
-    0x0096: ('NEFCurve2', ),	# ExifTool calls this 'LinearizationTable'
-    0x0097: ('ColorBalance', ),	# First 4 bytes are a version number in ASCII
-    0x0098: ('LensData', ),	# First 4 bytes are a version number in ASCII
-    0x0099: ('RawImageCenter', ),
-    0x009A: ('SensorPixelSize', ),
-    0x009C: ('Scene Assist', ),
-    0x009E: ('RetouchHistory', ),
-    0x00A0: ('SerialNumber', ),
-    0x00A2: ('ImageDataSize', ),
-    # 00A3: unknown - a single byte 0
-    # 00A4: In NEF, looks like a 4 byte ASCII version number ('0200')
-    0x00A5: ('ImageCount', ),
-    0x00A6: ('DeletedImageCount', ),
-    0x00A7: ('TotalShutterReleases', ),
-    # First 4 bytes are a version number in ASCII, with version specific
-    # info to follow.  Its hard to treat it as a string due to embedded nulls.
-    0x00A8: ('FlashInfo', ),
-    0x00A9: ('ImageOptimization', ),
-    0x00AA: ('Saturation', ),
-    0x00AB: ('DigitalVariProgram', ),
-    0x00AC: ('ImageStabilization', ),
-    0x00AD: ('Responsive AF', ),	# 'AFResponse'
-    0x00B0: ('MultiExposure', ),
-    0x00B1: ('HighISONoiseReduction', ),
-    0x00B7: ('AFInfo', ),
-    0x00B8: ('FileInfo', ),
-    # 00B9: unknown
-    0x0100: ('DigitalICE', ),
-    0x0103: ('PreviewCompression',
-             {1: 'Uncompressed',
-              2: 'CCITT 1D',
-              3: 'T4/Group 3 Fax',
-              4: 'T6/Group 4 Fax',
-              5: 'LZW',
-              6: 'JPEG (old-style)',
-              7: 'JPEG',
-              8: 'Adobe Deflate',
-              9: 'JBIG B&W',
-              10: 'JBIG Color',
-              32766: 'Next',
-              32769: 'Epson ERF Compressed',
-              32771: 'CCIRLEW',
-              32773: 'PackBits',
-              32809: 'Thunderscan',
-              32895: 'IT8CTPAD',
-              32896: 'IT8LW',
-              32897: 'IT8MP',
-              32898: 'IT8BL',
-              32908: 'PixarFilm',
-              32909: 'PixarLog',
-              32946: 'Deflate',
-              32947: 'DCS',
-              34661: 'JBIG',
-              34676: 'SGILog',
-              34677: 'SGILog24',
-              34712: 'JPEG 2000',
-              34713: 'Nikon NEF Compressed',
-              65000: 'Kodak DCR Compressed',
-              65535: 'Pentax PEF Compressed',}),
-    0x0201: ('PreviewImageStart', ),
-    0x0202: ('PreviewImageLength', ),
-    0x0213: ('PreviewYCbCrPositioning',
-             {1: 'Centered',
-              2: 'Co-sited'}),
-    0x0010: ('DataDump', ),
-    }
-
-MAKERNOTE_NIKON_OLDER_TAGS = {
-    0x0003: ('Quality',
-             {1: 'VGA Basic',
-              2: 'VGA Normal',
-              3: 'VGA Fine',
-              4: 'SXGA Basic',
-              5: 'SXGA Normal',
-              6: 'SXGA Fine'}),
-    0x0004: ('ColorMode',
-             {1: 'Color',
-              2: 'Monochrome'}),
-    0x0005: ('ImageAdjustment',
-             {0: 'Normal',
-              1: 'Bright+',
-              2: 'Bright-',
-              3: 'Contrast+',
-              4: 'Contrast-'}),
-    0x0006: ('CCDSpeed',
-             {0: 'ISO 80',
-              2: 'ISO 160',
-              4: 'ISO 320',
-              5: 'ISO 100'}),
-    0x0007: ('WhiteBalance',
-             {0: 'Auto',
-              1: 'Preset',
-              2: 'Daylight',
-              3: 'Incandescent',
-              4: 'Fluorescent',
-              5: 'Cloudy',
-              6: 'Speed Light'}),
-    }
-
-# decode Olympus SpecialMode tag in MakerNote
-def olympus_special_mode(v):
-    a={
-        0: 'Normal',
-        1: 'Unknown',
-        2: 'Fast',
-        3: 'Panorama'}
-    b={
-        0: 'Non-panoramic',
-        1: 'Left to right',
-        2: 'Right to left',
-        3: 'Bottom to top',
-        4: 'Top to bottom'}
-    if v[0] not in a or v[2] not in b:
-        return v
-    return '%s - sequence %d - %s' % (a[v[0]], v[1], b[v[2]])
-
-MAKERNOTE_OLYMPUS_TAGS={
-    # ah HAH! those sneeeeeaky bastids! this is how they get past the fact
-    # that a JPEG thumbnail is not allowed in an uncompressed TIFF file
-    0x0100: ('JPEGThumbnail', ),
-    0x0200: ('SpecialMode', olympus_special_mode),
-    0x0201: ('JPEGQual',
-             {1: 'SQ',
-              2: 'HQ',
-              3: 'SHQ'}),
-    0x0202: ('Macro',
-             {0: 'Normal',
-             1: 'Macro',
-             2: 'SuperMacro'}),
-    0x0203: ('BWMode',
-             {0: 'Off',
-             1: 'On'}),
-    0x0204: ('DigitalZoom', ),
-    0x0205: ('FocalPlaneDiagonal', ),
-    0x0206: ('LensDistortionParams', ),
-    0x0207: ('SoftwareRelease', ),
-    0x0208: ('PictureInfo', ),
-    0x0209: ('CameraID', make_string), # print as string
-    0x0F00: ('DataDump', ),
-    0x0300: ('PreCaptureFrames', ),
-    0x0404: ('SerialNumber', ),
-    0x1000: ('ShutterSpeedValue', ),
-    0x1001: ('ISOValue', ),
-    0x1002: ('ApertureValue', ),
-    0x1003: ('BrightnessValue', ),
-    0x1004: ('FlashMode', ),
-    0x1004: ('FlashMode',
-       {2: 'On',
-        3: 'Off'}),
-    0x1005: ('FlashDevice',
-       {0: 'None',
-        1: 'Internal',
-        4: 'External',
-        5: 'Internal + External'}),
-    0x1006: ('ExposureCompensation', ),
-    0x1007: ('SensorTemperature', ),
-    0x1008: ('LensTemperature', ),
-    0x100b: ('FocusMode',
-       {0: 'Auto',
-        1: 'Manual'}),
-    0x1017: ('RedBalance', ),
-    0x1018: ('BlueBalance', ),
-    0x101a: ('SerialNumber', ),
-    0x1023: ('FlashExposureComp', ),
-    0x1026: ('ExternalFlashBounce',
-       {0: 'No',
-        1: 'Yes'}),
-    0x1027: ('ExternalFlashZoom', ),
-    0x1028: ('ExternalFlashMode', ),
-    0x1029: ('Contrast 	int16u',
-       {0: 'High',
-        1: 'Normal',
-        2: 'Low'}),
-    0x102a: ('SharpnessFactor', ),
-    0x102b: ('ColorControl', ),
-    0x102c: ('ValidBits', ),
-    0x102d: ('CoringFilter', ),
-    0x102e: ('OlympusImageWidth', ),
-    0x102f: ('OlympusImageHeight', ),
-    0x1034: ('CompressionRatio', ),
-    0x1035: ('PreviewImageValid',
-       {0: 'No',
-        1: 'Yes'}),
-    0x1036: ('PreviewImageStart', ),
-    0x1037: ('PreviewImageLength', ),
-    0x1039: ('CCDScanMode',
-       {0: 'Interlaced',
-        1: 'Progressive'}),
-    0x103a: ('NoiseReduction',
-       {0: 'Off',
-        1: 'On'}),
-    0x103b: ('InfinityLensStep', ),
-    0x103c: ('NearLensStep', ),
-
-    # TODO - these need extra definitions
-    # http://search.cpan.org/src/EXIFTOOL/Image-ExifTool-6.90/html/TagNames/Olympus.html
-    0x2010: ('Equipment', ),
-    0x2020: ('CameraSettings', ),
-    0x2030: ('RawDevelopment', ),
-    0x2040: ('ImageProcessing', ),
-    0x2050: ('FocusInfo', ),
-    0x3000: ('RawInfo ', ),
-    }
-
-# 0x2020 CameraSettings
-MAKERNOTE_OLYMPUS_TAG_0x2020={
-    0x0100: ('PreviewImageValid',
-             {0: 'No',
-              1: 'Yes'}),
-    0x0101: ('PreviewImageStart', ),
-    0x0102: ('PreviewImageLength', ),
-    0x0200: ('ExposureMode',
-             {1: 'Manual',
-              2: 'Program',
-              3: 'Aperture-priority AE',
-              4: 'Shutter speed priority AE',
-              5: 'Program-shift'}),
-    0x0201: ('AELock',
-             {0: 'Off',
-              1: 'On'}),
-    0x0202: ('MeteringMode',
-             {2: 'Center Weighted',
-              3: 'Spot',
-              5: 'ESP',
-              261: 'Pattern+AF',
-              515: 'Spot+Highlight control',
-              1027: 'Spot+Shadow control'}),
-    0x0300: ('MacroMode',
-             {0: 'Off',
-              1: 'On'}),
-    0x0301: ('FocusMode',
-             {0: 'Single AF',
-              1: 'Sequential shooting AF',
-              2: 'Continuous AF',
-              3: 'Multi AF',
-              10: 'MF'}),
-    0x0302: ('FocusProcess',
-             {0: 'AF Not Used',
-              1: 'AF Used'}),
-    0x0303: ('AFSearch',
-             {0: 'Not Ready',
-              1: 'Ready'}),
-    0x0304: ('AFAreas', ),
-    0x0401: ('FlashExposureCompensation', ),
-    0x0500: ('WhiteBalance2',
-             {0: 'Auto',
-             16: '7500K (Fine Weather with Shade)',
-             17: '6000K (Cloudy)',
-             18: '5300K (Fine Weather)',
-             20: '3000K (Tungsten light)',
-             21: '3600K (Tungsten light-like)',
-             33: '6600K (Daylight fluorescent)',
-             34: '4500K (Neutral white fluorescent)',
-             35: '4000K (Cool white fluorescent)',
-             48: '3600K (Tungsten light-like)',
-             256: 'Custom WB 1',
-             257: 'Custom WB 2',
-             258: 'Custom WB 3',
-             259: 'Custom WB 4',
-             512: 'Custom WB 5400K',
-             513: 'Custom WB 2900K',
-             514: 'Custom WB 8000K', }),
-    0x0501: ('WhiteBalanceTemperature', ),
-    0x0502: ('WhiteBalanceBracket', ),
-    0x0503: ('CustomSaturation', ), # (3 numbers: 1. CS Value, 2. Min, 3. Max)
-    0x0504: ('ModifiedSaturation',
-             {0: 'Off',
-              1: 'CM1 (Red Enhance)',
-              2: 'CM2 (Green Enhance)',
-              3: 'CM3 (Blue Enhance)',
-              4: 'CM4 (Skin Tones)'}),
-    0x0505: ('ContrastSetting', ), # (3 numbers: 1. Contrast, 2. Min, 3. Max)
-    0x0506: ('SharpnessSetting', ), # (3 numbers: 1. Sharpness, 2. Min, 3. Max)
-    0x0507: ('ColorSpace',
-             {0: 'sRGB',
-              1: 'Adobe RGB',
-              2: 'Pro Photo RGB'}),
-    0x0509: ('SceneMode',
-             {0: 'Standard',
-              6: 'Auto',
-              7: 'Sport',
-              8: 'Portrait',
-              9: 'Landscape+Portrait',
-             10: 'Landscape',
-             11: 'Night scene',
-             13: 'Panorama',
-             16: 'Landscape+Portrait',
-             17: 'Night+Portrait',
-             19: 'Fireworks',
-             20: 'Sunset',
-             22: 'Macro',
-             25: 'Documents',
-             26: 'Museum',
-             28: 'Beach&Snow',
-             30: 'Candle',
-             35: 'Underwater Wide1',
-             36: 'Underwater Macro',
-             39: 'High Key',
-             40: 'Digital Image Stabilization',
-             44: 'Underwater Wide2',
-             45: 'Low Key',
-             46: 'Children',
-             48: 'Nature Macro'}),
-    0x050a: ('NoiseReduction',
-             {0: 'Off',
-              1: 'Noise Reduction',
-              2: 'Noise Filter',
-              3: 'Noise Reduction + Noise Filter',
-              4: 'Noise Filter (ISO Boost)',
-              5: 'Noise Reduction + Noise Filter (ISO Boost)'}),
-    0x050b: ('DistortionCorrection',
-             {0: 'Off',
-              1: 'On'}),
-    0x050c: ('ShadingCompensation',
-             {0: 'Off',
-              1: 'On'}),
-    0x050d: ('CompressionFactor', ),
-    0x050f: ('Gradation',
-             {'-1 -1 1': 'Low Key',
-              '0 -1 1': 'Normal',
-              '1 -1 1': 'High Key'}),
-    0x0520: ('PictureMode',
-             {1: 'Vivid',
-              2: 'Natural',
-              3: 'Muted',
-              256: 'Monotone',
-              512: 'Sepia'}),
-    0x0521: ('PictureModeSaturation', ),
-    0x0522: ('PictureModeHue?', ),
-    0x0523: ('PictureModeContrast', ),
-    0x0524: ('PictureModeSharpness', ),
-    0x0525: ('PictureModeBWFilter',
-             {0: 'n/a',
-              1: 'Neutral',
-              2: 'Yellow',
-              3: 'Orange',
-              4: 'Red',
-              5: 'Green'}),
-    0x0526: ('PictureModeTone',
-             {0: 'n/a',
-              1: 'Neutral',
-              2: 'Sepia',
-              3: 'Blue',
-              4: 'Purple',
-              5: 'Green'}),
-    0x0600: ('Sequence', ), # 2 or 3 numbers: 1. Mode, 2. Shot number, 3. Mode bits
-    0x0601: ('PanoramaMode', ), # (2 numbers: 1. Mode, 2. Shot number)
-    0x0603: ('ImageQuality2',
-             {1: 'SQ',
-              2: 'HQ',
-              3: 'SHQ',
-              4: 'RAW'}),
-    0x0901: ('ManometerReading', ),
-    }
-
-
-MAKERNOTE_CASIO_TAGS={
-    0x0001: ('RecordingMode',
-             {1: 'Single Shutter',
-              2: 'Panorama',
-              3: 'Night Scene',
-              4: 'Portrait',
-              5: 'Landscape'}),
-    0x0002: ('Quality',
-             {1: 'Economy',
-              2: 'Normal',
-              3: 'Fine'}),
-    0x0003: ('FocusingMode',
-             {2: 'Macro',
-              3: 'Auto Focus',
-              4: 'Manual Focus',
-              5: 'Infinity'}),
-    0x0004: ('FlashMode',
-             {1: 'Auto',
-              2: 'On',
-              3: 'Off',
-              4: 'Red Eye Reduction'}),
-    0x0005: ('FlashIntensity',
-             {11: 'Weak',
-              13: 'Normal',
-              15: 'Strong'}),
-    0x0006: ('Object Distance', ),
-    0x0007: ('WhiteBalance',
-             {1: 'Auto',
-              2: 'Tungsten',
-              3: 'Daylight',
-              4: 'Fluorescent',
-              5: 'Shade',
-              129: 'Manual'}),
-    0x000B: ('Sharpness',
-             {0: 'Normal',
-              1: 'Soft',
-              2: 'Hard'}),
-    0x000C: ('Contrast',
-             {0: 'Normal',
-              1: 'Low',
-              2: 'High'}),
-    0x000D: ('Saturation',
-             {0: 'Normal',
-              1: 'Low',
-              2: 'High'}),
-    0x0014: ('CCDSpeed',
-             {64: 'Normal',
-              80: 'Normal',
-              100: 'High',
-              125: '+1.0',
-              244: '+3.0',
-              250: '+2.0'}),
-    }
-
-MAKERNOTE_FUJIFILM_TAGS={
-    0x0000: ('NoteVersion', make_string),
-    0x1000: ('Quality', ),
-    0x1001: ('Sharpness',
-             {1: 'Soft',
-              2: 'Soft',
-              3: 'Normal',
-              4: 'Hard',
-              5: 'Hard'}),
-    0x1002: ('WhiteBalance',
-             {0: 'Auto',
-              256: 'Daylight',
-              512: 'Cloudy',
-              768: 'DaylightColor-Fluorescent',
-              769: 'DaywhiteColor-Fluorescent',
-              770: 'White-Fluorescent',
-              1024: 'Incandescent',
-              3840: 'Custom'}),
-    0x1003: ('Color',
-             {0: 'Normal',
-              256: 'High',
-              512: 'Low'}),
-    0x1004: ('Tone',
-             {0: 'Normal',
-              256: 'High',
-              512: 'Low'}),
-    0x1010: ('FlashMode',
-             {0: 'Auto',
-              1: 'On',
-              2: 'Off',
-              3: 'Red Eye Reduction'}),
-    0x1011: ('FlashStrength', ),
-    0x1020: ('Macro',
-             {0: 'Off',
-              1: 'On'}),
-    0x1021: ('FocusMode',
-             {0: 'Auto',
-              1: 'Manual'}),
-    0x1030: ('SlowSync',
-             {0: 'Off',
-              1: 'On'}),
-    0x1031: ('PictureMode',
-             {0: 'Auto',
-              1: 'Portrait',
-              2: 'Landscape',
-              4: 'Sports',
-              5: 'Night',
-              6: 'Program AE',
-              256: 'Aperture Priority AE',
-              512: 'Shutter Priority AE',
-              768: 'Manual Exposure'}),
-    0x1100: ('MotorOrBracket',
-             {0: 'Off',
-              1: 'On'}),
-    0x1300: ('BlurWarning',
-             {0: 'Off',
-              1: 'On'}),
-    0x1301: ('FocusWarning',
-             {0: 'Off',
-              1: 'On'}),
-    0x1302: ('AEWarning',
-             {0: 'Off',
-              1: 'On'}),
-    }
-
-MAKERNOTE_CANON_TAGS = {
-    0x0006: ('ImageType', ),
-    0x0007: ('FirmwareVersion', ),
-    0x0008: ('ImageNumber', ),
-    0x0009: ('OwnerName', ),
-    }
-
-# this is in element offset, name, optional value dictionary format
-MAKERNOTE_CANON_TAG_0x001 = {
-    1: ('Macromode',
-        {1: 'Macro',
-         2: 'Normal'}),
-    2: ('SelfTimer', ),
-    3: ('Quality',
-        {2: 'Normal',
-         3: 'Fine',
-         5: 'Superfine'}),
-    4: ('FlashMode',
-        {0: 'Flash Not Fired',
-         1: 'Auto',
-         2: 'On',
-         3: 'Red-Eye Reduction',
-         4: 'Slow Synchro',
-         5: 'Auto + Red-Eye Reduction',
-         6: 'On + Red-Eye Reduction',
-         16: 'external flash'}),
-    5: ('ContinuousDriveMode',
-        {0: 'Single Or Timer',
-         1: 'Continuous'}),
-    7: ('FocusMode',
-        {0: 'One-Shot',
-         1: 'AI Servo',
-         2: 'AI Focus',
-         3: 'MF',
-         4: 'Single',
-         5: 'Continuous',
-         6: 'MF'}),
-    10: ('ImageSize',
-         {0: 'Large',
-          1: 'Medium',
-          2: 'Small'}),
-    11: ('EasyShootingMode',
-         {0: 'Full Auto',
-          1: 'Manual',
-          2: 'Landscape',
-          3: 'Fast Shutter',
-          4: 'Slow Shutter',
-          5: 'Night',
-          6: 'B&W',
-          7: 'Sepia',
-          8: 'Portrait',
-          9: 'Sports',
-          10: 'Macro/Close-Up',
-          11: 'Pan Focus'}),
-    12: ('DigitalZoom',
-         {0: 'None',
-          1: '2x',
-          2: '4x'}),
-    13: ('Contrast',
-         {0xFFFF: 'Low',
-          0: 'Normal',
-          1: 'High'}),
-    14: ('Saturation',
-         {0xFFFF: 'Low',
-          0: 'Normal',
-          1: 'High'}),
-    15: ('Sharpness',
-         {0xFFFF: 'Low',
-          0: 'Normal',
-          1: 'High'}),
-    16: ('ISO',
-         {0: 'See ISOSpeedRatings Tag',
-          15: 'Auto',
-          16: '50',
-          17: '100',
-          18: '200',
-          19: '400'}),
-    17: ('MeteringMode',
-         {3: 'Evaluative',
-          4: 'Partial',
-          5: 'Center-weighted'}),
-    18: ('FocusType',
-         {0: 'Manual',
-          1: 'Auto',
-          3: 'Close-Up (Macro)',
-          8: 'Locked (Pan Mode)'}),
-    19: ('AFPointSelected',
-         {0x3000: 'None (MF)',
-          0x3001: 'Auto-Selected',
-          0x3002: 'Right',
-          0x3003: 'Center',
-          0x3004: 'Left'}),
-    20: ('ExposureMode',
-         {0: 'Easy Shooting',
-          1: 'Program',
-          2: 'Tv-priority',
-          3: 'Av-priority',
-          4: 'Manual',
-          5: 'A-DEP'}),
-    23: ('LongFocalLengthOfLensInFocalUnits', ),
-    24: ('ShortFocalLengthOfLensInFocalUnits', ),
-    25: ('FocalUnitsPerMM', ),
-    28: ('FlashActivity',
-         {0: 'Did Not Fire',
-          1: 'Fired'}),
-    29: ('FlashDetails',
-         {14: 'External E-TTL',
-          13: 'Internal Flash',
-          11: 'FP Sync Used',
-          7: '2nd("Rear")-Curtain Sync Used',
-          4: 'FP Sync Enabled'}),
-    32: ('FocusMode',
-         {0: 'Single',
-          1: 'Continuous'}),
-    }
-
-MAKERNOTE_CANON_TAG_0x004 = {
-    7: ('WhiteBalance',
-        {0: 'Auto',
-         1: 'Sunny',
-         2: 'Cloudy',
-         3: 'Tungsten',
-         4: 'Fluorescent',
-         5: 'Flash',
-         6: 'Custom'}),
-    9: ('SequenceNumber', ),
-    14: ('AFPointUsed', ),
-    15: ('FlashBias',
-         {0xFFC0: '-2 EV',
-          0xFFCC: '-1.67 EV',
-          0xFFD0: '-1.50 EV',
-          0xFFD4: '-1.33 EV',
-          0xFFE0: '-1 EV',
-          0xFFEC: '-0.67 EV',
-          0xFFF0: '-0.50 EV',
-          0xFFF4: '-0.33 EV',
-          0x0000: '0 EV',
-          0x000C: '0.33 EV',
-          0x0010: '0.50 EV',
-          0x0014: '0.67 EV',
-          0x0020: '1 EV',
-          0x002C: '1.33 EV',
-          0x0030: '1.50 EV',
-          0x0034: '1.67 EV',
-          0x0040: '2 EV'}),
-    19: ('SubjectDistance', ),
-    }
-
 # extract multibyte integer in Motorola format (little endian)
 def s2n_motorola(str):
     x = 0
@@ -1236,24 +501,197 @@ class IFD_Tag:
                                         self.printable,
                                         self.field_offset)
 
+# struct formats for integers s2n can unpack straight out of a mapped file
+UNPACK_FORMATS = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
+UNPACK_ENDIAN = {'I': '<', 'M': '>'}
+
+# map a whole file read-only, or return None if it can't be (empty files,
+# pipes, platforms without mmap)
+def map_file(f):
+    try:
+        import mmap
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ImportError, AttributeError, EnvironmentError, ValueError):
+        return None
+
+# raised when parsing a file goes over one of its ParseLimits
+class ParseLimit(Exception):
+    pass
+
+# limits on the work parsing one file may do, so a corrupted file (IFD
+# loops, bogus counts and offsets) can't hang the caller or make it read
+# huge regions: IFDs followed in a chain, total IFD entries, bytes read and
+# an optional time budget in seconds
+class ParseLimits:
+    def __init__(self, ifds=64, entries=20000, bytes=4*1024*1024, seconds=None):
+        self.ifds = ifds
+        self.entries = entries
+        self.bytes = bytes
+        self.seconds = seconds
+
+DEFAULT_LIMITS = ParseLimits()
+
+# work parsing one file has done against its ParseLimits; process_file
+# shares one between the PNG or ISO base media walk and the IFDs, so the
+# limits cover the whole file
+class ParseBudget:
+    def __init__(self, limits=None):
+        self.limits = limits or DEFAULT_LIMITS
+        self.entries = 0
+        self.bytes = 0
+        self.deadline = None
+        if self.limits.seconds:
+            self.deadline = time.time() + self.limits.seconds
+
+    # account for length more bytes read, checked before reading so a bogus
+    # count never gets to allocate its buffer
+    def spend(self, length):
+        self.bytes += length
+        if self.bytes > self.limits.bytes:
+            raise ParseLimit('read more than %d bytes' % self.limits.bytes)
+
+    # account for one more entry (an IFD entry, PNG chunk, box or HEIF
+    # item), and check the time budget
+    def step(self):
+        self.entries += 1
+        if self.entries > self.limits.entries:
+            raise ParseLimit('more than %d entries' % self.limits.entries)
+        if self.deadline is not None and time.time() > self.deadline:
+            raise ParseLimit('took more than %g seconds' % self.limits.seconds)
+
+# handle on a JPEG thumbnail embedded in a file at offset (from the start of
+# the file), nothing is read until read() is called; file is the one the
+# tags came from, pass an open one to read() if that one was closed since
+class Thumbnail:
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self):
+        return '<%s of %d bytes at %d>' % (self.__class__.__name__,
+                                           self.length, self.offset)
+
+    def read(self, file=None):
+        f = file or self.file
+        # a bogus length must not allocate more than the file holds
+        f.seek(0, 2)
+        length = min(self.length, max(f.tell() - self.offset, 0))
+        f.seek(self.offset)
+        return f.read(length)
+
+# handle on an uncompressed TIFF thumbnail, which has to be rebuilt from
+# the thumbnail IFD and its strips when read; length is only the size of
+# the pixel strips
+class TIFFThumbnail(Thumbnail):
+    def __init__(self, hdr, thumb_ifd):
+        self.file = hdr.file
+        self.offset = hdr.offset + thumb_ifd
+        self.length = sum(hdr.tags['Thumbnail StripByteCounts'].values)
+        self.hdr = hdr
+        self.thumb_ifd = thumb_ifd
+
+    def read(self, file=None):
+        # a header of its own, reading straight from the file: the mapped
+        # file the tags were parsed from is closed by now, and the time
+        # budget of the parse is long spent
+        limits = self.hdr.limits
+        hdr = EXIF_header(file or self.file, self.hdr.endian, self.hdr.offset,
+                          self.hdr.fake_exif, self.hdr.strict,
+                          limits=ParseLimits(limits.ifds, limits.entries, limits.bytes))
+        hdr.tags = self.hdr.tags
+        return hdr.extract_TIFF_thumbnail(self.thumb_ifd)
+
+# tags returned by process_file; a MakerNote is only decoded the first time
+# one of its tags (or a thumbnail it may hold) is looked up, or when
+# decode_maker_note() is called.  Iterating shows MakerNote tags only once
+# decoded.
+class ExifTags(dict):
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.maker_note = None
+
+    # whether looking up key has to decode the pending MakerNote first
+    def pending(self, key):
+        return self.maker_note is not None and \
+               (key.startswith('MakerNote ') or key == 'JPEGThumbnail')
+
+    def decode_maker_note(self):
+        maker_note, self.maker_note = self.maker_note, None
+        if maker_note is not None:
+            maker_note.decode(self)
+
+    def __missing__(self, key):
+        if self.pending(key):
+            self.decode_maker_note()
+            return self[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key) and self.pending(key):
+            self.decode_maker_note()
+        return dict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
 # class that handles an EXIF header
+# if data is given (a mapped file) values are decoded straight out of it
+# instead of seeking and reading the file for each one
 class EXIF_header:
-    def __init__(self, file, endian, offset, fake_exif, strict, debug=0):
+    def __init__(self, file, endian, offset, fake_exif, strict, debug=0, data=None,
+                 limits=None, budget=None):
         self.file = file
         self.endian = endian
         self.offset = offset
         self.fake_exif = fake_exif
         self.strict = strict
         self.debug = debug
-        self.tags = {}
+        self.data = data
+        self.tags = ExifTags()
+        # work done so far against the limits, and why parsing stopped early
+        self.budget = budget or ParseBudget(limits)
+        self.limits = self.budget.limits
+        self.truncated = None
+
+    def spend(self, length):
+        self.budget.spend(length)
+
+    def step(self):
+        self.budget.step()
+
+    # return length bytes at offset
+    def read(self, offset, length):
+        self.spend(length)
+        start = self.offset + offset
+        if self.data is None:
+            self.file.seek(start)
+            return self.file.read(length)
+        if start < 0:
+            raise IOError('invalid offset %d' % start)
+        return self.data[start:start+length]
 
     # convert slice to integer, based on sign and endian flags
     # usually this offset is assumed to be relative to the beginning of the
     # start of the EXIF information.  For some cameras that use relative tags,
     # this offset may be relative to some other starting point.
     def s2n(self, offset, length, signed=0):
-        self.file.seek(self.offset+offset)
-        slice=self.file.read(length)
+        if self.data is not None and length in UNPACK_FORMATS and self.offset+offset >= 0:
+            fmt = UNPACK_FORMATS[length]
+            if signed:
+                fmt = fmt.lower()
+            self.spend(length)
+            try:
+                return struct.unpack_from(UNPACK_ENDIAN[self.endian] + fmt,
+                                          self.data, self.offset+offset)[0]
+            except struct.error:
+                # runs past the end of the file, decode what there is
+                pass
+        slice=self.read(offset, length)
         if self.endian == 'I':
             val=s2n_intel(slice)
         else:
@@ -1265,6 +703,26 @@ class EXIF_header:
                 val=val-(msb << 1)
         return val
 
+    # decode count values of field_type at offset with one read, rather
+    # than an s2n call per value; what runs past the end of the file reads
+    # as zeros like s2n does
+    def unpack(self, offset, count, field_type, signed):
+        typelen = FIELD_TYPES[field_type][0]
+        if field_type in (5, 10):
+            # ratios, a pair of longs each
+            number, length = count * 2, 4
+        else:
+            number, length = count, typelen
+        fmt = UNPACK_FORMATS[length]
+        if signed:
+            fmt = fmt.lower()
+        data = self.read(offset, count * typelen).ljust(count * typelen, '\x00')
+        values = struct.unpack('%s%d%s' % (UNPACK_ENDIAN.get(self.endian, '>'),
+                                           number, fmt), data)
+        if field_type in (5, 10):
+            return [Ratio(values[i], values[i+1]) for i in range(0, number, 2)]
+        return list(values)
+
     # convert offset to string
     def n2s(self, offset, length):
         s = ''
@@ -1286,18 +744,29 @@ class EXIF_header:
         return self.s2n(ifd+2+12*entries, 4)
 
     # return list of IFDs in header
+    # a chain pointing back into itself or longer than the limit is cut
+    # short, keeping the IFDs found up to there
     def list_IFDs(self):
         i=self.first_IFD()
         a=[]
+        visited=set()
         while i:
+            if i in visited:
+                self.truncated = 'IFD loop at offset %d' % i
+                break
+            if len(a) >= self.limits.ifds:
+                self.truncated = 'more than %d IFDs' % self.limits.ifds
+                break
+            visited.add(i)
             a.append(i)
             i=self.next_IFD(i)
         return a
 
     # return list of entries in this IFD
-    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF'):
+    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, stop_tag='UNDEF'):
         entries=self.s2n(ifd, 2)
         for i in range(entries):
+            self.step()
             # entry is index of start of this IFD in the file
             entry = ifd + 2 + 12 * i
             tag = self.s2n(entry, 2)
@@ -1330,18 +799,9 @@ class EXIF_header:
                 # need to jump ahead again.
                 if count * typelen > 4:
                     # offset is not the value; it's a pointer to the value
-                    # if relative we set things up so s2n will seek to the right
-                    # place when it adds self.offset.  Note that this 'relative'
-                    # is for the Nikon type 3 makernote.  Other cameras may use
-                    # other relative offsets, which would have to be computed here
-                    # slightly differently.
-                    if relative:
-                        tmp_offset = self.s2n(offset, 4)
-                        offset = tmp_offset + ifd - 8
-                        if self.fake_exif:
-                            offset = offset + 18
-                    else:
-                        offset = self.s2n(offset, 4)
+                    # (relative to self.offset, which for MakerNotes that
+                    # use relative addressing is the start of the note)
+                    offset = self.s2n(offset, 4)
 
                 field_offset = offset
                 if field_type == 2:
@@ -1349,8 +809,7 @@ class EXIF_header:
                     # XXX investigate
                     # sometimes gets too big to fit in int value
                     if count != 0 and count < (2**31):
-                        self.file.seek(self.offset + offset)
-                        values = self.file.read(count)
+                        values = self.read(offset, count)
                         #print values
                         # Drop any garbage after a null.
                         values = values.split('\x00', 1)[0]
@@ -1363,23 +822,10 @@ class EXIF_header:
                     # XXX investigate
                     # some entries get too big to handle could be malformed
                     # file or problem with self.s2n
-                    if count < 1000:
-                        for dummy in range(count):
-                            if field_type in (5, 10):
-                                # a ratio
-                                value = Ratio(self.s2n(offset, 4, signed),
-                                              self.s2n(offset + 4, 4, signed))
-                            else:
-                                value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
-                    # The test above causes problems with tags that are
-                    # supposed to have long values!  Fix up one important case.
-                    elif tag_name == 'MakerNote' :
-                        for dummy in range(count):
-                            value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
+                    # The test causes problems with tags that are supposed
+                    # to have long values!  Fix up one important case.
+                    if count < 1000 or tag_name == 'MakerNote':
+                        values = self.unpack(offset, count, field_type, signed)
                     #else :
                     #    print "Warning: dropping large tag:", tag, tag_name
 
@@ -1415,19 +861,18 @@ class EXIF_header:
             if tag_name == stop_tag:
                 break
 
-    # extract uncompressed TIFF thumbnail (like pulling teeth)
+    # build uncompressed TIFF thumbnail (like pulling teeth)
     # we take advantage of the pre-existing layout in the thumbnail IFD as
     # much as possible
     def extract_TIFF_thumbnail(self, thumb_ifd):
         entries = self.s2n(thumb_ifd, 2)
         # this is header plus offset to IFD ...
         if self.endian == 'M':
-            tiff = 'MM\x00*\x00\x00\x00\x08'
+            tiff = bytearray('MM\x00*\x00\x00\x00\x08')
         else:
-            tiff = 'II*\x00\x08\x00\x00\x00'
+            tiff = bytearray('II*\x00\x08\x00\x00\x00')
         # ... plus thumbnail IFD data plus a null "next IFD" pointer
-        self.file.seek(self.offset+thumb_ifd)
-        tiff += self.file.read(entries*12+2)+'\x00\x00\x00\x00'
+        tiff += self.read(thumb_ifd, entries*12+2)+'\x00\x00\x00\x00'
 
         # fix up large value offset pointers into data area
         for i in range(entries):
@@ -1445,131 +890,28 @@ class EXIF_header:
                 strip_len = count * typelen
             # is it in the data area?
             if count * typelen > 4:
-                # update offset pointer (nasty "strings are immutable" crap)
-                # should be able to say "tiff[ptr:ptr+4]=newoff"
+                # update offset pointer
                 newoff = len(tiff)
-                tiff = tiff[:ptr] + self.n2s(newoff, 4) + tiff[ptr+4:]
+                tiff[ptr:ptr+4] = self.n2s(newoff, 4)
                 # remember strip offsets location
                 if tag == 0x0111:
                     strip_off = newoff
                     strip_len = 4
                 # get original data and store it
-                self.file.seek(self.offset + oldoff)
-                tiff += self.file.read(count * typelen)
+                tiff += self.read(oldoff, count * typelen)
 
         # add pixel strips and update strip offset info
         old_offsets = self.tags['Thumbnail StripOffsets'].values
         old_counts = self.tags['Thumbnail StripByteCounts'].values
         for i in range(len(old_offsets)):
-            # update offset pointer (more nasty "strings are immutable" crap)
+            # update offset pointer
             offset = self.n2s(len(tiff), strip_len)
-            tiff = tiff[:strip_off] + offset + tiff[strip_off + strip_len:]
+            tiff[strip_off:strip_off + strip_len] = offset
             strip_off += strip_len
             # add pixel strip to end
-            self.file.seek(self.offset + old_offsets[i])
-            tiff += self.file.read(old_counts[i])
-
-        self.tags['TIFFThumbnail'] = tiff
-
-    # decode all the camera-specific MakerNote formats
-
-    # Note is the data that comprises this MakerNote.  The MakerNote will
-    # likely have pointers in it that point to other parts of the file.  We'll
-    # use self.offset as the starting point for most of those pointers, since
-    # they are relative to the beginning of the file.
-    #
-    # If the MakerNote is in a newer format, it may use relative addressing
-    # within the MakerNote.  In that case we'll use relative addresses for the
-    # pointers.
-    #
-    # As an aside: it's not just to be annoying that the manufacturers use
-    # relative offsets.  It's so that if the makernote has to be moved by the
-    # picture software all of the offsets don't have to be adjusted.  Overall,
-    # this is probably the right strategy for makernotes, though the spec is
-    # ambiguous.  (The spec does not appear to imagine that makernotes would
-    # follow EXIF format internally.  Once they did, it's ambiguous whether
-    # the offsets should be from the header at the start of all the EXIF info,
-    # or from the header at the start of the makernote.)
-    def decode_maker_note(self):
-        note = self.tags['EXIF MakerNote']
-
-        # Some apps use MakerNote tags but do not use a format for which we
-        # have a description, so just do a raw dump for these.
-        #if self.tags.has_key('Image Make'):
-        make = self.tags['Image Make'].printable
-        #else:
-        #    make = ''
-
-        # model = self.tags['Image Model'].printable # unused
-
-        # Nikon
-        # The maker note usually starts with the word Nikon, followed by the
-        # type of the makernote (1 or 2, as a short).  If the word Nikon is
-        # not at the start of the makernote, it's probably type 2, since some
-        # cameras work that way.
-        if 'NIKON' in make:
-            if note.values[0:7] == [78, 105, 107, 111, 110, 0, 1]:
-                if self.debug:
-                    print "Looks like a type 1 Nikon MakerNote."
-                self.dump_IFD(note.field_offset+8, 'MakerNote',
-                              dict=MAKERNOTE_NIKON_OLDER_TAGS)
-            elif note.values[0:7] == [78, 105, 107, 111, 110, 0, 2]:
-                if self.debug:
-                    print "Looks like a labeled type 2 Nikon MakerNote"
-                if note.values[12:14] != [0, 42] and note.values[12:14] != [42L, 0L]:
-                    raise ValueError("Missing marker tag '42' in MakerNote.")
-                # skip the Makernote label and the TIFF header
-                self.dump_IFD(note.field_offset+10+8, 'MakerNote',
-                              dict=MAKERNOTE_NIKON_NEWER_TAGS, relative=1)
-            else:
-                # E99x or D1
-                if self.debug:
-                    print "Looks like an unlabeled type 2 Nikon MakerNote"
-                self.dump_IFD(note.field_offset, 'MakerNote',
-                              dict=MAKERNOTE_NIKON_NEWER_TAGS)
-            return
-
-        # Olympus
-        if make.startswith('OLYMPUS'):
-            self.dump_IFD(note.field_offset+8, 'MakerNote',
-                          dict=MAKERNOTE_OLYMPUS_TAGS)
-            # XXX TODO
-            #for i in (('MakerNote Tag 0x2020', MAKERNOTE_OLYMPUS_TAG_0x2020),):
-            #    self.decode_olympus_tag(self.tags[i[0]].values, i[1])
-            #return
-
-        # Casio
-        if 'CASIO' in make or 'Casio' in make:
-            self.dump_IFD(note.field_offset, 'MakerNote',
-                          dict=MAKERNOTE_CASIO_TAGS)
-            return
-
-        # Fujifilm
-        if make == 'FUJIFILM':
-            # bug: everything else is "Motorola" endian, but the MakerNote
-            # is "Intel" endian
-            endian = self.endian
-            self.endian = 'I'
-            # bug: IFD offsets are from beginning of MakerNote, not
-            # beginning of file header
-            offset = self.offset
-            self.offset += note.field_offset
-            # process note with bogus values (note is actually at offset 12)
-            self.dump_IFD(12, 'MakerNote', dict=MAKERNOTE_FUJIFILM_TAGS)
-            # reset to correct values
-            self.endian = endian
-            self.offset = offset
-            return
-
-        # Canon
-        if make == 'Canon':
-            self.dump_IFD(note.field_offset, 'MakerNote',
-                          dict=MAKERNOTE_CANON_TAGS)
-            for i in (('MakerNote Tag 0x0001', MAKERNOTE_CANON_TAG_0x001),
-                      ('MakerNote Tag 0x0004', MAKERNOTE_CANON_TAG_0x004)):
-                self.canon_decode_tag(self.tags[i[0]].values, i[1])
-            return
+            tiff += self.read(old_offsets[i], old_counts[i])
 
+        return str(tiff)
 
     # XXX TODO decode Olympus MakerNote tag based on offset within tag
     def olympus_decode_tag(self, value, dict):
@@ -1592,10 +934,167 @@ class EXIF_header:
             self.tags['MakerNote '+name]=IFD_Tag(str(val), None, 0, None,
                                                  None, None)
 
+# decode all the camera-specific MakerNote formats
+
+# The MakerNote will likely have pointers in it that point to other parts of
+# the file.  Most of those pointers are relative to the TIFF header at the
+# start of all the EXIF info.
+#
+# If the MakerNote is in a newer format, it may use relative addressing
+# within the MakerNote.  In that case we'll use relative addresses for the
+# pointers.
+#
+# As an aside: it's not just to be annoying that the manufacturers use
+# relative offsets.  It's so that if the makernote has to be moved by the
+# picture software all of the offsets don't have to be adjusted.  Overall,
+# this is probably the right strategy for makernotes, though the spec is
+# ambiguous.  (The spec does not appear to imagine that makernotes would
+# follow EXIF format internally.  Once they did, it's ambiguous whether
+# the offsets should be from the header at the start of all the EXIF info,
+# or from the header at the start of the makernote.)
+
+# a MakerNote found while parsing, along with the handler for its vendor;
+# the note's bytes are already in memory so decoding it later doesn't need
+# the file, only pointers into the note itself can be followed
+class MakerNote:
+    def __init__(self, handler, note, file, file_offset, endian, strict, debug=0,
+                 limits=None):
+        self.handler = handler
+        self.note = note
+        # the file and where the note starts in it, for thumbnails it holds
+        self.file = file
+        self.file_offset = file_offset
+        self.base = None
+        self.endian = endian
+        self.strict = strict
+        self.debug = debug
+        self.limits = limits or DEFAULT_LIMITS
+        self.data = None
+        self.tags = None
+
+    def decode(self, tags):
+        self.data = ''.join([chr(v) for v in self.note.values])
+        self.tags = tags
+        try:
+            self.handler(self)
+        except ParseLimit as e:
+            tags['ParseLimit'] = IFD_Tag(str(e), None, 2, str(e), 0, 0)
+        self.data = None
+
+        # Sometimes in a TIFF file, a JPEG thumbnail is hidden in the
+        # MakerNote since it's not allowed in a uncompressed TIFF IFD
+        thumb = dict.get(tags, 'MakerNote JPEGThumbnail')
+        if thumb and not dict.__contains__(tags, 'JPEGThumbnail'):
+            tags['JPEGThumbnail'] = Thumbnail(self.file,
+                                              self.file_offset + self.base + thumb.field_offset,
+                                              thumb.field_length)
+
+    # dump the IFD start bytes into the note; endian defaults to the file's
+    # and base, where in the note value offsets count from, to the TIFF
+    # header.  Returns the header used so handlers can decode more.
+    def dump(self, start, dict, endian=None, base=None):
+        if base is None:
+            base = -self.note.field_offset
+        if endian not in ('I', 'M'):
+            endian = self.endian
+        self.base = base
+        # the time budget of the parse is long spent
+        limits = ParseLimits(self.limits.ifds, self.limits.entries, self.limits.bytes)
+        hdr = EXIF_header(None, endian, base, 0, self.strict,
+                          self.debug, self.data, limits)
+        hdr.tags = self.tags
+        hdr.dump_IFD(start - base, 'MakerNote', dict=dict)
+        return hdr
+
+# the tag tables of a vendor's MakerNotes, from its module in the makernotes
+# package; importing EXIF doesn't pay for tables most runs never use, a
+# module is only imported the first time one of its notes is decoded
+def maker_note_tables(vendor):
+    return __import__('makernotes.' + vendor, globals(), locals(), [vendor])
+
+# Nikon
+# The maker note usually starts with the word Nikon, followed by the
+# type of the makernote (1 or 2, as a short).  If the word Nikon is
+# not at the start of the makernote, it's probably type 2, since some
+# cameras work that way.
+def decode_nikon_maker_note(maker_note):
+    nikon = maker_note_tables('nikon')
+    values = maker_note.note.values
+    if values[0:7] == [78, 105, 107, 111, 110, 0, 1]:
+        if maker_note.debug:
+            print "Looks like a type 1 Nikon MakerNote."
+        maker_note.dump(8, nikon.MAKERNOTE_NIKON_OLDER_TAGS)
+    elif values[0:7] == [78, 105, 107, 111, 110, 0, 2]:
+        if maker_note.debug:
+            print "Looks like a labeled type 2 Nikon MakerNote"
+        if values[12:14] != [0, 42] and values[12:14] != [42L, 0L]:
+            raise ValueError("Missing marker tag '42' in MakerNote.")
+        # skip the Makernote label, offsets count from the TIFF header
+        # that follows it
+        endian = chr(values[10])
+        maker_note.dump(10+8, nikon.MAKERNOTE_NIKON_NEWER_TAGS, endian, 10)
+    else:
+        # E99x or D1
+        if maker_note.debug:
+            print "Looks like an unlabeled type 2 Nikon MakerNote"
+        maker_note.dump(0, nikon.MAKERNOTE_NIKON_NEWER_TAGS)
+
+# Olympus
+def decode_olympus_maker_note(maker_note):
+    olympus = maker_note_tables('olympus')
+    maker_note.dump(8, olympus.MAKERNOTE_OLYMPUS_TAGS)
+    # XXX TODO
+    #for i in (('MakerNote Tag 0x2020', olympus.MAKERNOTE_OLYMPUS_TAG_0x2020),):
+    #    self.decode_olympus_tag(self.tags[i[0]].values, i[1])
+
+# Casio
+def decode_casio_maker_note(maker_note):
+    casio = maker_note_tables('casio')
+    maker_note.dump(0, casio.MAKERNOTE_CASIO_TAGS)
+
+# Fujifilm
+# bug: everything else is "Motorola" endian, but the MakerNote is "Intel"
+# endian, and IFD offsets are from the beginning of the MakerNote, not the
+# beginning of the file header
+def decode_fujifilm_maker_note(maker_note):
+    fujifilm = maker_note_tables('fujifilm')
+    maker_note.dump(12, fujifilm.MAKERNOTE_FUJIFILM_TAGS, 'I', 0)
+
+# Canon
+def decode_canon_maker_note(maker_note):
+    canon = maker_note_tables('canon')
+    hdr = maker_note.dump(0, canon.MAKERNOTE_CANON_TAGS)
+    for i in (('MakerNote Tag 0x0001', canon.MAKERNOTE_CANON_TAG_0x001),
+              ('MakerNote Tag 0x0004', canon.MAKERNOTE_CANON_TAG_0x004)):
+        tag = dict.get(maker_note.tags, i[0])
+        if tag:
+            hdr.canon_decode_tag(tag.values, i[1])
+
+# MakerNote handlers, by a test on the camera make; the first that matches
+# decodes the note (some apps use MakerNote tags but do not use a format
+# for which we have a description, these are not decoded)
+MAKERNOTE_HANDLERS = (
+    (lambda make: 'NIKON' in make, decode_nikon_maker_note),
+    (lambda make: make.startswith('OLYMPUS'), decode_olympus_maker_note),
+    (lambda make: 'CASIO' in make or 'Casio' in make, decode_casio_maker_note),
+    (lambda make: make == 'FUJIFILM', decode_fujifilm_maker_note),
+    (lambda make: make == 'Canon', decode_canon_maker_note),
+    )
+
+def maker_note_handler(make):
+    for test, handler in MAKERNOTE_HANDLERS:
+        if test(make):
+            return handler
+    return None
+
 # process an image file (expects an open file object)
 # this is the function that has to deal with all the arbitrary nasty bits
 # of the EXIF standard
-def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
+# with use_mmap the file is mapped and decoded in place, which saves a seek
+# and read for every value in TIFF based files (DNG, NEF, CR2, ...) whose
+# IFDs are spread all over the file
+def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False,
+                 use_mmap=False, limits=None):
     # yah it's cheesy...
     global detailed
     detailed = details
@@ -1603,9 +1102,34 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     # by default do not fake an EXIF beginning
     fake_exif = 0
 
-    # determine whether it's a JPEG or TIFF
+    # tags found outside of the EXIF information (PNG chunks)
+    extra_tags = {}
+
+    # shared by the walk to the EXIF information and the IFDs
+    budget = ParseBudget(limits)
+
+    # determine whether it's a JPEG, TIFF, PNG or ISO base media file
     data = f.read(12)
-    if data[0:4] in ['II*\x00', 'MM\x00*']:
+    if data[0:8] == PNG_SIGNATURE:
+        # it's a PNG file, the EXIF information is in an eXIf chunk
+        extra_tags, offset = walk_png(f, debug, budget)
+        if offset is None:
+            return extra_tags
+        f.seek(offset)
+        endian = f.read(1)
+        if endian not in ('I', 'M'):
+            return extra_tags
+    elif data[4:8] in ISOBMFF_TYPES:
+        # it's an ISO base media file (HEIF, MP4, MOV), the EXIF information
+        # is an item of the meta box
+        extra_tags, offset = walk_isobmff(f, debug, budget)
+        if offset is None:
+            return extra_tags
+        f.seek(offset)
+        endian = f.read(1)
+        if endian not in ('I', 'M'):
+            return extra_tags
+    elif data[0:4] in ['II*\x00', 'MM\x00*']:
         # it's a TIFF file
         f.seek(0)
         endian = f.read(1)
@@ -1633,71 +1157,863 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     # deal with the EXIF info we found
     if debug:
         print {'I': 'Intel', 'M': 'Motorola'}[endian], 'format'
-    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug)
-    ifd_list = hdr.list_IFDs()
-    ctr = 0
-    for i in ifd_list:
-        if ctr == 0:
-            IFD_name = 'Image'
-        elif ctr == 1:
-            IFD_name = 'Thumbnail'
-            thumb_ifd = i
+    data = None
+    if use_mmap:
+        data = map_file(f)
+    try:
+        tags = dump_file(f, endian, offset, fake_exif, stop_tag, strict, debug, data,
+                         limits, budget)
+    finally:
+        if data is not None:
+            data.close()
+    tags.update(extra_tags)
+    return tags
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# box types an ISO base media file (HEIF, MP4, MOV) can start with; older
+# QuickTime files have no 'ftyp'
+ISOBMFF_TYPES = ('ftyp', 'moov', 'mdat', 'free', 'skip', 'wide', 'pnot')
+
+# seconds between 1904-01-01, where MP4/MOV times count from, and 1970-01-01
+MP4_EPOCH_OFFSET = 2082844800
+
+# iterate the boxes between file offsets start and end (or the end of the
+# file) as (type, data offset, data size), reading only their headers
+def iter_boxes(f, budget, start, end=None):
+    pos = start
+    while end is None or pos + 8 <= end:
+        budget.step()
+        budget.spend(8)
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>L4s', header)
+        header_size = 8
+        if size == 1:
+            # 64 bit size follows the type
+            budget.spend(8)
+            large = f.read(8)
+            if len(large) < 8:
+                return
+            size = struct.unpack('>Q', large)[0]
+            header_size = 16
+        elif size == 0:
+            # box extends to the end of its parent or the file
+            if end is None:
+                f.seek(0, 2)
+                size = f.tell() - pos
+            else:
+                size = end - pos
+        if size < header_size:
+            # corrupt size, nothing after this can be trusted
+            return
+        yield kind, pos + header_size, size - header_size
+        pos += size
+
+# read a big endian unsigned integer of size bytes at pos, returns the
+# value and the position after it
+def read_uint(data, pos, size):
+    if size == 0:
+        return 0, pos
+    fmt = {1: '>B', 2: '>H', 4: '>L', 8: '>Q'}[size]
+    return struct.unpack(fmt, data[pos:pos+size])[0], pos + size
+
+# parse the data of an 'iloc' (item location) box, returns a dictionary of
+# item ID to file offset of the item's first extent
+# the item and extent counts come from the file, so they're capped by how
+# many entries the data can actually hold, and each item is an entry of
+# the budget
+def parse_iloc(data, budget):
+    locations = {}
+    try:
+        version = ord(data[0])
+        sizes, pos = read_uint(data, 4, 2)
+        offset_size = sizes >> 12
+        length_size = (sizes >> 8) & 0x0F
+        base_offset_size = (sizes >> 4) & 0x0F
+        if version in (1, 2):
+            index_size = sizes & 0x0F
         else:
-            IFD_name = 'IFD %d' % ctr
-        if debug:
-            print ' IFD %d (%s) at offset %d:' % (ctr, IFD_name, i)
-        hdr.dump_IFD(i, IFD_name, stop_tag=stop_tag)
-        # EXIF IFD
-        exif_off = hdr.tags.get(IFD_name+' ExifOffset')
-        if exif_off:
+            index_size = 0
+        if version < 2:
+            id_size = 2
+        else:
+            id_size = 4
+        count, pos = read_uint(data, pos, id_size)
+        # item ID, construction method, data reference index, base offset
+        # and extent count
+        item_size = id_size + 2 + base_offset_size + 2
+        if version in (1, 2):
+            item_size += 2
+        extent_size = index_size + offset_size + length_size
+        count = min(count, (len(data) - pos) // item_size)
+        for dummy in xrange(count):
+            budget.step()
+            item_id, pos = read_uint(data, pos, id_size)
+            construction_method = 0
+            if version in (1, 2):
+                construction_method, pos = read_uint(data, pos, 2)
+                construction_method &= 0x0F
+            data_reference_index, pos = read_uint(data, pos, 2)
+            base_offset, pos = read_uint(data, pos, base_offset_size)
+            extent_count, pos = read_uint(data, pos, 2)
+            if extent_size:
+                extent_count = min(extent_count, (len(data) - pos) // extent_size)
+            else:
+                # empty extents all locate the item at its base offset
+                extent_count = min(extent_count, 1)
+            for i in xrange(extent_count):
+                if index_size:
+                    extent_index, pos = read_uint(data, pos, index_size)
+                extent_offset, pos = read_uint(data, pos, offset_size)
+                extent_length, pos = read_uint(data, pos, length_size)
+                # only items stored in the file itself can be read
+                if i == 0 and construction_method == 0 and \
+                   data_reference_index == 0:
+                    locations[item_id] = base_offset + extent_offset
+    except (IndexError, KeyError, struct.error):
+        # truncated box, keep what was parsed
+        pass
+    return locations
+
+# find the Exif item of a HEIF 'meta' box, whose data is between file
+# offsets start and end, returns the file offset of its TIFF header or None
+def heif_exif_offset(f, start, end, budget):
+    exif_id = None
+    locations = {}
+    # 'meta' is a full box, skip its version and flags
+    for kind, pos, size in iter_boxes(f, budget, start + 4, end):
+        if kind == 'iinf':
+            budget.spend(1)
+            f.seek(pos)
+            version = f.read(1)
+            if not version:
+                # truncated file, there is no Exif item to find
+                return None
+            if version == '\x00':
+                count_size = 2
+            else:
+                count_size = 4
+            for kind2, pos2, size2 in iter_boxes(f, budget, pos + 4 + count_size, pos + size):
+                if kind2 != 'infe':
+                    continue
+                budget.spend(16)
+                f.seek(pos2)
+                infe = f.read(min(size2, 16))
+                # version, flags, item ID, protection index and item type
+                if len(infe) >= 12 and infe[0] == '\x02':
+                    item_id = struct.unpack('>H', infe[4:6])[0]
+                    item_type = infe[8:12]
+                elif len(infe) >= 14 and infe[0] == '\x03':
+                    item_id = struct.unpack('>L', infe[4:8])[0]
+                    item_type = infe[10:14]
+                else:
+                    continue
+                if item_type == 'Exif':
+                    exif_id = item_id
+                    break
+        elif kind == 'iloc':
+            budget.spend(min(size, 1 << 20))
+            f.seek(pos)
+            locations = parse_iloc(f.read(min(size, 1 << 20)), budget)
+    if exif_id is None or exif_id not in locations:
+        return None
+    # the item starts with the offset of the TIFF header past this field,
+    # usually skipping an 'Exif\0\0' prefix
+    offset = locations[exif_id]
+    budget.spend(10)
+    f.seek(offset)
+    skip = f.read(4)
+    if len(skip) < 4:
+        return None
+    offset += 4 + struct.unpack('>L', skip)[0]
+    f.seek(offset)
+    if f.read(6) == 'Exif\x00\x00':
+        offset += 6
+    return offset
+
+# convert a UTC Unix timestamp to EXIF's 'YYYY:MM:DD HH:MM:SS' in local
+# time, which is what cameras write in EXIF, so videos and PNGs are dated
+# like the photos taken alongside them
+def local_datetime(timestamp):
+    try:
+        dt = datetime.fromtimestamp(timestamp)
+    except (ValueError, OverflowError, EnvironmentError):
+        # outside of what the platform's local time handles, leave it UTC
+        dt = datetime(1970, 1, 1) + timedelta(seconds=timestamp)
+    return '%04d:%02d:%02d %02d:%02d:%02d' % (dt.year, dt.month, dt.day,
+                                              dt.hour, dt.minute, dt.second)
+
+# convert an MP4/MOV time (seconds since 1904-01-01 UTC) to local time
+def mp4_datetime(seconds):
+    return local_datetime(seconds - MP4_EPOCH_OFFSET)
+
+# convert the 7 bytes of a PNG tIME chunk (a UTC time) to local time; a
+# value that isn't a real date is kept as is for the caller to reject
+def png_time(data):
+    fields = struct.unpack('>HBBBBB', data)
+    try:
+        utc = datetime(*fields)
+    except ValueError:
+        return '%04d:%02d:%02d %02d:%02d:%02d' % fields
+    return local_datetime(calendar.timegm(utc.timetuple()))
+
+# walk the top level boxes of an ISO base media file by their headers,
+# seeking over their data so media payloads are never read
+# returns the creation and modification times of a movie's 'mvhd' box as
+# 'Movie CreationTime' and 'Movie ModifyTime' tags (local time), and the file
+# offset of the TIFF header of a HEIF Exif item or None if there is none
+# going over the budget keeps what was found and adds a 'ParseLimit' tag
+def walk_isobmff(f, debug=False, budget=None):
+    budget = budget or ParseBudget()
+    tags = {}
+    exif_offset = None
+    try:
+        for kind, pos, size in iter_boxes(f, budget, 0):
             if debug:
-                print ' EXIF SubIFD at offset %d:' % exif_off.values[0]
-            hdr.dump_IFD(exif_off.values[0], 'EXIF', stop_tag=stop_tag)
-            # Interoperability IFD contained in EXIF IFD
-            intr_off = hdr.tags.get('EXIF SubIFD InteroperabilityOffset')
-            if intr_off:
-                if debug:
-                    print ' EXIF Interoperability SubSubIFD at offset %d:' \
-                          % intr_off.values[0]
-                hdr.dump_IFD(intr_off.values[0], 'EXIF Interoperability',
-                             dict=INTR_TAGS, stop_tag=stop_tag)
-        # GPS IFD
-        gps_off = hdr.tags.get(IFD_name+' GPSInfo')
-        if gps_off:
+                print ' box %s (%d bytes) at offset %d' % (kind, size, pos)
+            if kind == 'meta' and exif_offset is None:
+                exif_offset = heif_exif_offset(f, pos, pos + size, budget)
+            elif kind == 'moov':
+                for kind2, pos2, size2 in iter_boxes(f, budget, pos, pos + size):
+                    if kind2 != 'mvhd':
+                        continue
+                    budget.spend(20)
+                    f.seek(pos2)
+                    mvhd = f.read(min(size2, 20))
+                    try:
+                        if ord(mvhd[0]) == 1:
+                            times = struct.unpack('>QQ', mvhd[4:20])
+                        else:
+                            times = struct.unpack('>LL', mvhd[4:12])
+                    except (IndexError, struct.error):
+                        break
+                    for name, seconds in zip(('CreationTime', 'ModifyTime'), times):
+                        # 0 means not set
+                        if seconds:
+                            values = mp4_datetime(seconds)
+                            tags['Movie ' + name] = IFD_Tag(values, None, 2, values,
+                                                            pos2, len(mvhd))
+                    break
+    except ParseLimit as e:
+        tags['ParseLimit'] = IFD_Tag(str(e), None, 2, str(e), 0, 0)
+    return tags, exif_offset
+
+# convert a PNG 'Creation Time' text to EXIF's 'YYYY:MM:DD HH:MM:SS'
+# the PNG spec suggests RFC 1123 dates, but ISO 8601 and EXIF style dates
+# are common too
+def png_datetime(value):
+    value = value.strip()
+    if len(value) >= 19 and value[4] in ':-' and value[7] in ':-' and \
+       value[10] in ' T':
+        return '%s:%s:%s %s' % (value[0:4], value[5:7], value[8:10],
+                                value[11:19])
+    from email.utils import parsedate
+    parsed = parsedate(value)
+    if parsed:
+        return '%04d:%02d:%02d %02d:%02d:%02d' % parsed[:6]
+    return None
+
+# walk the chunks of a PNG file by their headers, seeking over chunk data
+# (the image data is never read) so this costs one small read per chunk
+# returns the creation ('PNG CreationTime', from tEXt) and modification
+# ('PNG ModifyTime', from tIME, in local time) times as tags, and the file
+# offset of the eXIf chunk's data or None if there is no eXIf chunk
+# going over the budget keeps what was found and adds a 'ParseLimit' tag
+def walk_png(f, debug=False, budget=None):
+    budget = budget or ParseBudget()
+    tags = {}
+    exif_offset = None
+    pos = len(PNG_SIGNATURE)
+    try:
+        while True:
+            budget.step()
+            budget.spend(8)
+            f.seek(pos)
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk = struct.unpack('>L4s', header)
+            data_pos = pos + 8
+            if debug:
+                print ' PNG chunk %s (%d bytes) at offset %d' % (chunk, length, pos)
+            if chunk == 'eXIf' and exif_offset is None:
+                budget.spend(6)
+                exif_offset = data_pos
+                # some writers keep the JPEG APP1 'Exif' prefix
+                if f.read(6) == 'Exif\x00\x00':
+                    exif_offset += 6
+            elif chunk == 'tIME' and length == 7:
+                budget.spend(7)
+                data = f.read(7)
+                # a truncated file leaves the next date source to the caller
+                if len(data) == 7:
+                    values = png_time(data)
+                    tags['PNG ModifyTime'] = IFD_Tag(values, None, 2, values, data_pos, 7)
+            elif chunk == 'tEXt' and 'PNG CreationTime' not in tags:
+                # keyword, null, text; creation times are short so don't read
+                # more than that of other (possibly huge) text chunks
+                budget.spend(min(length, 128))
+                keyword, _, text = f.read(min(length, 128)).partition('\x00')
+                if keyword == 'Creation Time':
+                    values = png_datetime(text)
+                    if values:
+                        tags['PNG CreationTime'] = IFD_Tag(values, None, 2, values,
+                                                          data_pos, length)
+            elif chunk == 'IEND':
+                break
+            # skip the chunk data and its CRC
+            pos = data_pos + length + 4
+    except ParseLimit as e:
+        tags['ParseLimit'] = IFD_Tag(str(e), None, 2, str(e), 0, 0)
+    return tags, exif_offset
+
+# read all the IFDs, thumbnails and MakerNote once process_file found the
+# EXIF header
+def dump_file(f, endian, offset, fake_exif, stop_tag, strict, debug, data,
+              limits=None, budget=None):
+    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug, data, limits,
+                      budget)
+    try:
+        ifd_list = hdr.list_IFDs()
+        ctr = 0
+        for i in ifd_list:
+            if ctr == 0:
+                IFD_name = 'Image'
+            elif ctr == 1:
+                IFD_name = 'Thumbnail'
+                thumb_ifd = i
+            else:
+                IFD_name = 'IFD %d' % ctr
             if debug:
-                print ' GPS SubIFD at offset %d:' % gps_off.values[0]
-            hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS, stop_tag=stop_tag)
-        ctr += 1
-
-    # extract uncompressed TIFF thumbnail
-    thumb = hdr.tags.get('Thumbnail Compression')
-    if thumb and thumb.printable == 'Uncompressed TIFF':
-        hdr.extract_TIFF_thumbnail(thumb_ifd)
-
-    # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
-    thumb_off = hdr.tags.get('Thumbnail JPEGInterchangeFormat')
-    if thumb_off:
-        f.seek(offset+thumb_off.values[0])
-        size = hdr.tags['Thumbnail JPEGInterchangeFormatLength'].values[0]
-        hdr.tags['JPEGThumbnail'] = f.read(size)
-
-    # deal with MakerNote contained in EXIF IFD
-    # (Some apps use MakerNote tags but do not use a format for which we
-    # have a description, do not process these).
-    if 'EXIF MakerNote' in hdr.tags and 'Image Make' in hdr.tags and detailed:
-        hdr.decode_maker_note()
-
-    # Sometimes in a TIFF file, a JPEG thumbnail is hidden in the MakerNote
-    # since it's not allowed in a uncompressed TIFF IFD
-    if 'JPEGThumbnail' not in hdr.tags:
-        thumb_off=hdr.tags.get('MakerNote JPEGThumbnail')
-        if thumb_off:
-            f.seek(offset+thumb_off.values[0])
-            hdr.tags['JPEGThumbnail']=file.read(thumb_off.field_length)
+                print ' IFD %d (%s) at offset %d:' % (ctr, IFD_name, i)
+            hdr.dump_IFD(i, IFD_name, stop_tag=stop_tag)
+            # EXIF IFD
+            exif_off = hdr.tags.get(IFD_name+' ExifOffset')
+            if exif_off:
+                if debug:
+                    print ' EXIF SubIFD at offset %d:' % exif_off.values[0]
+                hdr.dump_IFD(exif_off.values[0], 'EXIF', stop_tag=stop_tag)
+                # Interoperability IFD contained in EXIF IFD
+                intr_off = hdr.tags.get('EXIF SubIFD InteroperabilityOffset')
+                if intr_off:
+                    if debug:
+                        print ' EXIF Interoperability SubSubIFD at offset %d:' \
+                              % intr_off.values[0]
+                    hdr.dump_IFD(intr_off.values[0], 'EXIF Interoperability',
+                                 dict=INTR_TAGS, stop_tag=stop_tag)
+            # GPS IFD
+            gps_off = hdr.tags.get(IFD_name+' GPSInfo')
+            if gps_off:
+                if debug:
+                    print ' GPS SubIFD at offset %d:' % gps_off.values[0]
+                hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS, stop_tag=stop_tag)
+            ctr += 1
+
+        # uncompressed TIFF thumbnail
+        thumb = hdr.tags.get('Thumbnail Compression')
+        if thumb and thumb.values[0] == 1 and \
+           'Thumbnail StripOffsets' in hdr.tags and \
+           'Thumbnail StripByteCounts' in hdr.tags:
+            hdr.tags['TIFFThumbnail'] = TIFFThumbnail(hdr, thumb_ifd)
+
+        # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
+        thumb_off = hdr.tags.get('Thumbnail JPEGInterchangeFormat')
+        thumb_len = hdr.tags.get('Thumbnail JPEGInterchangeFormatLength')
+        if thumb_off and thumb_len:
+            hdr.tags['JPEGThumbnail'] = Thumbnail(f, offset + thumb_off.values[0],
+                                                  thumb_len.values[0])
+
+        # note where the MakerNote contained in EXIF IFD is and who can
+        # decode it, it's only decoded once one of its tags is asked for
+        if 'EXIF MakerNote' in hdr.tags and 'Image Make' in hdr.tags and detailed:
+            handler = maker_note_handler(hdr.tags['Image Make'].printable)
+            if handler:
+                note = hdr.tags['EXIF MakerNote']
+                hdr.tags.maker_note = MakerNote(handler, note, f, offset + note.field_offset,
+                                                endian, strict, debug, limits)
+    except ParseLimit as e:
+        hdr.truncated = str(e)
+
+    # flag partial results
+    if hdr.truncated:
+        if debug:
+            print ' parsing stopped early: %s' % hdr.truncated
+        hdr.tags['ParseLimit'] = IFD_Tag(hdr.truncated, None, 2, hdr.truncated, 0, 0)
 
     return hdr.tags
 
 
+# datetime tags read by process_datetime, by IFD they are found in
+DATETIME_TAGS = {
+    'Image': (0x0132, ),
+    'EXIF': (0x9003, 0x9004, 0x9290, 0x9291, 0x9292, 0x9010, 0x9011, 0x9012),
+    }
+
+# sub-second and UTC offset tags that go with each datetime tag
+DATETIME_EXTRA_TAGS = {
+    'DateTimeOriginal': ('SubSecTimeOriginal', 'OffsetTimeOriginal'),
+    'DateTimeDigitized': ('SubSecTimeDigitized', 'OffsetTimeDigitized'),
+    'DateTime': ('SubSecTime', 'OffsetTime'),
+    }
+
+# fixed UTC offset as given by the OffsetTime tags
+class FixedOffset(tzinfo):
+    def __init__(self, minutes):
+        self.offset = timedelta(minutes=minutes)
+        if minutes < 0:
+            sign = '-'
+        else:
+            sign = '+'
+        self.name = '%s%02d:%02d' % (sign, abs(minutes) // 60, abs(minutes) % 60)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return self.name
+
+    def __repr__(self):
+        return '<FixedOffset %s>' % self.name
+
+# convert a 'YYYY:MM:DD HH:MM:SS' value to a datetime by fixed-width
+# slicing, adding microseconds from a SubSecTime value ('123' is .123
+# seconds) and a timezone from an OffsetTime value ('+02:00')
+# returns None if the value is not a valid datetime
+def decode_datetime(value, subsec=None, offset=None):
+    if len(value) < 19 or value[4] != ':' or value[7] != ':' or \
+       value[13] != ':' or value[16] != ':':
+        return None
+    try:
+        dt = datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                      int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    except ValueError:
+        # blank '    :  :     :  :  ' or zeroed '0000:00:00 00:00:00' dates
+        return None
+    if subsec:
+        digits = subsec.strip()[:6]
+        if digits.isdigit():
+            dt = dt.replace(microsecond=int(digits.ljust(6, '0')))
+    if offset and len(offset) >= 6 and offset[0] in '+-' and offset[3] == ':':
+        try:
+            minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+        except ValueError:
+            minutes = None
+        if minutes is not None:
+            if offset[0] == '-':
+                minutes = -minutes
+            dt = dt.replace(tzinfo=FixedOffset(minutes))
+    return dt
+
+# return the first valid datetime out of the datetime tags named in
+# `names` (in that order) from a tags dictionary returned by process_file
+# or process_datetime, or None if none of them is valid
+def get_datetime(tags, names=('DateTimeOriginal', 'DateTimeDigitized', 'DateTime')):
+    for name in names:
+        for ifd_name in ('EXIF', 'Image', 'PNG', 'Movie'):
+            tag = tags.get(ifd_name + ' ' + name)
+            if tag is None or tag.field_type != 2:
+                continue
+            subsec, offset = None, None
+            extra = DATETIME_EXTRA_TAGS.get(name)
+            if extra:
+                if 'EXIF ' + extra[0] in tags:
+                    subsec = tags['EXIF ' + extra[0]].values
+                if 'EXIF ' + extra[1] in tags:
+                    offset = tags['EXIF ' + extra[1]].values
+            dt = decode_datetime(tag.values, subsec, offset)
+            if dt:
+                return dt
+    return None
+
+# read only the datetime tags from IFD0 and the EXIF SubIFD without
+# processing the rest of the file (expects an open file object)
+# at most the first `limit` bytes are looked at, or the whole EXIF
+# segment of a JPEG if that is longer
+# returns a tags dictionary like process_file does, {} if the file has no
+# EXIF information, or None if the tags could not be reached this way and
+# process_file should be used instead
+# with use_mmap the whole file is mapped instead of reading a prefix
+def process_datetime(f, limit=65536, use_mmap=False):
+    mapped = None
+    if use_mmap:
+        mapped = map_file(f)
+    try:
+        return find_datetime(f, limit, mapped)
+    finally:
+        if mapped is not None:
+            mapped.close()
+
+# the work of process_datetime on either a mapped file or a prefix read from f
+def find_datetime(f, limit, mapped):
+    if mapped is not None:
+        data = mapped
+    else:
+        data = f.read(limit)
+
+    if data[0:8] == PNG_SIGNATURE or data[4:8] in ISOBMFF_TYPES:
+        # walking PNG chunks or ISO base media boxes only reads their headers
+        # anyway
+        return None
+    elif data[0:4] in ('II*\x00', 'MM\x00*'):
+        base = 0
+    elif data[0:2] == '\xFF\xD8':
+        # walk the JPEG segments up to the EXIF segment
+        pos = 2
+        base = None
+        while pos + 10 <= len(data) and data[pos] == '\xFF':
+            marker = data[pos+1]
+            length = ord(data[pos+2])*256+ord(data[pos+3])
+            if marker == '\xE1' and data[pos+4:pos+10] == 'Exif\x00\x00':
+                base = pos + 10
+                # make sure the whole segment is in the buffer
+                end = pos + 2 + length
+                if end > len(data) and mapped is None:
+                    data += f.read(end - len(data))
+                break
+            if marker in ('\xDA', '\xD9'):
+                # image data starts without an EXIF segment
+                return {}
+            pos += 2 + length
+        if base is None:
+            return None
+    else:
+        # file format not recognized
+        return {}
+
+    if data[base:base+1] == 'I':
+        endian = '<'
+    else:
+        endian = '>'
+
+    # unpack a value at an offset relative to the TIFF header, refusing
+    # to look past the buffer
+    def unpack(fmt, offset):
+        start = base + offset
+        end = start + struct.calcsize(endian + fmt)
+        if offset < 0 or end > len(data):
+            raise IndexError('offset %d outside of buffer' % offset)
+        return struct.unpack(endian + fmt, data[start:end])[0]
+
+    tags = {}
+    try:
+        ifds = [('Image', unpack('L', 4))]
+        while ifds:
+            ifd_name, ifd = ifds.pop(0)
+            for i in range(unpack('H', ifd)):
+                entry = ifd + 2 + 12 * i
+                tag = unpack('H', entry)
+                if ifd_name == 'Image' and tag == 0x8769:
+                    ifds.append(('EXIF', unpack('L', entry + 8)))
+                elif tag in DATETIME_TAGS[ifd_name] and unpack('H', entry + 2) == 2:
+                    count = unpack('L', entry + 4)
+                    if count > 4:
+                        offset = unpack('L', entry + 8)
+                    else:
+                        offset = entry + 8
+                    if base + offset + count > len(data):
+                        raise IndexError('value of tag 0x%04X outside of buffer' % tag)
+                    values = data[base+offset:base+offset+count].split('\x00', 1)[0]
+                    tags[ifd_name + ' ' + EXIF_TAGS[tag][0]] = IFD_Tag(values, tag, 2,
+                                                                       values, offset,
+                                                                       count)
+    except (IndexError, struct.error):
+        return None
+
+    return tags
+
+# process one file for process_files, returns (path, tags, error) where
+# tags is a plain dict with any MakerNote decoded and thumbnails left out,
+# so it can be sent back from a worker process
+def process_path(args):
+    path, kwargs = args
+    try:
+        f = open(path, 'rb')
+        try:
+            tags = process_file(f, **kwargs)
+            if isinstance(tags, ExifTags) and kwargs.get('details', True):
+                tags.decode_maker_note()
+            tags = dict([(k, v) for k, v in tags.items()
+                         if k not in ('JPEGThumbnail', 'TIFFThumbnail')])
+        finally:
+            f.close()
+    except Exception as e:
+        return path, None, '%s: %s' % (e.__class__.__name__, e)
+    return path, tags, None
+
+# process many files, yielding (path, tags, error) for each as it is done;
+# error is None or a description of what went wrong with that file
+# with workers > 1 files are spread over that many processes and results
+# come back in the order they complete, not the order of paths
+# any other keyword arguments are passed on to process_file
+def process_files(paths, workers=1, **kwargs):
+    args = ((path, kwargs) for path in paths)
+    if workers <= 1:
+        for result in itertools.imap(process_path, args):
+            yield result
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(process_path, args, 16):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# paths named on the command line: files, directories (walked) and '-'
+# for a list of paths on stdin, one per line
+def iter_paths(args):
+    for arg in args:
+        if arg == '-':
+            for line in sys.stdin:
+                line = line.rstrip('\r\n')
+                if line:
+                    yield line
+        elif os.path.isdir(arg):
+            for root, dirs, filenames in os.walk(arg):
+                dirs.sort()
+                for filename in sorted(filenames):
+                    yield os.path.join(root, filename)
+        else:
+            yield arg
+
+# write process_files results as JSON lines, tags by their printable values
+# returns the number of files and of errors
+def dump_json(results, out):
+    import json
+    files = errors = 0
+    for path, tags, error in results:
+        files += 1
+        if error:
+            errors += 1
+        else:
+            tags = dict([(k, str(v).decode('utf-8', 'replace')) for k, v in tags.items()])
+        out.write(json.dumps({'path': path.decode('utf-8', 'replace'),
+                              'tags': tags, 'error': error}, sort_keys=True))
+        out.write('\n')
+    return files, errors
+
+# columns of a TagTable: one value per file, stored compactly
+
+NAN = float('nan')
+
+# numbers in a typed array, NaN where a file has no value
+class NumberColumn:
+    kind = 'number'
+
+    def __init__(self, rows=0):
+        self.values = array.array('d', [NAN]) * rows
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, value):
+        if value is None:
+            value = NAN
+        self.values.append(value)
+
+    def get(self, i):
+        value = self.values[i]
+        if value != value:
+            return None
+        return value
+
+    def format(self, i):
+        value = self.get(i)
+        if value is None:
+            return ''
+        if value == int(value):
+            return '%d' % value
+        return repr(value)
+
+# datetimes as seconds since 1970-01-01 in the camera's local time
+class DateTimeColumn(NumberColumn):
+    kind = 'datetime'
+
+    def format(self, i):
+        value = self.get(i)
+        if value is None:
+            return ''
+        dt = datetime(1970, 1, 1) + timedelta(seconds=value)
+        return '%04d:%02d:%02d %02d:%02d:%02d' % (dt.year, dt.month, dt.day,
+                                                dt.hour, dt.minute, dt.second)
+
+# dictionary encoded strings: each distinct string is kept once and rows
+# hold its index, -1 where a file has no value
+class StringColumn:
+    kind = 'string'
+
+    def __init__(self, rows=0):
+        self.codes = array.array('i', [-1]) * rows
+        self.strings = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, value):
+        if value is None:
+            self.codes.append(-1)
+            return
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.strings)
+            self.strings.append(value)
+        self.codes.append(code)
+
+    def get(self, i):
+        code = self.codes[i]
+        if code < 0:
+            return None
+        return self.strings[code]
+
+    def format(self, i):
+        return self.get(i) or ''
+
+# IFDs a short tag name ('Make') is looked up in, in this order
+TABLE_IFDS = ('EXIF', 'Image', 'GPS', 'PNG', 'Movie', 'MakerNote')
+
+# tags holding datetimes; SubSecTime, OffsetTime and the like only go with
+# one and are kept as strings
+TABLE_DATETIME_TAGS = ('DateTime', 'DateTimeOriginal', 'DateTimeDigitized',
+                       'GPSDate', 'CreationTime', 'ModifyTime')
+
+# selected tags of many files, one column per tag, for audits of large
+# archives: a few bytes per value instead of an IFD_Tag per tag and file
+# names are full tag names ('Image Make') or short ones ('Make') looked
+# up in TABLE_IFDS; tags holding a single number become number columns,
+# datetimes datetime columns and everything else dictionary encoded
+# strings, decided by the first value seen
+class TagTable:
+    def __init__(self, names):
+        self.names = list(names)
+        self.columns = [None] * len(self.names)
+        # paths as one run of bytes with the offset each one ends at
+        self.path_data = bytearray()
+        self.path_ends = array.array('L')
+
+    def __len__(self):
+        return len(self.path_ends)
+
+    def path(self, i):
+        start = i and self.path_ends[i-1]
+        return str(self.path_data[start:self.path_ends[i]])
+
+    def lookup(self, tags, name):
+        if name in tags or ' ' in name:
+            return tags.get(name)
+        for ifd in TABLE_IFDS:
+            tag = tags.get(ifd + ' ' + name)
+            if tag is not None:
+                return tag
+        return None
+
+    # the kind of column and value for a tag
+    def cell(self, name, tag):
+        if tag is None:
+            return None, None
+        values = getattr(tag, 'values', None)
+        short = name.split()[-1]
+        if short in TABLE_DATETIME_TAGS and isinstance(values, str):
+            if short == 'GPSDate':
+                # a date alone, as of midnight
+                values = values[:10] + ' 00:00:00'
+            # blank or zeroed dates count as missing
+            dt = decode_datetime(values)
+            if dt is None:
+                return DateTimeColumn, None
+            return DateTimeColumn, calendar.timegm(dt.timetuple()) + \
+                                   dt.microsecond / 1e6
+        if isinstance(values, list) and len(values) == 1:
+            value = values[0]
+            if isinstance(value, Ratio):
+                if value.den:
+                    return NumberColumn, float(value.num) / value.den
+            elif isinstance(value, (int, long)) and str(tag) == str(value):
+                # enumerations are kept by their printable value
+                return NumberColumn, value
+        return StringColumn, str(tag)
+
+    def append(self, path, tags):
+        for i, name in enumerate(self.names):
+            kind, value = self.cell(name, self.lookup(tags, name))
+            column = self.columns[i]
+            if column is None and kind is not None:
+                column = self.columns[i] = kind(len(self))
+            elif column is not None and kind is not None and \
+                 column.kind != kind.kind:
+                # numbers that turn out not to be numbers in some files
+                if kind is not StringColumn:
+                    value = str(self.lookup(tags, name))
+                if not isinstance(column, StringColumn):
+                    strings = StringColumn()
+                    for row in range(len(column)):
+                        strings.append(column.format(row) or None)
+                    column = self.columns[i] = strings
+            if column is not None:
+                column.append(value)
+        self.path_data.extend(path)
+        self.path_ends.append(len(self.path_data))
+
+    # column for name, or None when no file had the tag
+    def column(self, name):
+        return self.columns[self.names.index(name)]
+
+    # one line per column: how many files have it, distinct values or range
+    def summary(self):
+        lines = []
+        for name, column in zip(self.names, self.columns):
+            if column is None:
+                lines.append('%s: 0 of %d' % (name, len(self)))
+                continue
+            rows = [i for i in range(len(column)) if column.get(i) is not None]
+            line = '%s: %d of %d' % (name, len(rows), len(self))
+            if isinstance(column, StringColumn):
+                line += ', %d distinct' % len(column.strings)
+            elif rows:
+                low = min(rows, key=column.get)
+                high = max(rows, key=column.get)
+                line += ', %s to %s' % (column.format(low), column.format(high))
+            lines.append(line)
+        return lines
+
+    def write_csv(self, f):
+        import csv
+        writer = csv.writer(f)
+        writer.writerow(['path'] + self.names)
+        for i in range(len(self)):
+            row = [self.path(i)]
+            for column in self.columns:
+                row.append(column.format(i) if column is not None else '')
+            writer.writerow(row)
+
+    # numpy .npz with 'path', numbers and datetimes as float64 (NaN if
+    # missing) and strings as an int32 '<name>' array of codes into a
+    # '<name>.strings' array; needs numpy
+    def save_npz(self, filename):
+        import numpy
+        arrays = {'path': numpy.array([self.path(i) for i in range(len(self))], dtype='S')}
+        for name, column in zip(self.names, self.columns):
+            if column is None:
+                arrays[name] = numpy.empty(len(self))
+                arrays[name].fill(NAN)
+            elif isinstance(column, StringColumn):
+                arrays[name] = numpy.frombuffer(column.codes, dtype=numpy.intc).copy()
+                arrays[name + '.strings'] = numpy.array(column.strings, dtype='S')
+            else:
+                arrays[name] = numpy.frombuffer(column.values, dtype=numpy.float64).copy()
+        numpy.savez(filename, **arrays)
+
 # show command line usage
 def usage(exit_status):
     msg = 'Usage: EXIF.py [OPTIONS] file1 [file2 ...]\n'
@@ -1706,6 +2022,14 @@ def usage(exit_status):
     msg += '-t TAG --stop-tag TAG   Stop processing when this tag is retrieved.\n'
     msg += '-s --strict   Run in strict mode (stop on errors).\n'
     msg += '-d --debug   Run in debug mode (display extra info).\n'
+    msg += '-j --json   Print a JSON object per file, one per line; directories\n'
+    msg += '            are walked and - reads paths from stdin.\n'
+    msg += '-w N --workers N   Process files in N processes (with --json or --columns).\n'
+    msg += '-c TAGS --columns TAGS   Collect the comma separated TAGS of all files\n'
+    msg += '            into a table, written as CSV; directories are walked\n'
+    msg += '            and - reads paths from stdin.\n'
+    msg += '-o FILE --output FILE   Write the --columns table to FILE, .csv or\n'
+    msg += '            .npz (needs numpy), instead of stdout.\n'
     print msg
     sys.exit(exit_status)
 
@@ -1716,7 +2040,9 @@ if __name__ == '__main__':
 
     # parse command line options/arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hqsdt:v", ["help", "quick", "strict", "debug", "stop-tag="])
+        opts, args = getopt.getopt(sys.argv[1:], "hqsdt:vjw:c:o:", ["help", "quick", "strict", "debug", "stop-tag=",
+                                                                 "json", "workers=", "columns=",
+                                                                 "output="])
     except getopt.GetoptError:
         usage(2)
     if args == []:
@@ -1725,6 +2051,10 @@ if __name__ == '__main__':
     stop_tag = 'UNDEF'
     debug = False
     strict = False
+    json_lines = False
+    workers = 1
+    columns = None
+    output = None
     for o, a in opts:
         if o in ("-h", "--help"):
             usage(0)
@@ -1736,6 +2066,54 @@ if __name__ == '__main__':
             strict = True
         if o in ("-d", "--debug"):
             debug = True
+        if o in ("-j", "--json"):
+            json_lines = True
+        if o in ("-w", "--workers"):
+            try:
+                workers = int(a)
+            except ValueError:
+                usage(2)
+        if o in ("-c", "--columns"):
+            columns = [name.strip() for name in a.split(',') if name.strip()]
+        if o in ("-o", "--output"):
+            output = a
+
+    # table mode: selected tags of all files as columns, summary on stderr
+    if columns:
+        start = time.time()
+        table = TagTable(columns)
+        errors = 0
+        for path, tags, error in process_files(iter_paths(args), workers, stop_tag=stop_tag,
+                                               details=detailed, strict=strict):
+            if error:
+                errors += 1
+                sys.stderr.write('%s: %s\n' % (path, error))
+                tags = {}
+            table.append(path, tags)
+        if output and output.endswith('.npz'):
+            table.save_npz(output)
+        elif output:
+            out = open(output, 'wb')
+            table.write_csv(out)
+            out.close()
+        else:
+            table.write_csv(sys.stdout)
+        elapsed = time.time() - start
+        for line in table.summary():
+            sys.stderr.write(line + '\n')
+        sys.stderr.write('%d files (%d errors) in %.2f s\n' % (len(table), errors, elapsed))
+        sys.exit(0)
+
+    # bulk mode: JSON lines on stdout, throughput on stderr
+    if json_lines:
+        start = time.time()
+        results = process_files(iter_paths(args), workers, stop_tag=stop_tag,
+                                details=detailed, strict=strict)
+        files, errors = dump_json(results, sys.stdout)
+        elapsed = time.time() - start
+        sys.stderr.write('%d files (%d errors) in %.2f s, %.1f files/s with %d workers\n'
+                         % (files, errors, elapsed, files / max(elapsed, 1e-6), workers))
+        sys.exit(0)
 
     # output info for each file
     for filename in args:
@@ -1750,6 +2128,8 @@ if __name__ == '__main__':
         if not data:
             print 'No EXIF information found'
             continue
+        if isinstance(data, ExifTags):
+            data.decode_maker_note()
 
         x=data.keys()
         x.sort()
@@ -0,0 +1,2 @@
+# MakerNote tag tables, one module per camera vendor. EXIF.py imports a
+# vendor's module the first time one of its MakerNotes is decoded.
@@ -5,10 +5,42 @@
 
 import EXIF
 
+import errno
+import hashlib
+import hmac
+import httplib
+import itertools
 import os
+import posixpath
+import re
 import shutil
+import signal
+import socket
+import struct
+import tarfile
+import threading
+import time
+import urlparse
 from datetime import datetime
+from string import Formatter
+from urllib import quote
 import ConfigParser
+import zipfile
+import zlib
+
+# tag names EXIF.process_file can produce without decoding MakerNotes
+STANDARD_TAGS = set(t[0] for d in (EXIF.EXIF_TAGS, EXIF.INTR_TAGS, EXIF.GPS_TAGS) for t in d.values())
+
+# tags every photo in a catalog is parsed for, besides those of its section's template
+CATALOG_TAGS = ('Make', 'Model')
+
+def saveas_tags(saveas):
+    # field names referenced by a saveas format string, e.g. '{Year}/{Name}' -> set(['Year', 'Name'])
+    tags = set()
+    for _, name, _, _ in Formatter().parse(saveas):
+        if name:
+            tags.add(name.split('.')[0].split('[')[0])
+    return tags
 
 class PixifLogger(object):
     def __init__(self, section, filename_out):
@@ -21,7 +53,7 @@ class PixifLogger(object):
             datetime.today().isoformat(),
             self.section,
             text,
-            image.filename,
+            getattr(image, 'filename', image),
             dst
         ]))
 
@@ -44,35 +76,1648 @@ class PixifLogger(object):
         except IOError:
             pass
 
+def temp_filename(dst):
+    # hidden sibling of dst that an atomic transfer writes to before renaming into place
+    head, tail = os.path.split(dst)
+    return os.path.join(head, '.{0}.pixif-tmp'.format(tail))
+
+def fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        # directories can't be synced on every platform
+        pass
+    finally:
+        os.close(fd)
+
+# FS_IOC_FIEMAP ioctl request and the sizes of struct fiemap and one struct fiemap_extent (Linux)
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_SIZE = 32
+FIEMAP_EXTENT_SIZE = 56
+
+def physical_offset(path):
+    # physical byte offset of a file's first extent, or None where FIEMAP isn't available
+    try:
+        import fcntl
+    except ImportError:
+        return None
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        # map the whole file but ask for a single extent
+        request = struct.pack('=QQLLLL', 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + '\x00' * FIEMAP_EXTENT_SIZE
+        result = fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except (IOError, OSError):
+        return None
+    finally:
+        os.close(fd)
+
+    mapped = struct.unpack_from('=L', result, 20)[0]
+    if not mapped:
+        # empty or inline file
+        return None
+
+    return struct.unpack_from('=Q', result, FIEMAP_SIZE + 8)[0]
+
+def load_fadvise():
+    # os.posix_fadvise where available, else the C library's own, else None
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise:
+        return fadvise
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'posix_fadvise64', None) or libc.posix_fadvise
+        func.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    except (ImportError, OSError, AttributeError, TypeError):
+        return None
+
+    def fadvise(fd, offset, length, advice):
+        error = func(fd, offset, length, advice)
+        if error:
+            raise OSError(error, os.strerror(error))
+
+    return fadvise
+
+fadvise = load_fadvise()
+
+class PixifAdvisor(object):
+    # Page cache hints for scanning and copying with counters of what was advised.
+    # Header reads are prefetched with WILLNEED, copies read SEQUENTIAL and both source and
+    # destination are dropped from the cache with DONTNEED once a transfer commits.
+    SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+    WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+    DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+    NAMES = {SEQUENTIAL: 'sequential', WILLNEED: 'willneed', DONTNEED: 'dontneed'}
+
+    def __init__(self):
+        self.counts = dict((name, 0) for name in self.NAMES.values())
+        self.bytes = dict((name, 0) for name in self.NAMES.values())
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def advise(self, fd, offset, length, advice):
+        if not fadvise:
+            return
+
+        name = self.NAMES[advice]
+
+        try:
+            fadvise(fd, offset, length, advice)
+        except OSError:
+            self.errors += 1
+            return
+
+        # 0 means through the end of the file; count only bytes the file actually has
+        remaining = max(os.fstat(fd).st_size - offset, 0)
+        length = min(length, remaining) if length else remaining
+
+        with self.lock:
+            self.counts[name] += 1
+            self.bytes[name] += length
+
+    def drop(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            self.advise(fd, 0, 0, self.DONTNEED)
+        finally:
+            os.close(fd)
+
+    def summary(self):
+        return ' '.join('{0}={1} ({2} bytes)'.format(name, self.counts[name], self.bytes[name])
+                        for name in sorted(self.counts)) + ' errors={0}'.format(self.errors)
+
+def copy_file(src, dst, advisor=None, throttle=None, header=None):
+    # shutil.copy2 reading the source in chunks so it can be advised and throttled.
+    # With the PixifHeader kept from parsing, only the bytes after it are read again.
+    chunk = 64 * 1024 if throttle else 1024 * 1024
+
+    with open(src, 'rb') as fsrc:
+        prefix = header.prefix(fsrc) if header else ''
+
+        if advisor:
+            advisor.advise(fsrc.fileno(), len(prefix), 0, advisor.SEQUENTIAL)
+
+        with open(dst, 'wb') as fdst:
+            if prefix:
+                if throttle:
+                    throttle.take_bytes(len(prefix))
+
+                fdst.write(prefix)
+
+            while True:
+                buf = fsrc.read(chunk)
+                if not buf:
+                    break
+
+                if throttle:
+                    throttle.take_bytes(len(buf))
+
+                fdst.write(buf)
+
+    shutil.copystat(src, dst)
+
+class PixifHeader(object):
+    # File wrapper handed to the EXIF parser that keeps every byte from the start of the file up to `limit` in memory.
+    # Reads ahead sequentially, so seeking forward to an IFD reads the bytes skipped over too: a copy needs them anyway.
+    # What lies beyond the limit is read straight from the file and not kept.
+    # f may also be a stream of `size` bytes, such as an archive member, which can only be skipped forward.
+    CHUNK = 64 * 1024
+
+    def __init__(self, f, limit, size=None):
+        self.f = f
+        self.limit = limit
+        self.data = ''
+        self.pos = 0
+        # position of f itself
+        self.at = 0
+
+        if size is None:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            self.signature = (st.st_size, st.st_mtime)
+        else:
+            self.signature = None
+
+        self.size = size
+
+        # zip members have a seek() that only raises
+        seekable = getattr(f, 'seekable', None)
+        self.seekable = seekable() if seekable else hasattr(f, 'seek')
+
+    def goto(self, offset):
+        # move f to offset, or return False when a stream would have to go back
+        if offset == self.at:
+            return True
+
+        if self.seekable:
+            self.f.seek(offset)
+            self.at = offset
+            return True
+
+        while self.at < offset:
+            skipped = len(self.f.read(min(offset - self.at, self.CHUNK)))
+            if not skipped:
+                break
+            self.at += skipped
+
+        return self.at == offset
+
+    def take(self, length):
+        data = self.f.read(length)
+        self.at += len(data)
+        return data
+
+    def fill(self, end):
+        end = min(end, self.limit, self.size)
+        if end > len(self.data):
+            want = min(max(end - len(self.data), self.CHUNK), self.limit - len(self.data))
+            if self.goto(len(self.data)):
+                self.data += self.take(want)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(self.size - self.pos, 0)
+
+        end = self.pos + size
+        self.fill(end)
+
+        kept = len(self.data)
+        if end <= kept:
+            chunk = self.data[self.pos:end]
+        else:
+            chunk = self.data[self.pos:kept]
+            if self.goto(max(self.pos, kept)):
+                chunk += self.take(end - max(self.pos, kept))
+
+        self.pos += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        return self.pos
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        # the parse is done; drop the file but keep what was read
+        self.f = None
+
+    def prefix(self, f):
+        # the kept bytes when f is still the file they were read from, positioning f after them
+        st = os.fstat(f.fileno())
+        if (st.st_size, st.st_mtime) != self.signature:
+            return ''
+
+        f.seek(len(self.data))
+        return self.data
+
+# archives a src may name instead of a folder
+ARCHIVE_FILE_EXT = ('.zip', '.tar', '.tgz', '.tar.gz', '.tbz2', '.tar.bz2')
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_FILE_EXT) and os.path.isfile(path)
+
+def split_archive(path):
+    # (archive, member) when path names a member inside an archive, else None
+    head, member = os.path.split(path)
+
+    while head and head != os.path.dirname(head):
+        if is_archive(head):
+            return head, member
+
+        head, tail = os.path.split(head)
+        member = tail + '/' + member
+
+    return None
+
+class PixifArchive(object):
+    # Zip or tar archive read as a source without extracting it. Members are opened as streams, one at a time.
+    # Zip members can be read in any order; a compressed tar is only read forward, so its members are listed,
+    # parsed and transferred in the order they're stored.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.info = {}
+
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            self.tar = None
+        else:
+            self.zip = None
+            self.tar = tarfile.open(path, 'r:*')
+
+    def members(self):
+        # (name, size) of each file in the archive, in stored order
+        if self.zip:
+            files = ((info, info.filename, info.file_size) for info in self.zip.infolist() if not info.filename.endswith('/'))
+        else:
+            files = ((info, info.name, info.size) for info in self.tar if info.isfile())
+
+        for info, name, size in files:
+            if isinstance(name, unicode):
+                # zip names flagged as UTF-8; paths are byte strings everywhere else
+                name = name.encode('utf-8')
+
+            # tar members are often stored as ./name
+            name = posixpath.normpath(name)
+
+            self.info[name] = info
+            yield name, size
+
+    def mtime(self, name):
+        info = self.info[name]
+        if self.zip:
+            return time.mktime(info.date_time + (0, 0, -1))
+        return info.mtime
+
+    def size(self, name):
+        info = self.info[name]
+        return info.file_size if self.zip else info.size
+
+    def extract(self, name, consume):
+        # consume(stream, size) with the member open
+        with self.lock:
+            if self.zip:
+                stream = self.zip.open(self.info[name])
+            else:
+                stream = self.tar.extractfile(self.info[name])
+
+            try:
+                return consume(stream, self.size(name))
+            finally:
+                stream.close()
+
+    def copy(self, name, dst, throttle=None):
+        # write a member to dst with its modification time, like shutil.copy2
+        def write(stream, size):
+            with open(dst, 'wb') as f:
+                while True:
+                    buf = stream.read(1024 * 1024)
+                    if not buf:
+                        break
+
+                    if throttle:
+                        throttle.take_bytes(len(buf))
+
+                    f.write(buf)
+
+        self.extract(name, write)
+        os.utime(dst, (time.time(), self.mtime(name)))
+
+def parse_size(value):
+    # '512', '64K', '10M' or '1G' as a number; empty means 0 (unlimited)
+    value = str(value or '').strip().upper()
+    if not value:
+        return 0
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+
+    return float(value)
+
+class PixifBucket(object):
+    # Token bucket refilled at `rate` tokens per second holding up to `burst` seconds worth.
+    # Taking more than is available leaves the bucket in debt, which delay() says how long to wait out.
+    # A rate of 0 is unlimited.
+    def __init__(self, rate=0, burst=1.0, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = self.capacity()
+        self.last = self.clock()
+
+    def capacity(self):
+        return max(self.rate * self.burst, 1)
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity(), self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def set_rate(self, rate, burst=None):
+        self.refill()
+        self.rate = rate
+        if burst is not None:
+            self.burst = burst
+        self.tokens = min(self.tokens, self.capacity())
+
+    def take(self, amount):
+        if not self.rate:
+            return
+
+        self.refill()
+        self.tokens -= amount
+
+    def delay(self):
+        if not self.rate:
+            return 0
+
+        self.refill()
+        return max(-self.tokens / self.rate, 0)
+
+class PixifThrottle(object):
+    # Bytes/s and files/s limits for transfers. A section's throttle has the global one as its parent
+    # and every transfer has to fit through both.
+    def __init__(self, bps=0, fps=0, burst=1.0, parent=None, control=None):
+        self.bytes = PixifBucket(bps, burst)
+        self.files = PixifBucket(fps, burst)
+        self.parent = parent
+        self.control = control
+        # concurrent transfers queue up here one at a time while the buckets are in debt
+        self.lock = threading.Lock()
+
+    def chain(self):
+        throttle = self
+        while throttle:
+            yield throttle
+            throttle = throttle.parent
+
+    def is_active(self):
+        # with a control file, limits may be switched on while running
+        return any(t.control or t.bytes.rate or t.files.rate for t in self.chain())
+
+    def set_limits(self, bps, fps, burst=None):
+        self.bytes.set_rate(bps, burst)
+        self.files.set_rate(fps, burst)
+
+    def take_bytes(self, amount):
+        with self.lock:
+            for throttle in self.chain():
+                throttle.bytes.take(amount)
+            self.wait()
+
+    def take_file(self):
+        with self.lock:
+            for throttle in self.chain():
+                throttle.files.take(1)
+            self.wait()
+
+    def wait(self):
+        while True:
+            for throttle in self.chain():
+                if throttle.control:
+                    throttle.control.poll()
+
+            delay = max([max(t.bytes.delay(), t.files.delay()) for t in self.chain()])
+            if delay <= 0:
+                return
+
+            # sleep in short steps so new limits take effect promptly
+            time.sleep(min(delay, 0.5))
+
+class PixifControl(object):
+    # Reloads throttle limits from a config file while running, when the file changes or on request
+    # (SIGUSR1). Limits are read from the [pixif] section for the global throttle and from each section.
+    POLL_INTERVAL = 1.0
+
+    requested = False
+
+    def __init__(self, filename, throttles):
+        self.filename = filename
+        self.throttles = throttles
+        self.checked = time.time()
+        self.mtime = self.get_mtime()
+
+    @classmethod
+    def request(cls, *args):
+        cls.requested = True
+
+    def get_mtime(self):
+        try:
+            return os.path.getmtime(self.filename)
+        except OSError:
+            return None
+
+    def poll(self):
+        now = time.time()
+
+        if not PixifControl.requested and now - self.checked < self.POLL_INTERVAL:
+            return
+
+        self.checked = now
+        mtime = self.get_mtime()
+
+        if PixifControl.requested or mtime != self.mtime:
+            PixifControl.requested = False
+            self.mtime = mtime
+            self.reload()
+
+    def reload(self):
+        config = ConfigParser.RawConfigParser()
+        config.read(self.filename)
+
+        for name, throttle in self.throttles.iteritems():
+            if not config.has_section(name):
+                continue
+
+            limits = dict(config.items(name))
+            throttle.set_limits(parse_size(limits.get('bps')), parse_size(limits.get('fps')),
+                                float(limits['burst']) if limits.get('burst') else None)
+
+class PixifMounts(object):
+    # Runs blocking file operations on a pool of threads with at most `limit` of them in flight on each mount,
+    # so a high-latency network mount has many round trips outstanding at once instead of waiting on each in turn.
+    # Results come back in the order of the items. A limit of 1 runs everything in order on the calling thread.
+    def __init__(self, limit=1):
+        self.limit = max(int(limit or 1), 1)
+        self.points = {}
+        self.semaphores = {}
+
+    def mount(self, path):
+        # mount point of the directory holding path, which needn't exist yet; the bucket of object storage
+        if '://' in path:
+            scheme, rest = path.split('://', 1)
+            return '{0}://{1}'.format(scheme, rest.split('/', 1)[0])
+
+        head = os.path.dirname(os.path.abspath(path))
+
+        if head not in self.points:
+            point = head
+            while not os.path.ismount(point) and os.path.dirname(point) != point:
+                point = os.path.dirname(point)
+            self.points[head] = point
+
+        return self.points[head]
+
+    def map(self, func, items, paths):
+        # func(item) for each item; paths(item) names the files a call touches, each of whose mounts it holds a slot on
+        if self.limit == 1:
+            for item in items:
+                yield func(item)
+            return
+
+        from multiprocessing.pool import ThreadPool
+
+        # slots are always taken in the same order so two calls can't each hold one the other waits for
+        keyed = [(item, sorted(set(self.mount(path) for path in paths(item)))) for item in items]
+        mounts = set(mount for item, held in keyed for mount in held)
+
+        for mount in mounts:
+            self.semaphores.setdefault(mount, threading.BoundedSemaphore(self.limit))
+
+        def call(args):
+            item, held = args
+            for mount in held:
+                self.semaphores[mount].acquire()
+            try:
+                return func(item)
+            finally:
+                for mount in reversed(held):
+                    self.semaphores[mount].release()
+
+        pool = ThreadPool(self.limit * max(len(mounts), 1))
+
+        try:
+            for result in pool.imap(call, keyed):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+class PixifCommitter(object):
+    # Group commit for transfers: with files set, pending transfers are made durable together
+    # every `files` transfers or `ms` milliseconds. Each pending file is synced, renamed into place,
+    # and then each destination directory is synced once for the whole group.
+    # Without files set, transfers commit immediately and nothing is synced.
+    def __init__(self, files=0, ms=0, lock=None):
+        self.files = files
+        self.ms = ms
+        self.pending = []
+        self.pending_dst = set()
+        self.started = None
+        self.errors = []
+        # held while committing, as callbacks write to the caller's journal
+        self.lock = lock or threading.RLock()
+        self.timer = None
+
+    def is_pending(self, dst):
+        return dst in self.pending_dst
+
+    def add(self, tmp, dst, callback=None):
+        with self.lock:
+            self.pending.append((tmp, dst, callback))
+            self.pending_dst.add(dst)
+
+            if self.started is None:
+                self.started = time.time()
+
+                if self.ms and self.files:
+                    # a group that never fills up still commits once its time is up
+                    self.timer = threading.Timer(self.ms / 1000.0, self.expire, (self.started,))
+                    self.timer.daemon = True
+                    self.timer.start()
+
+            if len(self.pending) >= self.files or (self.ms and (time.time() - self.started) * 1000 >= self.ms):
+                self.flush()
+
+    def expire(self, started):
+        with self.lock:
+            # unless the group was committed meanwhile
+            if self.started == started:
+                self.commit()
+
+    def flush(self):
+        with self.lock:
+            self.commit()
+
+    def commit(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        pending, self.pending = self.pending, []
+        self.pending_dst = set()
+        self.started = None
+
+        if self.files:
+            for tmp, dst, callback in pending:
+                fsync_path(tmp or dst)
+
+        committed = []
+
+        for tmp, dst, callback in pending:
+            try:
+                if tmp:
+                    os.rename(tmp, dst)
+                committed.append((dst, callback))
+            except OSError as e:
+                self.errors.append((str(e), tmp, dst))
+
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+        if self.files:
+            for head in set(os.path.dirname(dst) for dst, callback in committed):
+                fsync_path(head or os.curdir)
+
+        for dst, callback in committed:
+            if callback:
+                try:
+                    callback()
+                except OSError as e:
+                    self.errors.append((str(e), dst, dst))
+
+class PixifStorage(object):
+    # Destination of a collection. This one is the local filesystem, which PixifCollection transfers to itself
+    # so journaling, atomic renames and group commits apply; other storages upload whole files with put().
+    local = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def join(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def getsize(self, path):
+        return os.path.getsize(path)
+
+    def listdir(self, head):
+        return os.listdir(head or os.curdir)
+
+    def makedirs(self, head):
+        try:
+            os.makedirs(head)
+        except OSError:
+            # destination root already exists
+            pass
+
+    def reserve(self, path):
+        # create path empty, or False if it already exists; workers sharing the tree can't take the name meanwhile
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+
+        return True
+
+    def remove(self, path):
+        os.remove(path)
+
+    def identical(self, src, dst, digest):
+        # digest(path) is the caller's cached content hash
+        if os.path.getsize(src) != os.path.getsize(dst):
+            return False
+
+        return digest(src) == digest(dst)
+
+class PixifConnections(object):
+    # Pool of persistent HTTP connections to one host. Connections are kept open between requests and
+    # a new one is made whenever every pooled connection is busy, so concurrent transfers never wait on each other.
+    def __init__(self, host, port=None, secure=False, timeout=60):
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        cls = httplib.HTTPSConnection if self.secure else httplib.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, url, body=None, headers=None):
+        # (status, headers, body) of the response; a connection the server dropped while idle is retried once
+        for attempt in (0, 1):
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+
+            fresh = conn is None
+            conn = conn or self.connect()
+
+            try:
+                conn.request(method, url, body, headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if fresh or attempt:
+                    raise
+                continue
+
+            if response.getheader('connection', '').lower() == 'close':
+                conn.close()
+            else:
+                with self.lock:
+                    self.idle.append(conn)
+
+            return response.status, dict(response.getheaders()), data
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for conn in idle:
+            conn.close()
+
+class PixifS3Storage(PixifStorage):
+    # S3 compatible object storage for dst=s3://bucket/prefix, signed with AWS Signature Version 4 using the
+    # AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variables. endpoint points at any compatible
+    # server (MinIO, Ceph, a local stand-in) and is addressed path-style. Files larger than partsize are sent as
+    # multipart uploads of PARALLEL_PARTS parts at a time. Existence checks are answered from one listing
+    # of each destination prefix, which uploads keep up to date.
+    local = False
+
+    PARALLEL_PARTS = 4
+
+    # smallest part size S3 accepts for all but the last part
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, root, endpoint='', region='', partsize=''):
+        self.root = root.rstrip('/')
+        self.bucket = root[len('s3://'):].split('/', 1)[0]
+        self.region = region or 'us-east-1'
+        self.partsize = max(int(parse_size(partsize or '8M')), self.MIN_PART_SIZE)
+        self.access_key = os.environ.get('AWS_ACCESS_KEY_ID', '')
+        self.secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+
+        url = urlparse.urlsplit(endpoint or 'https://s3.{0}.amazonaws.com'.format(self.region))
+        self.host = url.netloc
+        self.connections = PixifConnections(url.hostname, url.port, url.scheme == 'https')
+
+        # prefix -> {name: (size, etag)}
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    def join(self, *parts):
+        return posixpath.join(self.root, *parts)
+
+    def key(self, path):
+        # object key of an s3://bucket/key path
+        return path[len('s3://') + len(self.bucket) + 1:]
+
+    def sign(self, method, uri, query, headers, payload='UNSIGNED-PAYLOAD'):
+        now = time.gmtime()
+        stamp = time.strftime('%Y%m%dT%H%M%SZ', now)
+        scope = '{0}/{1}/s3/aws4_request'.format(stamp[:8], self.region)
+
+        headers = dict(headers, host=self.host)
+        headers['x-amz-date'] = stamp
+        headers['x-amz-content-sha256'] = payload
+
+        names = sorted(name.lower() for name in headers)
+        values = dict((name.lower(), str(value).strip()) for name, value in headers.iteritems())
+        canonical = '\n'.join([
+            method,
+            uri,
+            '&'.join('{0}={1}'.format(quote(k, '-_.~'), quote(v, '-_.~')) for k, v in sorted(query.iteritems())),
+            ''.join('{0}:{1}\n'.format(name, values[name]) for name in names),
+            ';'.join(names),
+            payload
+        ])
+        signing = '\n'.join(['AWS4-HMAC-SHA256', stamp, scope, hashlib.sha256(canonical).hexdigest()])
+
+        secret = 'AWS4' + self.secret_key
+        for part in (stamp[:8], self.region, 's3', 'aws4_request'):
+            secret = hmac.new(secret, part, hashlib.sha256).digest()
+
+        headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, Signature={3}'.format(
+            self.access_key, scope, ';'.join(names), hmac.new(secret, signing, hashlib.sha256).hexdigest())
+
+        return headers
+
+    def request(self, method, key='', query=None, body=None, headers=None, expect=(200,)):
+        query = query or {}
+        uri = quote('/{0}/{1}'.format(self.bucket, key) if key else '/{0}'.format(self.bucket), '/-_.~')
+        url = uri + ('?' + '&'.join('{0}={1}'.format(quote(k, '-_.~'), quote(v, '-_.~'))
+                                    for k, v in sorted(query.iteritems())) if query else '')
+
+        try:
+            status, headers, data = self.connections.request(method, url, body, self.sign(method, uri, query, headers or {}))
+        except (httplib.HTTPException, socket.error) as e:
+            raise OSError('{0} {1}: {2}'.format(method, url, e))
+
+        if status not in expect:
+            raise OSError('{0} {1}: {2} {3}'.format(method, url, status, self.error_code(data)))
+
+        return headers, data
+
+    @classmethod
+    def error_code(cls, data):
+        match = re.search(r'<Code>([^<]*)</Code>', data or '')
+        return match.group(1) if match else ''
+
+    @classmethod
+    def find(cls, element, name):
+        # children of element called name, whatever their namespace
+        return [child for child in element if child.tag.split('}')[-1] == name]
+
+    def listdir(self, head):
+        return list(self.entries(head))
+
+    def entries(self, head):
+        # {name: (size, etag)} of the objects directly under head, listed once
+        with self.lock:
+            if head in self.listings:
+                return self.listings[head]
+
+        from xml.etree import ElementTree
+
+        prefix = self.key(head + '/')
+        entries = {}
+        query = {'list-type': '2', 'prefix': prefix, 'delimiter': '/'}
+
+        while True:
+            headers, data = self.request('GET', query=query)
+            result = ElementTree.fromstring(data)
+
+            for contents in self.find(result, 'Contents'):
+                fields = dict((child.tag.split('}')[-1], child.text or '') for child in contents)
+                entries[fields['Key'][len(prefix):]] = (int(fields['Size']), fields.get('ETag', '').strip('"'))
+
+            token = [t.text for t in self.find(result, 'NextContinuationToken')]
+            if not token:
+                break
+            query['continuation-token'] = token[0]
+
+        with self.lock:
+            return self.listings.setdefault(head, entries)
+
+    def exists(self, path):
+        head, tail = posixpath.split(path)
+        return tail in self.entries(head)
+
+    def getsize(self, path):
+        head, tail = posixpath.split(path)
+        entry = self.entries(head).get(tail)
+        if entry is None:
+            raise OSError(errno.ENOENT, 'no such object', path)
+        return entry[0]
+
+    def makedirs(self, head):
+        # prefixes need no creating
+        pass
+
+    def reserve(self, path):
+        # there's no exclusive create, so this only checks the listing and the last upload to a name wins
+        return not self.exists(path)
+
+    def identical(self, src, dst, digest=None):
+        # compared against the listed size and ETag, so nothing is downloaded
+        head, tail = posixpath.split(dst)
+        size, etag = self.entries(head)[tail]
+
+        if os.path.getsize(src) != size:
+            return False
+
+        return self.etag(src, etag.count('-') and int(etag.split('-')[1])) == etag
+
+    def etag(self, path, parts=0):
+        # ETag S3 gives path uploaded whole (MD5 of the content) or in parts of partsize (MD5 of the part MD5s);
+        # an object uploaded with another part size won't match and is taken to differ
+        digests = []
+
+        with open(path, 'rb') as f:
+            for part in range(max(parts, 1)):
+                h = hashlib.md5()
+                remaining = self.partsize if parts else os.fstat(f.fileno()).st_size
+
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    remaining -= len(chunk)
+
+                digests.append(h)
+
+        if not parts:
+            return digests[0].hexdigest()
+
+        return '{0}-{1}'.format(hashlib.md5(''.join(h.digest() for h in digests)).hexdigest(), parts)
+
+    def put(self, src, dst, header=None, throttle=None):
+        # upload src to dst, reusing the bytes of a PixifHeader kept from parsing
+        with open(src, 'rb') as f:
+            prefix = header.prefix(f) if header else ''
+            self.put_stream(f, os.fstat(f.fileno()).st_size, dst, prefix, throttle)
+
+    def put_stream(self, f, size, dst, prefix='', throttle=None):
+        # upload prefix followed by the rest of the size bytes read from f, which is only read forward
+        key = self.key(dst)
+        rest = [prefix]
+
+        def read(length):
+            data, rest[0] = rest[0][:length], rest[0][length:]
+            if len(data) < length:
+                data += f.read(length - len(data))
+
+            if throttle:
+                throttle.take_bytes(len(data))
+
+            return data
+
+        if size <= self.partsize:
+            headers, body = self.request('PUT', key, body=read(size))
+            etag = headers.get('etag', '').strip('"')
+        else:
+            etag = self.put_parts(key, size, read)
+
+        self.listed(dst, size, etag)
+
+    def put_data(self, dst, data):
+        headers, body = self.request('PUT', self.key(dst), body=data)
+        self.listed(dst, len(data), headers.get('etag', '').strip('"'))
+
+    def put_parts(self, key, size, read):
+        # parts are read in order on this thread and uploaded PARALLEL_PARTS at a time, which also bounds
+        # how many are held in memory
+        from multiprocessing.pool import ThreadPool
+
+        headers, data = self.request('POST', key, {'uploads': ''})
+        upload = re.search(r'<UploadId>([^<]*)</UploadId>', data).group(1)
+        count = (size + self.partsize - 1) // self.partsize
+        slots = threading.BoundedSemaphore(self.PARALLEL_PARTS)
+
+        def part(number, data):
+            try:
+                headers, body = self.request('PUT', key, {'partNumber': str(number), 'uploadId': upload}, data)
+                return number, headers.get('etag', '')
+            finally:
+                slots.release()
+
+        pool = ThreadPool(min(self.PARALLEL_PARTS, count))
+        results = []
+
+        try:
+            for number in range(1, count + 1):
+                slots.acquire()
+                results.append(pool.apply_async(part, (number, read(min(self.partsize, size - (number - 1) * self.partsize)))))
+
+            etags = [result.get() for result in results]
+        except Exception:
+            # don't leave the uploaded parts behind to be billed
+            try:
+                self.request('DELETE', key, {'uploadId': upload}, expect=(200, 204))
+            except OSError:
+                pass
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+        body = '<CompleteMultipartUpload>{0}</CompleteMultipartUpload>'.format(''.join(
+            '<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>'.format(number, etag) for number, etag in etags))
+        headers, data = self.request('POST', key, {'uploadId': upload}, body)
+
+        if '<Error>' in data:
+            # completing can fail after the 200 status has been sent
+            raise OSError('POST {0}: {1}'.format(key, self.error_code(data)))
+
+        match = re.search(r'<ETag>([^<]*)</ETag>', data)
+        return match.group(1).replace('&quot;', '').strip('"') if match else ''
+
+    def listed(self, dst, size, etag):
+        # an upload joins the listing of its prefix, if that has been listed
+        head, tail = posixpath.split(dst)
+
+        with self.lock:
+            if head in self.listings:
+                self.listings[head][tail] = (size, etag)
+
+    def remove(self, dst):
+        self.request('DELETE', self.key(dst), expect=(200, 204))
+
+        head, tail = posixpath.split(dst)
+        with self.lock:
+            self.listings.get(head, {}).pop(tail, None)
+
+def open_storage(dst, endpoint='', region='', partsize=''):
+    # storage a dst path or URL is transferred to
+    if dst.startswith('s3://'):
+        return PixifS3Storage(dst, endpoint, region, partsize)
+
+    return PixifStorage(dst)
+
+class PixifCollisions(object):
+    # Picks the destination name when a file is already there:
+    #   skip: leave it and don't transfer
+    #   suffix: append -1, -2, ... before the extension
+    #   hash: skip files byte-identical to the existing one or one of its suffixed copies, suffix the rest
+    # Each destination directory is listed once; names handed out after that are tracked in memory,
+    # so a burst of photos with the same name costs no exists() probing. Concurrent transfers list and hash
+    # outside of lock and only hold it to pick and record a name.
+    POLICIES = ('skip', 'suffix', 'hash')
+
+    SUFFIX = re.compile(r'^(?P<stem>.*)-(?P<number>\d+)$')
+
+    def __init__(self, policy='skip', storage=None, lock=None):
+        self.policy = policy
+        self.storage = storage or PixifStorage(None)
+        self.lock = lock or threading.RLock()
+        self.dirs = {}
+        self.hashes = {}
+
+    def listing(self, head):
+        # names in head and the highest suffix of each stem and extension
+        with self.lock:
+            if head in self.dirs:
+                return self.dirs[head]
+
+        try:
+            names = set(self.storage.listdir(head))
+        except OSError:
+            names = set()
+
+        counters = {}
+
+        for name in names:
+            stem, ext = os.path.splitext(name)
+            match = self.SUFFIX.match(stem)
+            if match:
+                key = (match.group('stem'), ext)
+                counters[key] = max(counters.get(key, 0), int(match.group('number')))
+
+        # another transfer may have listed head meanwhile, and handed out names from its listing since
+        with self.lock:
+            return self.dirs.setdefault(head, (names, counters))
+
+    def resolve(self, src, dst):
+        # name to transfer src to, or None when an identical copy is already there
+        head, tail = os.path.split(dst)
+        names, counters = self.listing(head)
+        stem, ext = os.path.splitext(tail)
+        key = (stem, ext)
+        compared = set()
+
+        while True:
+            with self.lock:
+                if tail not in names:
+                    names.add(tail)
+                    return dst
+
+                copies = []
+                if self.policy == 'hash':
+                    copies = [name for name in [tail] + ['{0}-{1}{2}'.format(stem, n, ext)
+                                                         for n in range(1, counters.get(key, 0) + 1)]
+                              if name in names and name not in compared]
+
+                if not copies:
+                    number = counters.get(key, 0) + 1
+                    while '{0}-{1}{2}'.format(stem, number, ext) in names:
+                        number += 1
+
+                    counters[key] = number
+                    name = '{0}-{1}{2}'.format(stem, number, ext)
+                    names.add(name)
+
+                    return os.path.join(head, name)
+
+            # copies suffixed by other transfers while these were hashed are compared on the next pass
+            for name in copies:
+                if self.identical(src, os.path.join(head, name)):
+                    return None
+
+            compared.update(copies)
+
+    @classmethod
+    def is_copy(cls, dst, other):
+        # other is dst or one of its suffixed names
+        if other == dst:
+            return True
+
+        head, tail = os.path.split(dst)
+        other_head, other_tail = os.path.split(other)
+        stem, ext = os.path.splitext(tail)
+        other_stem, other_ext = os.path.splitext(other_tail)
+        match = cls.SUFFIX.match(other_stem)
+
+        return head == other_head and ext == other_ext and match is not None and match.group('stem') == stem
+
+    def identical(self, src, dst):
+        try:
+            return self.storage.identical(src, dst, self.digest)
+        except (IOError, OSError, KeyError):
+            # not there yet, e.g. still a temporary file waiting for its commit or an upload in flight
+            return False
+
+    def digest(self, path):
+        if path not in self.hashes:
+            h = hashlib.sha1()
+
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                    h.update(chunk)
+
+            self.hashes[path] = h.digest()
+
+        return self.hashes[path]
+
+class PixifJournal(object):
+    # Write-ahead journal of transfers so an interrupted run can be resumed.
+    # Each line is: state, method, src, dst. The last line for a (src, dst) pair is its current state.
+    PLANNED = 'planned'
+    COPYING = 'copying'
+    COMMITTED = 'committed'
+    REMOVED = 'removed'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.finished = set()
+        self.sources = {}
+        self.f = None
+
+    def read(self):
+        entries = {}
+
+        try:
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    # a torn last line from a crash mid-write is ignored
+                    if len(parts) != 4:
+                        continue
+
+                    state, method, src, dst = parts
+                    entries[(src, dst)] = (state, method)
+        except IOError:
+            pass
+
+        return entries
+
+    def recover(self, storages=(), partial=True):
+        # Roll incomplete transfers forward or back and remember which ones already finished.
+        # Destinations under the root of one of storages are checked there, any others on the local filesystem.
+        # With partial False, transfers that never committed are left alone.
+        # Returns a list of (text, src, dst) describing each action taken for logging.
+        actions = []
+        local = PixifStorage('')
+
+        for (src, dst), (state, method) in self.read().iteritems():
+            if state == self.COPYING and not partial:
+                continue
+
+            storage = ([s for s in storages if dst.startswith(s.root + '/')] or [local])[0]
+
+            try:
+                if state == self.COPYING and not storage.local:
+                    # an upload appears whole or not at all, so a listed one completed before the journal caught up
+                    if storage.exists(dst) and (split_archive(src) or not os.path.exists(src)
+                                                or os.path.getsize(src) == storage.getsize(dst)):
+                        if method == 'move' and os.path.exists(src):
+                            os.remove(src)
+                            actions.append(('(journal) removed source of committed move', src, dst))
+                        self.finish(src, dst)
+                elif state == self.COPYING:
+                    tmp = temp_filename(dst)
+                    if os.path.exists(tmp):
+                        # an atomic transfer never got renamed into place
+                        os.remove(tmp)
+                        actions.append(('(journal) removed temporary destination', src, tmp))
+
+                    if (os.path.exists(src) or split_archive(src)) and storage.exists(dst):
+                        # destination may be partial; roll back so it is transferred again
+                        os.remove(dst)
+                        actions.append(('(journal) removed partial destination', src, dst))
+                    elif storage.exists(dst):
+                        # a rename completed before the journal caught up
+                        self.finish(src, dst)
+                elif state == self.COMMITTED and method == 'move':
+                    if os.path.exists(src) and storage.exists(dst):
+                        os.remove(src)
+                        actions.append(('(journal) removed source of committed move', src, dst))
+                    self.finish(src, dst)
+                elif state in (self.COMMITTED, self.REMOVED):
+                    self.finish(src, dst)
+            except OSError as e:
+                actions.append((str(e), src, dst))
+
+        return actions
+
+    def finish(self, src, dst):
+        self.finished.add((src, dst))
+        self.sources.setdefault(src, []).append(dst)
+
+    def is_finished(self, src, dst, suffixed=False):
+        # with suffixed, a transfer that landed on a suffixed copy of dst counts too
+        if (src, dst) in self.finished:
+            return True
+
+        return suffixed and any(PixifCollisions.is_copy(dst, other) for other in self.sources.get(src, ()))
+
+    def open(self):
+        if not self.f:
+            self.f = open(self.filename, 'a')
+
+    def record(self, state, method, src, dst, flush=True):
+        self.open()
+        self.f.write('\t'.join([state, method, src, dst]) + '\n')
+
+        if flush:
+            self.f.flush()
+
+    def flush(self):
+        if self.f:
+            self.f.flush()
+
+    def clear(self):
+        # the run completed; nothing is left to resume
+        if self.f:
+            self.f.close()
+            self.f = None
+
+        self.finished = set()
+        self.sources = {}
+
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+def shard_of(path, count):
+    # which of count shards a path relative to its src falls in, by the range of CRC-32 values it hashes to
+    return ((zlib.crc32(path) & 0xffffffff) * count) >> 32
+
+class PixifLeases(object):
+    # Lease table in a SQLite file shared by several pixif processes, possibly on different hosts, that splits each
+    # section into `shards` hash ranges of source paths. A worker claims a shard that is neither done nor leased,
+    # renews the lease from a background thread while working on it and marks it done; the lease of a worker that
+    # died runs out after `seconds` and the shard is claimed again. Once every shard is done the section is finished
+    # for good, so a new job needs a new file. Hosts' clocks have to roughly agree.
+    # Workers reserve destination names here before creating them. A name has one owner, so whoever claims a shard
+    # next can tell the transfers its last owner completed from the placeholders and partial files it left behind.
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS jobs (job TEXT PRIMARY KEY, shards INTEGER)',
+        'CREATE TABLE IF NOT EXISTS leases (job TEXT, shard INTEGER, owner TEXT, expires REAL, done INTEGER, '
+        'PRIMARY KEY (job, shard))',
+        'CREATE TABLE IF NOT EXISTS reservations (job TEXT, shard INTEGER, src TEXT, dst TEXT PRIMARY KEY, '
+        'size INTEGER)',
+        'CREATE INDEX IF NOT EXISTS reservations_src ON reservations (job, shard, src)',
+    )
+
+    def __init__(self, filename, worker, shards=16, seconds=60.0):
+        import sqlite3
+
+        self.filename = filename
+        self.owner = '{0}:{1}'.format(worker, os.getpid())
+        self.shards = shards
+        self.seconds = seconds
+        self.held = {}
+        # the connection is shared with the renewing threads
+        self.lock = threading.Lock()
+
+        # statements commit on their own; claims begin their transaction explicitly to take the write lock first
+        self.db = sqlite3.connect(filename, timeout=max(seconds, 5), isolation_level=None, check_same_thread=False)
+
+        for sql in self.SCHEMA:
+            self.db.execute(sql)
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params)
+
+    def job(self, name):
+        # shard count of a job, adding it with this worker's count if it is new
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('INSERT OR IGNORE INTO jobs VALUES (?, ?)', (name, self.shards))
+            shards = self.db.execute('SELECT shards FROM jobs WHERE job = ?', (name,)).fetchone()[0]
+            self.db.executemany('INSERT OR IGNORE INTO leases VALUES (?, ?, NULL, 0, 0)',
+                                [(name, shard) for shard in range(shards)])
+            self.db.execute('COMMIT')
+
+        return shards
+
+    def claim(self, name):
+        # a shard of the job leased to this worker, waiting for other workers' leases to finish or run out;
+        # None once every shard is done
+        while True:
+            with self.lock:
+                now = time.time()
+                self.db.execute('BEGIN IMMEDIATE')
+                row = self.db.execute('SELECT shard FROM leases WHERE job = ? AND done = 0 AND expires < ? ORDER BY shard '
+                                      'LIMIT 1', (name, now)).fetchone()
+                if row:
+                    self.db.execute('UPDATE leases SET owner = ?, expires = ? WHERE job = ? AND shard = ?',
+                                    (self.owner, now + self.seconds, name, row[0]))
+                self.db.execute('COMMIT')
+
+            if row:
+                self.hold(name, row[0])
+                return row[0]
+
+            if not self.execute('SELECT COUNT(*) FROM leases WHERE job = ? AND done = 0', (name,)).fetchone()[0]:
+                return None
+
+            time.sleep(min(self.seconds / 4.0, 5.0))
+
+    def hold(self, name, shard):
+        # renew the lease every third of its length until the shard is finished
+        stop = threading.Event()
+        lost = []
+
+        def renew():
+            while True:
+                stop.wait(self.seconds / 3.0)
+                if stop.isSet():
+                    return
+
+                if not self.renew(name, shard):
+                    lost.append(True)
+                    return
+
+        thread = threading.Thread(target=renew)
+        thread.daemon = True
+        thread.start()
+        self.held[(name, shard)] = (stop, thread, lost)
+
+    def renew(self, name, shard):
+        # False when the lease ran out and another worker has the shard now
+        cursor = self.execute('UPDATE leases SET expires = ? WHERE job = ? AND shard = ? AND owner = ? AND done = 0',
+                              (time.time() + self.seconds, name, shard, self.owner))
+        return cursor.rowcount == 1
+
+    def finish(self, name, shard, done=True):
+        # mark a claimed shard done, or hand it back to the other workers; False if the lease was lost meanwhile
+        stop, thread, lost = self.held.pop((name, shard))
+        stop.set()
+        thread.join()
+
+        if done:
+            cursor = self.execute('UPDATE leases SET done = 1 WHERE job = ? AND shard = ? AND owner = ?',
+                                  (name, shard, self.owner))
+        else:
+            cursor = self.execute('UPDATE leases SET expires = 0 WHERE job = ? AND shard = ? AND owner = ?',
+                                  (name, shard, self.owner))
+
+        return not lost and cursor.rowcount == 1
+
+    def reserve(self, name, shard, src, dst, size):
+        # record dst as the name src, size bytes once transferred, goes to; False if another worker has it.
+        # Names are kept once the shard is done, so every file a worker of the job creates has its record.
+        import sqlite3
+
+        try:
+            self.execute('INSERT INTO reservations VALUES (?, ?, ?, ?, ?)', (name, shard, src, dst, size))
+        except sqlite3.IntegrityError:
+            return False
+
+        return True
+
+    def placed(self, name, shard, src):
+        # where an earlier owner of the shard finished transferring src to, or None
+        for dst, size in self.execute('SELECT dst, size FROM reservations WHERE job = ? AND shard = ? AND src = ?',
+                                      (name, shard, src)).fetchall():
+            if os.path.exists(dst) and os.path.getsize(dst) == size:
+                return dst
+
+        return None
+
+    def release(self, name, dst):
+        # give up a reserved name that was never created or whose file is gone again
+        self.execute('DELETE FROM reservations WHERE job = ? AND dst = ?', (name, dst))
+
+    def recover(self, name, shard):
+        # Clear what an earlier owner of a just claimed shard left under its reserved names: a destination of the
+        # recorded size is a finished transfer and stays, a shorter one or a leftover temporary file is removed
+        # and its name released so the shard's images are placed there again.
+        # Returns a list of (text, src, dst) like PixifJournal.recover.
+        actions = []
+        rows = self.execute('SELECT src, dst, size FROM reservations WHERE job = ? AND shard = ?',
+                            (name, shard)).fetchall()
+
+        for src, dst, size in rows:
+            try:
+                tmp = temp_filename(dst)
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                    actions.append(('(lease) removed temporary destination', src, tmp))
+
+                if os.path.exists(dst) and os.path.getsize(dst) != size:
+                    os.remove(dst)
+                    actions.append(('(lease) removed partial destination', src, dst))
+
+                if not os.path.exists(dst):
+                    self.release(name, dst)
+            except OSError as e:
+                actions.append((str(e), src, dst))
+
+        return actions
+
+    def close(self):
+        self.db.close()
+
+class PixifCatalog(object):
+    # SQLite catalog of transferred photos: where each one went, its datetime, size and resolved tags,
+    # so the library can be searched without parsing it again. Tags are stored one row per name and value.
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS photos (dst TEXT PRIMARY KEY, src TEXT, datetime TEXT, size INTEGER, added TEXT)',
+        'CREATE INDEX IF NOT EXISTS photos_datetime ON photos (datetime)',
+        'CREATE INDEX IF NOT EXISTS photos_size ON photos (size)',
+        'CREATE TABLE IF NOT EXISTS tags (dst TEXT, name TEXT, value TEXT, PRIMARY KEY (dst, name))',
+        'CREATE INDEX IF NOT EXISTS tags_value ON tags (name, value)',
+    )
+
+    def __init__(self, filename, batch=500):
+        import sqlite3
+
+        self.filename = filename
+        self.batch = batch
+        self.pending = []
+
+        self.db = sqlite3.connect(filename)
+        # paths and tag values are byte strings
+        self.db.text_factory = str
+
+        with self.db:
+            for sql in self.SCHEMA:
+                self.db.execute(sql)
+
+    def add(self, image, dst, size):
+        # rows are upserted in a single transaction once a batch is full
+        added = datetime.now().isoformat()
+        taken = image.datetime.isoformat(' ') if image.datetime else None
+        self.pending.append(((dst, image.filename, taken, size, added), dict(image)))
+
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?)',
+                                [photo for photo, tags in self.pending])
+            self.db.executemany('DELETE FROM tags WHERE dst = ?', [(photo[0],) for photo, tags in self.pending])
+            self.db.executemany('INSERT INTO tags VALUES (?, ?, ?)',
+                                [(photo[0], name, value) for photo, tags in self.pending for name, value in tags.iteritems()])
+
+        self.pending = []
+
+    def contains(self, dst):
+        self.flush()
+        return self.db.execute('SELECT 1 FROM photos WHERE dst = ?', (dst,)).fetchone() is not None
+
+    def find(self, filters):
+        # (datetime, dst) of photos whose tags match every (name, value) filter, oldest first
+        self.flush()
+        sql = 'SELECT datetime, dst FROM photos'
+        where = ['dst IN (SELECT dst FROM tags WHERE name = ? AND value = ?)'] * len(filters)
+
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        params = [part for name, value in filters for part in (name, value)]
+        return self.db.execute(sql + ' ORDER BY datetime, dst', params).fetchall()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
 class PixifImage(object):
     # Datetime tags to use for getting datetime of photo.
     # Will try each tag until a valid datetime is extracted once valid will not look at the remaining tags.
-    EXIF_DATETIME_TAGS = ('DateTimeOriginal', 'DateTimeDigitized', 'DateTime')
+    # CreationTime and ModifyTime come from PNG tEXt and tIME chunks or the movie header of MP4/MOV files.
+    EXIF_DATETIME_TAGS = ('DateTimeOriginal', 'DateTimeDigitized', 'DateTime', 'CreationTime', 'ModifyTime')
 
     # Datetime format to attempt to extra from EXIF_DATETIME_TAG.
     # Similar to EXIF_DATETIME_TAGS, will attempt to parse datetime using formats listed in order until valid.
+    # Only used for values EXIF.get_datetime can't decode, which handles the standard '%Y:%m:%d %H:%M:%S' itself.
     EXIF_DATETIME_STRF = ('%Y:%m:%d %H:%M:%S',)
 
     DATETIME_FORMAT = {
-        'tags': ('Year', 'Month', 'Day', 'Hour', 'Minute', 'Second', 'Weekday', 'Yearday'),
-        'strf': ('%Y',   '%m',    '%d',  '%H',   '%M',     '%S',     '%w',      '%j')
+        'tags': ('Year', 'Month', 'Day', 'Hour', 'Minute', 'Second', 'Weekday', 'Yearday', 'Microsecond'),
+        'strf': ('%Y',   '%m',    '%d',  '%H',   '%M',     '%S',     '%w',      '%j',      '%f')
     }
 
-    def __init__(self, filename):
+    # Bytes of the file header read when only datetime tags are needed.
+    DATETIME_HEADER_LIMIT = 65536
+
+    # TIFF based RAW formats. Their IFDs are spread throughout large files so they're parsed through a memory map.
+    MMAP_FILE_EXT = ('.tif', '.tiff', '.dng', '.nef', '.nrw', '.cr2', '.arw', '.srw', '.sr2', '.pef')
+
+    # Filename patterns to get the datetime of a photo from, e.g. 'IMG_20120102_101530.jpg' or
+    # Dropbox's '2012-01-02 10.15.30.jpg'. Named groups are DATETIME_FORMAT tags; only Year is required.
+    # Will try each pattern in order until a valid datetime is extracted. Neither matches inside a longer run of
+    # digits, such as a camera counter or a hash.
+    FILENAME_DATETIME_PATTERNS = (
+        re.compile(r'(?<!\d)(?P<Year>\d{4})(?P<Month>\d{2})(?P<Day>\d{2})[_-](?P<Hour>\d{2})(?P<Minute>\d{2})(?P<Second>\d{2})(?!\d)'),
+        re.compile(r'(?<!\d)(?P<Year>\d{4})-(?P<Month>\d{2})-(?P<Day>\d{2}) (?P<Hour>\d{2})\.(?P<Minute>\d{2})\.(?P<Second>\d{2})(?!\d)'),
+    )
+
+    # How filename datetimes are used:
+    #   none: never
+    #   fallback: when EXIF has no datetime, before falling back to the file's modification time
+    #   prefer: before EXIF; date-only templates then don't read the file at all when the name matches
+    NAMEDATES = ('none', 'fallback', 'prefer')
+
+    # Bytes of an archive member kept in memory for parsing; members are streams and can't be seeked back.
+    ARCHIVE_HEADER_LIMIT = 1024 * 1024
+
+    # Bytes of readonce headers kept across one scan until their images are placed; the images parsed past it
+    # keep none and are read in full when copied.
+    HEADER_RETAIN_LIMIT = 256 * 1024 * 1024
+
+    def __init__(self, filename, tags=None, namedates='none', patterns=None, advisor=None, parsems=0, readonce=0,
+                 archive=None):
         self.filename = filename
         self.datetime = None
+        self.moved = False
+        self.header = None
+        self.archive = archive
+        self.member = filename[len(archive.path) + 1:] if archive else None
         self.tags = {}
-
-        with open(filename, 'rb') as f:
-            self.exif_data = EXIF.process_file(f)
+        self.namedates = namedates
+        self.patterns = self.FILENAME_DATETIME_PATTERNS if patterns is None else patterns
+        self.exif_data = None
+
+        if namedates == 'prefer':
+            self.datetime = self.datetime_from_filename()
+
+        if self.datetime and self.date_only(tags):
+            # the name answers everything the template needs
+            self.exif_data = {}
+        elif archive:
+            self.exif_data = archive.extract(self.member, lambda stream, size: self.parse_stream(stream, size, tags, parsems,
+                                                                                                  readonce))
+        else:
+            # a mapped file is read outside of the header kept for copying
+            use_mmap = not readonce and os.path.splitext(filename)[1].lower() in self.MMAP_FILE_EXT
+
+            with open(filename, 'rb') as f:
+                if advisor:
+                    advisor.advise(f.fileno(), 0, self.DATETIME_HEADER_LIMIT, advisor.WILLNEED)
+
+                if readonce:
+                    f = self.header = PixifHeader(f, readonce)
+
+                if self.date_only(tags):
+                    self.exif_data = EXIF.process_datetime(f, self.DATETIME_HEADER_LIMIT, use_mmap)
+
+                if self.exif_data is None:
+                    f.seek(0)
+                    limits = EXIF.ParseLimits(seconds=parsems / 1000.0) if parsems else None
+                    self.exif_data = EXIF.process_file(f, details=self.needs_details(tags), use_mmap=use_mmap,
+                                                       limits=limits)
+
+            if self.header:
+                self.header.close()
+
+        # handle on the embedded preview, read only when exported
+        self.thumbnail = None
+        if tags is None or 'Thumbnail' in tags:
+            self.thumbnail = self.exif_data.get('JPEGThumbnail') or self.exif_data.get('TIFFThumbnail')
 
         self.set_file_tags()
         self.set_exif_tags()
+        self.set_maker_note_tags(tags)
         self.set_datetime_tags()
 
     def __repr__(self):
         return '<PixifImage at {0}>'.format(self.filename)
 
+    def parse_stream(self, stream, size, tags, parsems, readonce):
+        # parse an archive member from a bounded window at its start; nothing is kept for copying
+        f = PixifHeader(stream, max(readonce, self.ARCHIVE_HEADER_LIMIT), size)
+        limits = EXIF.ParseLimits(seconds=parsems / 1000.0) if parsems else None
+        exif_data = None
+
+        if self.date_only(tags):
+            exif_data = EXIF.process_datetime(f, self.DATETIME_HEADER_LIMIT)
+
+        if exif_data is None:
+            f.seek(0)
+            exif_data = EXIF.process_file(f, details=self.needs_details(tags), limits=limits)
+
+        f.close()
+        return exif_data
+
+    @classmethod
+    def needs_details(cls, tags):
+        # MakerNote decoding is only worth it when a referenced tag can't come from the standard IFDs
+        if tags is None:
+            return True
+
+        known = STANDARD_TAGS.union(cls.DATETIME_FORMAT['tags'], ('Name', 'Extension'))
+        return bool(set(tags) - known)
+
+    @classmethod
+    def date_only(cls, tags):
+        # the only EXIF tags a template needs are the datetime ones
+        if tags is None:
+            return False
+
+        return set(tags).issubset(cls.DATETIME_FORMAT['tags'] + ('Name', 'Extension'))
+
+    @classmethod
+    def compile_patterns(cls, text):
+        # extra patterns from config, one per line, are tried before the built-in ones
+        patterns = [re.compile(line.strip()) for line in (text or '').splitlines() if line.strip()]
+        return tuple(patterns) + cls.FILENAME_DATETIME_PATTERNS
+
     def __iter__(self):
         return self.tags.iteritems()
 
@@ -99,6 +1744,15 @@ class PixifImage(object):
                 # something went wrong but what can we do; tag value not usable
                 pass
 
+    def set_maker_note_tags(self, tags):
+        # MakerNotes are only decoded once the template asks for a tag the standard IFDs didn't have
+        if getattr(self.exif_data, 'maker_note', None) is None:
+            return
+
+        if tags is None or set(tags) - set(self.tags) - set(self.DATETIME_FORMAT['tags']) - set(['Thumbnail']):
+            self.exif_data.decode_maker_note()
+            self.set_exif_tags()
+
     def set_datetime_tags(self):
         self.set_datetime()
 
@@ -109,14 +1763,20 @@ class PixifImage(object):
                 self.tags[tag] = value
 
     def set_datetime(self):
-        if self.exif_data:
+        if not self.datetime and self.exif_data:
             self.datetime = self.datetime_from_exif()
 
-        if not self.exif_data or not self.datetime:
+        if not self.datetime and self.namedates == 'fallback':
+            self.datetime = self.datetime_from_filename()
+
+        if not self.datetime:
             self.datetime = self.datetime_from_file()
 
     def datetime_from_exif(self):
-        dt = None
+        # fixed-width decoding of standard EXIF datetimes including SubSecTime and OffsetTime
+        dt = EXIF.get_datetime(self.exif_data, self.EXIF_DATETIME_TAGS)
+        if dt:
+            return dt
 
         for tag in self.EXIF_DATETIME_TAGS:
             if tag not in self.tags:
@@ -124,36 +1784,100 @@ class PixifImage(object):
 
             for strf in self.EXIF_DATETIME_STRF:
                 try:
-                    date_str = str(self.tags[tag])
-                    dt = datetime.strptime(date_str, strf)
-                    break
+                    return datetime.strptime(str(self.tags[tag]), strf)
                 except Exception:
                     pass
 
-        return dt
+        return None
+
+    def datetime_from_filename(self):
+        name = os.path.basename(self.filename)
+
+        for pattern in self.patterns:
+            match = pattern.search(name)
+            if not match:
+                continue
+
+            parts = match.groupdict()
+            defaults = (0, 1, 1, 0, 0, 0)
+
+            try:
+                dt = datetime(*[int(parts.get(tag) or defaults[i]) for i, tag in enumerate(self.DATETIME_FORMAT['tags'][:6])])
+            except ValueError:
+                # not a real date, e.g. a counter that happens to look like one
+                continue
+
+            # strftime can't format earlier years
+            if dt.year >= 1900:
+                return dt
+
+        return None
+
+    def size(self):
+        if self.archive:
+            return self.archive.size(self.member)
+
+        return os.path.getsize(self.filename)
 
     def datetime_from_file(self):
+        if self.archive:
+            return datetime.fromtimestamp(self.archive.mtime(self.member))
+
         return datetime.fromtimestamp(os.path.getmtime(self.filename))
 
 
 class PixifCollection(object):
-    VALID_FILE_EXT = ('.jpg', '.jpeg', '.png')
-
-    def __init__(self, src, dst, saveas, method='move', overwrite=False, logger=None, **ignore):
+    VALID_FILE_EXT = ('.jpg', '.jpeg', '.png', '.heic', '.heif', '.mp4', '.mov', '.m4v', '.3gp') + PixifImage.MMAP_FILE_EXT
+
+    # Order files are parsed in:
+    #   walk: as os.walk finds them
+    #   inode: by inode number, which roughly follows disk layout on spinning disks
+    #   extent: by the physical offset of each file's first extent when FIEMAP is available, else by inode
+    ORDERS = ('walk', 'inode', 'extent')
+
+    def __init__(self, src, dst, saveas, method='move', overwrite=False, logger=None, images=None, journal=None,
+                 atomic=False, sync=0, syncms=0, namedates='none', namepatterns='', order='walk', advisor=None,
+                 throttle=None, parsems=0, catalog=None, collision='skip', readonce='', mounts=None, endpoint='',
+                 region='', partsize='', shard=None, leases=None, **ignore):
         self.src = src
         self.dst = dst
         self.saveas = saveas
         self.method = method
         self.overwrite = overwrite
         self.logger = logger
-
-        self.set_images()
+        self.journal = journal
+        self.atomic = atomic
+        # guards the journal, committer and destination names shared by concurrent transfers
+        self.lock = threading.RLock()
+        self.committer = PixifCommitter(sync, syncms, self.lock)
+        self.namedates = namedates
+        self.namepatterns = namepatterns
+        self.order = order
+        self.advisor = advisor
+        self.parsems = parsems
+        self.readonce = readonce
+        self.catalog = catalog
+        self.storage = open_storage(dst, endpoint, region, partsize)
+        self.collisions = PixifCollisions(collision, self.storage, self.lock)
+        self.throttle = throttle if throttle and throttle.is_active() else None
+        self.mounts = mounts or PixifMounts()
+        # a (job, shard) pair of the leases a worker places images for
+        self.shard = shard
+        self.leases = leases
+        self.claimed = set()
+
+        if images is None:
+            self.set_images()
+        else:
+            self.images = images
 
     def execute(self):
         if self.method == 'copy':
             self.copy()
         elif self.method == 'move':
             self.move()
+        elif self.method == 'thumbnails':
+            self.thumbnails()
 
     def copy(self):
         return self._process(shutil.copy2)
@@ -161,41 +1885,492 @@ class PixifCollection(object):
     def move(self):
         return self._process(shutil.move)
 
-    def _process(self, operator):
+    def thumbnails(self):
+        # save each image's embedded preview under dst instead of the image itself
         for image in self.images:
-            log = None
-            dst_file = os.path.join(self.dst, self.saveas.format(**dict(image)))
+            if image.moved:
+                continue
+
+            dst_file = self.storage.join(self.saveas.format(**dict(image)))
 
-            if self.overwrite or not os.path.exists(dst_file):
+            if not image.thumbnail:
+                log = '(warning) could not export thumbnail because image has none'
+            elif self.overwrite or not self.storage.exists(dst_file):
                 head, tail = os.path.split(dst_file)
+                self.storage.makedirs(head)
 
-                try:
-                    os.makedirs(head)
-                except OSError:
-                    # destination root already exists
-                    pass
+                tmp = temp_filename(dst_file) if self.atomic and self.storage.local else None
 
                 try:
-                    operator(image.filename, dst_file)
-                    log = '(success) processed image using {0}'.format(operator)
-                except OSError as e:
+                    if image.archive:
+                        data = image.archive.extract(image.member, lambda stream, size:
+                                                     image.thumbnail.read(PixifHeader(stream, size, size)))
+                    else:
+                        with open(image.filename, 'rb') as f:
+                            data = image.thumbnail.read(f)
+
+                    if not self.storage.local:
+                        self.storage.put_data(dst_file, data)
+                    else:
+                        with open(tmp or dst_file, 'wb') as f:
+                            f.write(data)
+
+                    if tmp:
+                        os.rename(tmp, dst_file)
+
+                    log = '(success) exported thumbnail'
+                except (IOError, OSError) as e:
                     log = str(e)
+                except Exception as e:
+                    # a corrupted thumbnail, e.g. one over the parse limits, only costs its own image
+                    log = '(warning) could not export thumbnail because it could not be read: {0}'.format(e)
             else:
-                log = '(warning) could not process image because file already exists'
+                log = '(warning) could not export thumbnail because file already exists'
+
+            if self.logger:
+                self.logger.append(log, image, dst_file)
+
+    def _process(self, operator):
+        method = 'move' if operator is shutil.move else 'copy'
+        plan = []
+
+        for image in self.images:
+            # an earlier section sharing this scan already moved the file away
+            if image.moved:
+                continue
+
+            dst_file = self.storage.join(self.saveas.format(**dict(image)))
+
+            # finished by an interrupted earlier run
+            if self.journal and self.journal.is_finished(image.filename, dst_file, self.collisions.policy != 'skip'):
+                continue
+
+            plan.append((image, dst_file))
+
+            if self.journal:
+                self.journal.record(PixifJournal.PLANNED, method, image.filename, dst_file, flush=False)
+
+        if self.journal:
+            self.journal.flush()
+
+        self.claimed = set()
+        # an archive is read one member at a time anyway, and a compressed tar only forward
+        mounts = PixifMounts() if any(image.archive for image, dst_file in plan) else self.mounts
+        places = mounts.map(lambda item: self.place(operator, *item), plan,
+                                 lambda item: (item[0].filename, item[1]))
+
+        for (image, planned), (log, dst_file, size) in itertools.izip(plan, places):
+            if size is not None:
+                self.catalog.add(image, dst_file, size)
 
             if log and self.logger:
                 self.logger.append(log, image, dst_file)
 
-    def set_images(self):
-        self.images = []
+        self.committer.flush()
 
-        for root, dirs, filenames in os.walk(self.src):
-            for filename in filenames:
-                if os.path.splitext(filename)[1].lower() in self.VALID_FILE_EXT:
+        if self.catalog:
+            self.catalog.flush()
+
+        for log, src, dst in self.committer.errors:
+            if self.logger:
+                self.logger.append(log, src, dst)
+
+        self.committer.errors = []
+
+    def place(self, operator, image, dst_file):
+        # transfer one image, possibly on a worker thread; returns the log text, the destination it went to
+        # and, when cataloging, the size it was transferred with (None if it wasn't)
+        log = None
+        size = None
+        wanted = dst_file
+        reserved = False
+        # the header is only worth keeping for one transfer; a later section sharing the scan reads the file again
+        header, image.header = image.header, None
+
+        if self.leases and self.storage.local:
+            placed = self.leases.placed(self.shard[0], self.shard[1], image.filename)
+
+            if placed:
+                # a worker that had the shard before finished this one, and any other name would be a second copy
+                size = image.size() if self.catalog else None
+
+                if operator is shutil.move and not image.archive:
+                    try:
+                        os.remove(image.filename)
+                    except OSError as e:
+                        return str(e), placed, None
+                    image.moved = True
+
+                return '(info) skipped image because an earlier owner of its shard already placed it', placed, size
+
+        # only picking and recording a name holds the lock; listing, hashing and reserving run alongside other transfers
+        while True:
+            if self.overwrite:
+                exists = False
+            elif self.collisions.policy != 'skip':
+                # any existing file makes way for a suffixed name, so only identical ones are left alone
+                resolved = self.collisions.resolve(image.filename, wanted)
+                exists = resolved is None
+                dst_file = resolved or wanted
+            else:
+                with self.lock:
+                    # taken by an earlier image of this run, which may still be in flight
+                    exists = dst_file in self.claimed or self.committer.is_pending(dst_file)
+                    self.claimed.add(dst_file)
+
+            if exists or self.overwrite or not self.shard:
+                break
+
+            # workers on other shards place into the same tree, so a name is only ours once it's created;
+            # one they got to first is skipped or, with suffixes, resolved again
+            try:
+                self.storage.makedirs(os.path.dirname(dst_file))
+                reserved = self.reserve(image, dst_file)
+            except OSError as e:
+                return str(e), dst_file, None
+
+            if reserved or self.collisions.policy == 'skip':
+                exists = not reserved
+                break
+
+        if not exists and not reserved and not self.overwrite and self.collisions.policy == 'skip':
+            try:
+                exists = self.storage.exists(dst_file)
+            except OSError as e:
+                # object storage can't be listed
+                return str(e), dst_file, None
+
+        if not exists:
+            head, tail = os.path.split(dst_file)
+            self.storage.makedirs(head)
+
+            try:
+                # the source is gone once moved
+                transferred = image.size() if self.catalog else None
+                self.transfer(operator, image.filename, dst_file, header, image.archive)
+                image.moved = operator is shutil.move and not image.archive
+                log = '(success) processed image using {0}'.format(operator)
+                size = transferred
+            except OSError as e:
+                log = str(e)
+
+                if reserved and self.storage.local:
+                    # leave the name to a later run rather than an empty file
                     try:
-                        self.images.append(PixifImage(os.path.join(root, filename)))
-                    except Exception as e:
-                        print e
+                        self.storage.remove(dst_file)
+                    except OSError:
+                        pass
+
+                    if self.leases:
+                        self.leases.release(self.shard[0], dst_file)
+        elif self.collisions.policy == 'hash':
+            log = '(info) skipped image because an identical file already exists'
+        else:
+            log = '(warning) could not process image because file already exists'
+
+        return log, dst_file, size
+
+    def reserve(self, image, dst):
+        # create dst empty, or False if it's taken. With leases the name is recorded before the file is created, and
+        # only if there's no file yet, so a recorded name's file is always the recording worker's to clear up
+        if not self.leases or not self.storage.local:
+            return self.storage.reserve(dst)
+
+        job, shard = self.shard
+        if self.storage.exists(dst) or not self.leases.reserve(job, shard, image.filename, dst, image.size()):
+            return False
+
+        if not self.storage.reserve(dst):
+            self.leases.release(job, dst)
+            return False
+
+        return True
+
+    def transfer(self, operator, src, dst, header=None, archive=None):
+        journal = self.journal
+        # members can't be removed from their archive, so they're always copied
+        method = 'move' if operator is shutil.move and not archive else 'copy'
+
+        if self.throttle:
+            self.throttle.take_file()
+
+        if not self.storage.local:
+            return self.upload(method, src, dst, header, archive)
+
+        if archive:
+            return self.extract(archive, src, dst)
+
+        if not journal and not self.atomic and not self.committer.files and not self.advisor and not self.throttle \
+                and not header:
+            return operator(src, dst)
+
+        if journal:
+            with self.lock:
+                journal.record(PixifJournal.COPYING, method, src, dst)
+
+        if method == 'move':
+            try:
+                # same device; the rename is atomic and removes the source too
+                os.rename(src, dst)
+            except OSError:
+                pass
+            else:
+                with self.lock:
+                    self.committer.add(None, dst, lambda: self.committed(method, src, dst, renamed=True))
+                return
+
+        # different devices or a copy; the source is only removed once the copy is committed
+        tmp = temp_filename(dst) if self.atomic else None
+
+        try:
+            if self.advisor or self.throttle or header:
+                copy_file(src, tmp or dst, self.advisor, self.throttle, header)
+            else:
+                shutil.copy2(src, tmp or dst)
+        except (IOError, OSError):
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        with self.lock:
+            self.committer.add(tmp, dst, lambda: self.committed(method, src, dst))
+
+    def upload(self, method, src, dst, header=None, archive=None):
+        # an object appears only once its upload completes, so there's nothing to make atomic or sync;
+        # the source of a move is removed right after
+        journal = self.journal
+
+        if journal:
+            with self.lock:
+                journal.record(PixifJournal.COPYING, method, src, dst)
+
+        if archive:
+            archive.extract(src[len(archive.path) + 1:],
+                            lambda stream, size: self.storage.put_stream(stream, size, dst, throttle=self.throttle))
+        else:
+            self.storage.put(src, dst, header, self.throttle)
+
+        if journal:
+            with self.lock:
+                journal.record(PixifJournal.COMMITTED, method, src, dst)
+
+        if method == 'move':
+            os.remove(src)
+
+            if journal:
+                with self.lock:
+                    journal.record(PixifJournal.REMOVED, method, src, dst)
+        elif self.advisor:
+            self.advisor.drop(src)
+
+    def extract(self, archive, src, dst):
+        # stream an archive member to dst; journaled, atomic and committed like any other copy
+        if self.journal:
+            with self.lock:
+                self.journal.record(PixifJournal.COPYING, 'copy', src, dst)
+
+        tmp = temp_filename(dst) if self.atomic else None
+
+        try:
+            archive.copy(src[len(archive.path) + 1:], tmp or dst, self.throttle)
+        except (IOError, OSError):
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        with self.lock:
+            self.committer.add(tmp, dst, lambda: self.committed('copy', src, dst))
+
+    def committed(self, method, src, dst, renamed=False):
+        journal = self.journal
+
+        if journal and not renamed:
+            journal.record(PixifJournal.COMMITTED, method, src, dst)
+
+        if method == 'move':
+            if not renamed:
+                os.remove(src)
+
+            if journal:
+                journal.record(PixifJournal.REMOVED, method, src, dst)
+
+        if self.advisor and not renamed:
+            # neither side of a finished copy is read again
+            if method == 'copy':
+                self.advisor.drop(src)
+            self.advisor.drop(dst)
+
+    def set_images(self):
+        self.images = self.find_images(self.src, self.image_tags(self.saveas, self.method, self.catalog), self.namedates, self.namepatterns, self.order,
+                                       self.advisor, self.parsems, self.readonce, self.mounts)
+
+    @classmethod
+    def image_tags(cls, saveas, method, catalog=None):
+        # tags the images have to be parsed for; exporting thumbnails needs the whole EXIF block,
+        # cataloging at least the standard IFDs
+        tags = saveas_tags(saveas)
+        if method == 'thumbnails':
+            tags.add('Thumbnail')
+        if catalog:
+            tags.update(CATALOG_TAGS)
+        return tags
+
+    @classmethod
+    def find_images(cls, src, tags=None, namedates='none', namepatterns='', order='walk', advisor=None, parsems=0,
+                    readonce='', mounts=None):
+        patterns = PixifImage.compile_patterns(namepatterns)
+        readonce = int(parse_size(readonce))
+
+        if is_archive(src):
+            return cls.find_archive_images(src, tags, namedates, patterns, parsems, readonce)
+
+        return cls.parse_images(cls.find_paths(src, order), tags, namedates, patterns, advisor, parsems, readonce, mounts)
+
+    @classmethod
+    def find_shards(cls, src, count, tags=None, namedates='none', namepatterns='', order='walk', advisor=None,
+                    parsems=0, readonce='', mounts=None):
+        # src split into count shards by path below src, from one walk of it: ({shard: items}, load) where
+        # load(items) gives the images of a shard. Files are only parsed once their shard is claimed,
+        # archive members as the archive is read.
+        patterns = PixifImage.compile_patterns(namepatterns)
+        readonce = int(parse_size(readonce))
+        buckets = {}
+
+        if is_archive(src):
+            for image in cls.find_archive_images(src, tags, namedates, patterns, parsems, readonce):
+                buckets.setdefault(shard_of(image.member, count), []).append(image)
+
+            return buckets, list
+
+        for path in cls.find_paths(src, order):
+            buckets.setdefault(shard_of(os.path.relpath(path, src), count), []).append(path)
+
+        return buckets, lambda paths: cls.parse_images(paths, tags, namedates, patterns, advisor, parsems, readonce,
+                                                       mounts)
+
+    @classmethod
+    def find_paths(cls, src, order='walk'):
+        # image files below src in the order they're parsed in
+        candidates = []
+
+        # collect candidates and their sort keys during the walk so ordering costs no extra pass
+        for root, dirs, filenames in os.walk(src):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() in cls.VALID_FILE_EXT:
+                    path = os.path.join(root, filename)
+                    candidates.append((cls.order_key(path, order), path))
+
+        if order != 'walk':
+            candidates.sort()
+
+        return [path for key, path in candidates]
+
+    @classmethod
+    def parse_images(cls, paths, tags, namedates, patterns, advisor, parsems, readonce, mounts=None):
+        images = []
+        mounts = mounts or PixifMounts()
+
+        def parse(path):
+            try:
+                return PixifImage(path, tags, namedates, patterns, advisor, parsems, readonce), None
+            except Exception as e:
+                return None, e
+
+        retained = 0
+
+        # headers are read concurrently, but images and errors still come back in candidate order
+        for image, error in mounts.map(parse, paths, lambda path: (path,)):
+            if error:
+                print error
+                continue
+
+            if image.header:
+                retained += len(image.header.data)
+                if retained > PixifImage.HEADER_RETAIN_LIMIT:
+                    image.header = None
+
+            images.append(image)
+
+        return images
+
+    @classmethod
+    def find_archive_images(cls, src, tags, namedates, patterns, parsems, readonce):
+        # members are parsed as the archive is listed, in one pass over a compressed tar
+        images = []
+        archive = PixifArchive(src)
+
+        for name, size in archive.members():
+            if os.path.splitext(name)[1].lower() in cls.VALID_FILE_EXT:
+                try:
+                    images.append(PixifImage(os.path.join(src, name), tags, namedates, patterns, None, parsems, readonce,
+                                             archive))
+                except Exception as e:
+                    print e
+
+        return images
+
+    @classmethod
+    def order_key(cls, path, order):
+        if order == 'walk':
+            return None
+
+        offset = physical_offset(path) if order == 'extent' else None
+        if offset is not None:
+            return (0, offset)
+
+        try:
+            st = os.lstat(path)
+        except OSError:
+            # sort unreadable files last; opening them will report the error
+            return (2, 0)
+
+        return (1, st.st_dev, st.st_ino)
+
+class PixifSources(object):
+    # Walks each distinct source tree once and shares the parsed images between every section under it.
+    # A section whose src is nested inside another section's src reuses the outer scan
+    # as long as both sections read images with the same IMAGE_OPTIONS. An archive is always a root of its own;
+    # the walk of a directory holding it never opens it.
+    IMAGE_OPTIONS = ('namedates', 'namepatterns', 'order', 'fadvise', 'parsems', 'readonce')
+
+    def __init__(self, sections, advisor=None, mounts=None):
+        self.advisor = advisor
+        self.mounts = mounts
+        self.roots = {}
+        self.tags = {}
+        self.images = {}
+        self.paths = {}
+
+        # walk each tree using the src spelling of its outermost section so log paths stay as configured
+        for cfg in sections:
+            self.paths[self.key(cfg)] = cfg['src']
+
+        for cfg in sections:
+            options, real = self.key(cfg)
+            outer = [r for o, r in self.paths if o == options and (real == r or real.startswith(r.rstrip(os.sep) + os.sep)
+                                                                   and not is_archive(real))]
+            root = (options, min(outer, key=len))
+
+            self.roots[self.key(cfg)] = (root, os.path.relpath(real, root[1]))
+            self.tags.setdefault(root, set()).update(PixifCollection.image_tags(cfg['saveas'], cfg['method'], cfg.get('catalog')))
+
+    def key(self, cfg):
+        return (tuple(cfg.get(name) for name in self.IMAGE_OPTIONS), os.path.realpath(cfg['src']))
+
+    def get(self, cfg):
+        root, sub = self.roots[self.key(cfg)]
+
+        if root not in self.images:
+            options = dict(zip(self.IMAGE_OPTIONS, root[0]))
+            advisor = self.advisor if options.pop('fadvise') else None
+            self.images[root] = PixifCollection.find_images(self.paths[root], self.tags[root], advisor=advisor,
+                                                            mounts=self.mounts, **options)
+
+        if sub == os.curdir:
+            return self.images[root]
+
+        prefix = os.path.join(self.paths[root], sub) + os.sep
+        return [image for image in self.images[root] if image.filename.startswith(prefix)]
 
 class PixifConfig(dict):
     opts_map = {
@@ -205,20 +2380,52 @@ class PixifConfig(dict):
         '-m': 'method',
         '-l': 'log',
         '-o': 'overwrite',
+        '-j': 'journal',
     }
 
-    flags = ['log', 'overwrite', 'enabled']
+    flags = ['log', 'overwrite', 'enabled', 'journal', 'atomic', 'fadvise']
+
+    numbers = ['sync', 'syncms', 'parsems']
+
+    # options that only take one of a few values
+    choices = {
+        'collision': PixifCollisions.POLICIES,
+        'order': PixifCollection.ORDERS,
+        'namedates': PixifImage.NAMEDATES,
+    }
 
     defaults = {
         'method': 'copy',
         'log': False,
         'overwrite': False,
-        'enabled': True
+        'enabled': True,
+        'journal': False,
+        'atomic': False,
+        'sync': 0,
+        'syncms': 0,
+        'namedates': 'none',
+        'namepatterns': '',
+        'order': 'walk',
+        'fadvise': False,
+        'parsems': 0,
+        'catalog': '',
+        'collision': 'skip',
+        'readonce': '',
+        'endpoint': '',
+        'region': '',
+        'partsize': '',
+        'bps': '',
+        'fps': '',
+        'burst': 1.0
     }
 
+    # section holding settings for the whole run rather than a transfer
+    settings_section = 'pixif'
+
     def __init__(self, filename=None, opts=None):
         self.filename = filename
         self.opts = opts
+        self.settings = {}
 
         if filename:
             # Assume that first element is config file name.
@@ -233,18 +2440,24 @@ class PixifConfig(dict):
         config.read(filename)
 
         for s in config.sections():
+            if s == self.settings_section:
+                self.settings = dict(config.items(s))
+                continue
+
             self[s] = self.defaults.copy()
 
             for name,_ in config.items(s):
                 if config.has_option(s, name):
                     if name in self.flags:
                         value = config.getboolean(s, name)
+                    elif name in self.numbers:
+                        value = config.getint(s, name)
                     else:
                         value = config.get(s, name)
 
                 self[s][name] = value
 
-    def from_opts(opts):
+    def from_opts(self, opts):
         self['section'] = self.defaults.copy()
 
         opts_dict = dict(opts)
@@ -255,21 +2468,175 @@ class PixifConfig(dict):
             else:
                 key = o.replace('--', '')
 
-            self['section'][key] = True if key in self.flags else opt
+            if key in self.flags:
+                self['section'][key] = True
+            elif key in self.numbers:
+                self['section'][key] = int(opt)
+            else:
+                self['section'][key] = opt
+
+    def errors(self):
+        # a message for each option of a section set to something other than one of its choices
+        errors = []
+
+        for s, cfg in sorted(self.iteritems()):
+            for name, allowed in sorted(self.choices.iteritems()):
+                if cfg.get(name) not in allowed:
+                    errors.append('[{0}] {1} must be one of {2}, not {3}'.format(s, name, ', '.join(allowed), cfg[name]))
+
+        return errors
+
+def query(opts):
+    # print datetime and destination of the cataloged photos matching every --query NAME=VALUE
+    catalog = dict(opts).get('--catalog')
+    if not catalog:
+        print 'ERROR: --query needs --catalog'
+        return
+
+    filters = [tuple(a.split('=', 1)) for o, a in opts if o == '--query' and '=' in a]
+    catalog = PixifCatalog(catalog)
+
+    for taken, dst in catalog.find(filters):
+        print '{0}\t{1}'.format(taken or '', dst)
+
+    catalog.close()
+
+def work_shards(leases, section, logger, options):
+    # claim shards of a section until all of them are done, transferring each one's images
+    # hosts may mount src in different places, so a job is known by its section name
+    job = section
+    shards = leases.job(job)
+    buckets = None
+
+    while True:
+        shard = leases.claim(job)
+        if shard is None:
+            break
+
+        # a worker that had the shard before may have died halfway through placing its images
+        for text, src, dst in leases.recover(job, shard):
+            logger.append(text, src, dst)
+
+        try:
+            if buckets is None:
+                # src is walked once, after the first claim so a finished job isn't walked at all
+                tags = PixifCollection.image_tags(options['saveas'], options['method'], options['catalog'])
+                buckets, load = PixifCollection.find_shards(
+                    options['src'], shards, tags, options['namedates'], options['namepatterns'], options['order'],
+                    options['advisor'], options['parsems'], options['readonce'], options['mounts'])
+
+            collection = PixifCollection(logger=logger, images=load(buckets.pop(shard, [])), shard=(job, shard),
+                                         leases=leases, **options)
+            collection.execute()
+        except BaseException:
+            leases.finish(job, shard, done=False)
+            raise
+
+        if leases.finish(job, shard):
+            logger.append('(info) {0} finished shard {1} of {2}'.format(leases.owner, shard + 1, shards), '', '')
+        else:
+            logger.append('(warning) {0} lost its lease on shard {1} of {2} before finishing it'.format(
+                          leases.owner, shard + 1, shards), '', '')
+
+        # entries of a shard are written as it finishes, not when the whole section does
+        logger.write()
+        logger.clear()
 
 def main(config_filename, opts):
     config = PixifConfig(filename=config_filename, opts=opts)
+
+    errors = config.errors()
+    if errors:
+        for error in errors:
+            print 'ERROR: ' + error
+        return
+
+    settings = config.settings
     logger_file = os.path.join(os.path.split(config_filename)[0], 'pixif.log')
 
-    for c, cfg in config.iteritems():
-        if not cfg['enabled']:
-            continue
+    def setting(name, default=None):
+        # from the [pixif] section, else the command line
+        return settings.get(name) or dict(opts).get('--' + name) or default
+
+    # workers sharing a lease file split the sections' sources between them
+    leases = None
+    journal_name = 'pixif.journal'
+
+    if setting('leases'):
+        worker = setting('worker', socket.gethostname())
+        leases = PixifLeases(setting('leases'), worker, int(setting('shards', 16)), float(setting('leasems', 60000)) / 1000)
+        # a journal of its own, which a restarted worker of the same name recovers
+        journal_name = 'pixif-{0}.journal'.format(re.sub(r'[^\w.-]', '_', worker))
+
+    journal = PixifJournal(os.path.join(os.path.split(config_filename)[0], journal_name))
+
+    # resume whatever an interrupted earlier run left behind before scanning, checking
+    # object storage destinations with their sections' settings
+    storages = [open_storage(cfg['dst'], cfg['endpoint'], cfg['region'], cfg['partsize'])
+                for c, cfg in config.iteritems() if cfg['dst'].startswith('s3://')]
+    # with leases, transfers that never committed are cleared from the names reserved in the lease file by
+    # whoever claims their shard next, and another worker may have finished them since
+    actions = journal.recover(storages, partial=not leases)
+    if actions:
+        logger = PixifLogger('journal', logger_file)
+        for text, src, dst in actions:
+            logger.append(text, src, dst)
+        logger.write()
+
+    sections = [(c, cfg) for c, cfg in config.iteritems() if cfg['enabled']]
+    advisor = PixifAdvisor()
+    mounts = PixifMounts(setting('concurrency'))
+    sources = PixifSources([cfg for c, cfg in sections], advisor, mounts)
+
+    # global and per-section bandwidth limits, adjustable while running through the control file
+    control = None
+    throttle = PixifThrottle(parse_size(settings.get('bps')), parse_size(settings.get('fps')),
+                             float(settings.get('burst') or 1.0))
+    throttles = {config.settings_section: throttle}
 
+    for c, cfg in sections:
+        throttles[c] = PixifThrottle(parse_size(cfg['bps']), parse_size(cfg['fps']), float(cfg['burst']), throttle)
+
+    if settings.get('control'):
+        control = PixifControl(settings['control'], throttles)
+        control.reload()
+        throttle.control = control
+
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, PixifControl.request)
+
+    # sections naming the same catalog file share one connection
+    catalogs = {}
+
+    for c, cfg in sections:
+        if cfg['catalog'] and cfg['catalog'] not in catalogs:
+            catalogs[cfg['catalog']] = PixifCatalog(cfg['catalog'])
+
+    for c, cfg in sections:
         logger = PixifLogger(c, logger_file)
 
-        collection = PixifCollection(logger=logger, **cfg)
-        collection.execute()
+        options = dict(cfg, journal=journal if cfg['journal'] else None, advisor=advisor if cfg['fadvise'] else None,
+                       throttle=throttles[c], catalog=catalogs.get(cfg['catalog']), mounts=mounts)
+
+        if leases:
+            work_shards(leases, c, logger, options)
+        else:
+            collection = PixifCollection(logger=logger, images=sources.get(cfg), **options)
+            collection.execute()
+
+        logger.write()
+
+    for catalog in catalogs.values():
+        catalog.close()
+
+    if leases:
+        leases.close()
+
+    journal.clear()
 
+    if any(cfg['fadvise'] for c, cfg in sections):
+        logger = PixifLogger('fadvise', logger_file)
+        logger.append('(info) ' + advisor.summary(), '', '')
         logger.write()
 
 if __name__ == '__main__':
@@ -280,12 +2647,15 @@ if __name__ == '__main__':
     try:
         opts, unparsed = getopt.getopt(
             sys.argv[1:],
-            's:d:a:m:lo',
-            ['src=', 'dst=', 'saveas=', 'method=', 'log', 'overwrite']
+            's:d:a:m:loj',
+            ['src=', 'dst=', 'saveas=', 'method=', 'log', 'overwrite', 'journal', 'atomic', 'sync=', 'syncms=', 'namedates=', 'namepatterns=', 'order=', 'fadvise', 'parsems=', 'bps=', 'fps=', 'burst=', 'catalog=', 'query=', 'collision=', 'readonce=', 'concurrency=', 'endpoint=', 'region=', 'partsize=', 'leases=', 'worker=', 'shards=', 'leasems=']
         )
     except getopt.GetoptError:
         print 'ERROR: Incorrect usage'
     else:
-        config_filename = unparsed[0] if unparsed else ''
-        main(config_filename, opts)
+        if '--query' in dict(opts):
+            query(opts)
+        else:
+            config_filename = unparsed[0] if unparsed else ''
+            main(config_filename, opts)
 
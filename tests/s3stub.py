@@ -0,0 +1,147 @@
+# In-process stand-in for the subset of the S3 API pixif uses: PUT object, ListObjectsV2 and multipart uploads.
+# Every request's AWS Signature Version 4 is checked independently of pixif's signing code.
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import hmac
+import re
+import threading
+import urllib
+import urlparse
+
+ACCESS_KEY = 'AKIDSTUB'
+SECRET_KEY = 'stub/secret/key'
+REGION = 'us-east-1'
+
+AUTHORIZATION = re.compile(r'AWS4-HMAC-SHA256 Credential=([^/]+)/(\d{8})/([^/]+)/s3/aws4_request, '
+                           r'SignedHeaders=([^,]+), Signature=(\w+)')
+
+
+def sign(secret, date, region, string_to_sign):
+    key = 'AWS4' + secret
+    for part in (date, region, 's3', 'aws4_request'):
+        key = hmac.new(key, part, hashlib.sha256).digest()
+    return hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def verified(self, url):
+        match = AUTHORIZATION.match(self.headers.get('Authorization', ''))
+        if not match or match.group(1) != ACCESS_KEY:
+            return False
+
+        date, region, signed, signature = match.group(2, 3, 4, 5)
+        query = sorted(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        canonical = '\n'.join([
+            self.command,
+            url.path,
+            '&'.join('%s=%s' % (urllib.quote(k, '-_.~'), urllib.quote(v, '-_.~')) for k, v in query),
+            ''.join('%s:%s\n' % (name, self.headers.get(name).strip()) for name in signed.split(';')),
+            signed,
+            self.headers.get('x-amz-content-sha256'),
+        ])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', self.headers.get('x-amz-date'),
+                                    '%s/%s/s3/aws4_request' % (date, region), hashlib.sha256(canonical).hexdigest()])
+        return sign(SECRET_KEY, date, region, string_to_sign) == signature
+
+    def reply(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        stub = self.server.stub
+        url = urlparse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+
+        with stub.lock:
+            stub.requests.append((self.command, self.path))
+
+        if not self.verified(url):
+            return self.reply(403, '<Error><Code>SignatureDoesNotMatch</Code></Error>')
+
+        bucket, _, key = urllib.unquote(url.path).lstrip('/').partition('/')
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+
+        with stub.lock:
+            if self.command == 'GET' and not key:
+                prefix = query.get('prefix', '')
+                keys = sorted(k for b, k in stub.objects if b == bucket and k.startswith(prefix)
+                              and '/' not in k[len(prefix):])
+                xml = '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                for k in keys:
+                    data, etag = stub.objects[bucket, k]
+                    xml += '<Contents><Key>%s</Key><Size>%d</Size><ETag>&quot;%s&quot;</ETag></Contents>' % (
+                        k, len(data), etag)
+                return self.reply(200, xml + '</ListBucketResult>')
+
+            if self.command == 'PUT' and 'partNumber' in query:
+                number = int(query['partNumber'])
+                if number in stub.fail_parts:
+                    return self.reply(500, '<Error><Code>InternalError</Code></Error>')
+                stub.uploads[query['uploadId']][number] = body
+                return self.reply(200, headers={'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+
+            if self.command == 'PUT':
+                etag = hashlib.md5(body).hexdigest()
+                stub.objects[bucket, key] = (body, etag)
+                return self.reply(200, headers={'ETag': '"%s"' % etag})
+
+            if self.command == 'POST' and 'uploads' in query:
+                upload = 'upload-%d' % len(stub.requests)
+                stub.uploads[upload] = {}
+                return self.reply(200, '<InitiateMultipartUploadResult><UploadId>%s</UploadId>'
+                                       '</InitiateMultipartUploadResult>' % upload)
+
+            if self.command == 'POST' and 'uploadId' in query:
+                parts = stub.uploads.pop(query['uploadId'])
+                numbers = [int(n) for n in re.findall(r'<PartNumber>(\d+)</PartNumber>', body)]
+                data = ''.join(parts[n] for n in numbers)
+                etag = '%s-%d' % (hashlib.md5(''.join(hashlib.md5(parts[n]).digest() for n in numbers)).hexdigest(),
+                                  len(numbers))
+                stub.objects[bucket, key] = (data, etag)
+                return self.reply(200, '<CompleteMultipartUploadResult><ETag>&quot;%s&quot;</ETag>'
+                                       '</CompleteMultipartUploadResult>' % etag)
+
+            if self.command == 'DELETE':
+                if 'uploadId' in query:
+                    stub.uploads.pop(query['uploadId'], None)
+                else:
+                    stub.objects.pop((bucket, key), None)
+                return self.reply(204)
+
+        return self.reply(400)
+
+    do_GET = do_PUT = do_POST = do_DELETE = handle_request
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class S3Stub(object):
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.fail_parts = set()
+        self.lock = threading.Lock()
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.stub = self
+        self.endpoint = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,272 @@
+import os
+import struct
+import sys
+import time
+import unittest
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import EXIF
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+
+def peak_memory():
+    # peak resident set size of this process in bytes (ru_maxrss is KB on Linux, bytes on macOS)
+    if resource is None:
+        return 0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def tiff_with_datetimes(exif_ifd=58):
+    # little-endian TIFF holding DateTime in IFD0 and DateTimeOriginal in an EXIF IFD at exif_ifd
+    ifd0 = struct.pack('<H', 2) + struct.pack('<HHLL', 0x0132, 2, 20, 38) + struct.pack('<HHLL', 0x8769, 4, 1, exif_ifd)
+    data = 'II*\x00' + struct.pack('<L', 8) + ifd0 + struct.pack('<L', 0) + '2012:01:03 08:00:00\x00'
+    data += '\x00' * (exif_ifd - len(data))
+    return data + struct.pack('<HHHLLL', 1, 0x9003, 2, 20, exif_ifd + 18, 0) + '2012:01:02 10:15:30\x00'
+
+
+def jpeg_with_datetimes(padding=0, trailing=0):
+    # an APP0 segment of padding bytes, the EXIF segment and trailing bytes of image data
+    app0 = '\xFF\xE0' + struct.pack('>H', padding + 2) + '\x00' * padding if padding else ''
+    exif = 'Exif\x00\x00' + tiff_with_datetimes()
+    return '\xFF\xD8' + app0 + '\xFF\xE1' + struct.pack('>H', len(exif) + 2) + exif + '\xFF\xDA' + '\x00' * trailing
+
+
+class CountingFile(StringIO):
+    def __init__(self, data):
+        StringIO.__init__(self, data)
+        self.consumed = 0
+
+    def read(self, n=-1):
+        data = StringIO.read(self, n)
+        self.consumed += len(data)
+        return data
+
+
+class ProcessDatetimeTestCase(unittest.TestCase):
+    LIMIT = 65536
+
+    def test_prefix_read(self):
+        f = CountingFile(jpeg_with_datetimes(trailing=4 * 1024 * 1024))
+        tags = EXIF.process_datetime(f, self.LIMIT)
+
+        self.assertEqual(str(tags['EXIF DateTimeOriginal']), '2012:01:02 10:15:30')
+        self.assertEqual(str(tags['Image DateTime']), '2012:01:03 08:00:00')
+        self.assertEqual(f.consumed, self.LIMIT)
+
+    def test_segment_across_prefix(self):
+        # the EXIF segment starts inside the prefix and ends past it, so the rest of it is read too
+        data = jpeg_with_datetimes(padding=self.LIMIT - 50, trailing=1024 * 1024)
+        f = CountingFile(data)
+        tags = EXIF.process_datetime(f, self.LIMIT)
+
+        self.assertEqual(str(tags['EXIF DateTimeOriginal']), '2012:01:02 10:15:30')
+        self.assertEqual(f.consumed, data.index('\xFF\xDA'))
+
+    def test_full_parse_past_prefix(self):
+        # DateTimeOriginal lies past the prefix, so process_file has to be used instead
+        data = tiff_with_datetimes(exif_ifd=100000)
+        self.assertEqual(EXIF.process_datetime(StringIO(data), self.LIMIT), None)
+
+        tags = EXIF.process_file(StringIO(data))
+        self.assertEqual(EXIF.get_datetime(tags), datetime(2012, 1, 2, 10, 15, 30))
+
+
+class CorpusTestCase(unittest.TestCase):
+    # truncated and hostile files, each of which must parse without raising and within its budget
+    LIMITS = EXIF.ParseLimits(entries=1000, bytes=256 * 1024, seconds=1.0)
+    SLACK_SECONDS = 0.5
+    MAX_MEMORY = 32 * 1024 * 1024
+
+    # files the budget itself has to stop
+    OVER_BUDGET = ('heic_iloc_items.heic', 'mp4_many_boxes.mp4', 'png_many_chunks.png', 'tiff_huge_count.tif',
+                   'tiff_huge_value.tif')
+
+    def parse(self, name, use_mmap=False):
+        with open(os.path.join(CORPUS, name), 'rb') as f:
+            return EXIF.process_file(f, use_mmap=use_mmap, limits=self.LIMITS)
+
+    def test_corpus_within_budget(self):
+        names = sorted(os.listdir(CORPUS))
+        self.assertTrue(names)
+
+        for name in names:
+            for use_mmap in (False, True):
+                memory = peak_memory()
+                start = time.time()
+                self.parse(name, use_mmap)
+                elapsed = time.time() - start
+
+                self.assertTrue(elapsed < self.LIMITS.seconds + self.SLACK_SECONDS,
+                                '{0} took {1:.2f}s'.format(name, elapsed))
+                self.assertTrue(peak_memory() - memory < self.MAX_MEMORY, '{0} grew the process by {1} bytes'.format(
+                                name, peak_memory() - memory))
+
+    def test_over_budget_flagged(self):
+        for name in self.OVER_BUDGET:
+            self.assertTrue('ParseLimit' in self.parse(name), name)
+
+    def test_truncated_png_time(self):
+        tags = self.parse('png_truncated_time.png')
+        self.assertFalse('PNG ModifyTime' in tags)
+
+    def test_iloc_count_capped(self):
+        # 0xffffffff items claimed by a box with no room for any
+        data = '\x02\x00\x00\x00\x00\x00\xff\xff\xff\xff'
+        self.assertEqual(EXIF.parse_iloc(data, EXIF.ParseBudget()), {})
+
+
+class DatetimeTestCase(unittest.TestCase):
+    # value, SubSecTime, OffsetTime and the datetime they decode to
+    DECODED = [
+        ('2012:01:02 10:15:30', None, None, datetime(2012, 1, 2, 10, 15, 30)),
+        ('2012:01:02 10:15:30 ', None, None, datetime(2012, 1, 2, 10, 15, 30)),
+        ('2012:01:02 10:15:30', '042', None, datetime(2012, 1, 2, 10, 15, 30, 42000)),
+        ('2012:01:02 10:15:30', '5  ', None, datetime(2012, 1, 2, 10, 15, 30, 500000)),
+        ('2012:01:02 10:15:30', '1234567', None, datetime(2012, 1, 2, 10, 15, 30, 123456)),
+        ('2012:01:02 10:15:30', '', None, datetime(2012, 1, 2, 10, 15, 30)),
+        ('2012:01:02 10:15:30', '4x', None, datetime(2012, 1, 2, 10, 15, 30)),
+        ('2012:01:02 10:15:30', '   ', None, datetime(2012, 1, 2, 10, 15, 30)),
+    ]
+
+    # values that aren't a datetime at all
+    MALFORMED = [
+        '',
+        '2012:01:02',
+        '2012:01:02 10:15',
+        '2012-01-02 10:15:30',
+        '2012:01:02T10-15-30',
+        '    :  :     :  :  ',
+        '0000:00:00 00:00:00',
+        '2012:00:02 10:15:30',
+        '2012:13:02 10:15:30',
+        '2012:02:30 10:15:30',
+        '2012:01:02 24:15:30',
+        'abcd:01:02 10:15:30',
+        '2012:01:02 10:15:3x',
+    ]
+
+    # OffsetTime values and their offset in minutes, None for ones that are ignored
+    OFFSETS = [
+        ('+02:00', 120),
+        ('-05:30', -330),
+        ('+00:00', 0),
+        ('+02:00\x00', 120),
+        ('02:00', None),
+        ('+0200', None),
+        ('+xx:00', None),
+        ('      ', None),
+        ('', None),
+    ]
+
+    def tag(self, value, field_type=2):
+        return EXIF.IFD_Tag(value, None, field_type, value, 0, len(value))
+
+    def test_decoded(self):
+        for value, subsec, offset, expected in self.DECODED:
+            self.assertEqual(EXIF.decode_datetime(value, subsec, offset), expected, repr((value, subsec)))
+
+    def test_malformed(self):
+        for value in self.MALFORMED:
+            self.assertEqual(EXIF.decode_datetime(value, '042', '+02:00'), None, repr(value))
+
+    def test_offsets(self):
+        for offset, minutes in self.OFFSETS:
+            dt = EXIF.decode_datetime('2012:01:02 10:15:30', None, offset)
+            if minutes is None:
+                self.assertEqual(dt.tzinfo, None, repr(offset))
+            else:
+                self.assertEqual(dt.utcoffset(), timedelta(minutes=minutes), repr(offset))
+                self.assertEqual(dt.replace(tzinfo=None), datetime(2012, 1, 2, 10, 15, 30))
+
+    def test_fixed_offset(self):
+        self.assertEqual(EXIF.FixedOffset(-330).tzname(None), '-05:30')
+        self.assertEqual(EXIF.FixedOffset(0).tzname(None), '+00:00')
+        self.assertEqual(EXIF.FixedOffset(120).dst(None), timedelta(0))
+
+    def test_get_datetime(self):
+        tags = {'EXIF DateTimeOriginal': self.tag('0000:00:00 00:00:00'),
+                'EXIF DateTimeDigitized': self.tag('2012:01:02 10:15:30'),
+                'EXIF SubSecTimeDigitized': self.tag('25'),
+                'EXIF OffsetTimeDigitized': self.tag('+01:00'),
+                'EXIF SubSecTimeOriginal': self.tag('99'),
+                'Image DateTime': self.tag('2012:01:03 08:00:00')}
+
+        # a zeroed DateTimeOriginal gives way to DateTimeDigitized with its own SubSecTime and OffsetTime
+        dt = EXIF.get_datetime(tags)
+        self.assertEqual(dt.replace(tzinfo=None), datetime(2012, 1, 2, 10, 15, 30, 250000))
+        self.assertEqual(dt.utcoffset(), timedelta(hours=1))
+
+        self.assertEqual(EXIF.get_datetime(tags, ('DateTime',)), datetime(2012, 1, 3, 8, 0, 0))
+        self.assertEqual(EXIF.get_datetime(tags, ('DateTimeOriginal',)), None)
+        # only ASCII values are decoded
+        self.assertEqual(EXIF.get_datetime({'Image DateTime': self.tag('2012:01:03 08:00:00', 7)}), None)
+        self.assertEqual(EXIF.get_datetime({}), None)
+
+
+class LocalTimeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'EST+05'
+        time.tzset()
+
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def test_creation_time_is_local(self):
+        # 2020-01-02 03:04:05 UTC is still the 1st five hours west
+        seconds = 1577934245 + EXIF.MP4_EPOCH_OFFSET
+        mvhd = struct.pack('>L4sLLL', 20, 'mvhd', 0, seconds, 0)
+        movie = struct.pack('>L4s', 16, 'ftyp') + 'isom\x00\x00\x00\x00' + struct.pack('>L4s', 28, 'moov') + mvhd
+
+        tags = EXIF.process_file(StringIO(movie))
+        self.assertEqual(str(tags['Movie CreationTime']), '2020:01:01 22:04:05')
+
+    def test_png_time_is_local(self):
+        # tIME is UTC too, so PNGs are ordered with the movies and photos around them
+        chunk = struct.pack('>L4sHBBBBB', 7, 'tIME', 2020, 1, 2, 3, 4, 5) + '\x00' * 4
+        png = EXIF.PNG_SIGNATURE + chunk + struct.pack('>L4s', 0, 'IEND') + '\x00' * 4
+
+        tags = EXIF.process_file(StringIO(png))
+        self.assertEqual(str(tags['PNG ModifyTime']), '2020:01:01 22:04:05')
+
+    def test_png_time_not_a_date(self):
+        self.assertEqual(EXIF.png_time(struct.pack('>HBBBBB', 2020, 13, 0, 3, 4, 5)), '2020:13:00 03:04:05')
+
+
+class TagTableTestCase(unittest.TestCase):
+    def tag(self, value):
+        return EXIF.IFD_Tag(value, None, 2, value, 0, len(value))
+
+    def test_datetime_columns(self):
+        table = EXIF.TagTable(['DateTimeOriginal', 'SubSecTimeOriginal', 'OffsetTime', 'GPSDate', 'Image DateTime'])
+        table.append('a.jpg', {'EXIF DateTimeOriginal': self.tag('2012:01:02 10:15:30'),
+                               'EXIF SubSecTimeOriginal': self.tag('042'),
+                               'EXIF OffsetTime': self.tag('+02:00'),
+                               'GPS GPSDate': self.tag('2012:01:02'),
+                               'Image DateTime': self.tag('2012:01:03 08:00:00')})
+
+        kinds = [table.column(name).kind for name in table.names]
+        self.assertEqual(kinds, ['datetime', 'string', 'string', 'datetime', 'datetime'])
+        self.assertEqual(table.column('SubSecTimeOriginal').format(0), '042')
+        self.assertEqual(table.column('OffsetTime').format(0), '+02:00')
+        self.assertEqual(table.column('GPSDate').format(0), '2012:01:02 00:00:00')
+        self.assertEqual(table.summary()[1], 'SubSecTimeOriginal: 1 of 1, 1 distinct')
+
+
+if __name__ == '__main__':
+    unittest.main()
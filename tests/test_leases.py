@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import pixif
+from test_pixif import TempDirTestCase
+
+
+class LeasesTestCase(TempDirTestCase):
+    SECONDS = 0.2
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.workers = []
+
+    def tearDown(self):
+        for leases in self.workers:
+            for name, shard in list(leases.held):
+                leases.finish(name, shard, done=False)
+            leases.close()
+        TempDirTestCase.tearDown(self)
+
+    def worker(self, name, shards=2):
+        leases = pixif.PixifLeases(self.path('leases.db'), name, shards, self.SECONDS)
+        self.workers.append(leases)
+        return leases
+
+    def die(self, leases, name, shard):
+        # stop renewing without finishing, as a killed worker does
+        stop, thread, lost = leases.held.pop((name, shard))
+        stop.set()
+        thread.join()
+
+    def test_claim_distinct_shards(self):
+        first, second = self.worker('first'), self.worker('second', shards=8)
+        # the job keeps the shard count of the worker that added it
+        self.assertEqual(first.job('reorg'), 2)
+        self.assertEqual(second.job('reorg'), 2)
+
+        self.assertEqual(first.claim('reorg'), 0)
+        self.assertEqual(second.claim('reorg'), 1)
+
+        self.assertTrue(first.finish('reorg', 0))
+        self.assertTrue(second.finish('reorg', 1))
+        self.assertEqual(first.claim('reorg'), None)
+
+    def test_held_lease_is_renewed(self):
+        first, second = self.worker('first', shards=1), self.worker('second')
+        first.job('reorg')
+        self.assertEqual(first.claim('reorg'), 0)
+
+        time.sleep(self.SECONDS * 3)
+        # nothing to claim while the lease is renewed, so the second worker only returns once it's done
+        first.finish('reorg', 0)
+        self.assertEqual(second.claim('reorg'), None)
+
+    def test_expired_lease_taken_over(self):
+        dead, alive = self.worker('dead'), self.worker('alive')
+        dead.job('reorg')
+        self.assertEqual(dead.claim('reorg'), 0)
+        self.die(dead, 'reorg', 0)
+
+        self.assertEqual(alive.claim('reorg'), 1)
+        start = time.time()
+        self.assertEqual(alive.claim('reorg'), 0)
+        self.assertTrue(time.time() - start < self.SECONDS * 5)
+        self.assertTrue(alive.finish('reorg', 0))
+        self.assertTrue(alive.finish('reorg', 1))
+        self.assertEqual(dead.claim('reorg'), None)
+
+    def test_lost_lease_not_finished(self):
+        stalled, alive = self.worker('stalled', shards=1), self.worker('alive')
+        stalled.job('reorg')
+        self.assertEqual(stalled.claim('reorg'), 0)
+
+        # the stalled worker went silent for longer than its lease
+        stalled.execute('UPDATE leases SET expires = 0')
+        self.assertEqual(alive.claim('reorg'), 0)
+        self.assertFalse(stalled.renew('reorg', 0))
+
+        self.assertFalse(stalled.finish('reorg', 0))
+        self.assertTrue(alive.finish('reorg', 0))
+
+    def test_handed_back_shard_claimed_again(self):
+        first, second = self.worker('first', shards=1), self.worker('second')
+        first.job('reorg')
+        self.assertEqual(first.claim('reorg'), 0)
+        self.assertTrue(first.finish('reorg', 0, done=False))
+
+        self.assertEqual(second.claim('reorg'), 0)
+        self.assertTrue(second.finish('reorg', 0))
+
+    def test_find_shards(self):
+        names = ['{0}/{1}.jpg'.format(head, i) for head in 'ab' for i in range(10)]
+        for name in names:
+            self.write(os.path.join('in', name), name)
+
+        buckets, load = pixif.PixifCollection.find_shards(self.path('in'), 4, set(['Name']))
+        self.assertEqual(sorted(sum(buckets.values(), [])), sorted(self.path('in', name) for name in names))
+
+        for shard, paths in buckets.items():
+            images = load(paths)
+            self.assertEqual([image.filename for image in images], paths)
+            for image in images:
+                self.assertEqual(pixif.shard_of(os.path.relpath(image.filename, self.path('in')), 4), shard)
+
+    def take_over(self, collision, method='copy'):
+        data = {'a.jpg': 'first photo', 'b.jpg': 'second photo'}
+        for name in data:
+            self.write(os.path.join('in', name), data[name])
+
+        # the first worker finished b.jpg and died copying a.jpg into its temporary file
+        dead = self.worker('dead', shards=1)
+        dead.job('reorg')
+        self.assertEqual(dead.claim('reorg'), 0)
+        for name in data:
+            self.assertTrue(dead.reserve('reorg', 0, self.path('in', name), self.path('out', name), len(data[name])))
+        self.write('out/a.jpg', '')
+        self.write('out/.a.jpg.pixif-tmp', 'first')
+        self.write('out/b.jpg', data['b.jpg'])
+        self.die(dead, 'reorg', 0)
+
+        leases = self.worker('alive')
+        logger = pixif.PixifLogger('reorg', self.path('pixif.log'))
+        options = dict(pixif.PixifConfig.defaults, src=self.path('in'), dst=self.path('out'), saveas='{Name}',
+                       method=method, collision=collision, journal=None, advisor=None, catalog=None, mounts=None)
+        pixif.work_shards(leases, 'reorg', logger, options)
+
+        self.assertEqual(self.files(self.path('out')), ['a.jpg', 'b.jpg'])
+        for name in data:
+            with open(self.path('out', name), 'rb') as f:
+                self.assertEqual(f.read(), data[name])
+
+        with open(self.path('pixif.log')) as f:
+            actions = [line.split('\t')[2] for line in f if '(lease)' in line or 'earlier owner' in line]
+        self.assertEqual(actions, ['(lease) removed temporary destination', '(lease) removed partial destination',
+                                   '(info) skipped image because an earlier owner of its shard already placed it'])
+
+        # names stay reserved once placed
+        self.assertFalse(leases.reserve('reorg', 0, self.path('in', 'c.jpg'), self.path('out', 'a.jpg'), 1))
+
+        if method == 'move':
+            self.assertEqual(self.files(self.path('in')), [])
+
+    def test_takeover_clears_reserved_names(self):
+        self.take_over('hash')
+
+    def test_takeover_with_suffixes(self):
+        # b.jpg isn't suffixed into a second copy
+        self.take_over('suffix')
+
+    def test_takeover_with_skip(self):
+        self.take_over('skip')
+
+    def test_takeover_of_move(self):
+        # the source of the finished move is removed rather than moved again
+        self.take_over('suffix', 'move')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,483 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from datetime import datetime
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import pixif
+from test_exif import jpeg_with_datetimes, tiff_with_datetimes
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='pixif-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, *parts):
+        return os.path.join(self.tmp, *parts)
+
+    def write(self, name, data):
+        path = self.path(name)
+        head = os.path.dirname(path)
+        if not os.path.isdir(head):
+            os.makedirs(head)
+
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        return path
+
+    def write_zip(self, name, members):
+        path = self.path(name)
+        with zipfile.ZipFile(path, 'w') as z:
+            for member, data in members:
+                z.writestr(member, data)
+
+        return path
+
+    def files(self, root):
+        return sorted(os.path.relpath(os.path.join(head, name), root)
+                      for head, dirs, names in os.walk(root) for name in names)
+
+
+class DatetimeTestCase(TempDirTestCase):
+    def test_full_parse_past_prefix(self):
+        # a date-only template reads a prefix first and has to fall back to parsing the whole file
+        path = self.write('a.jpg', tiff_with_datetimes(exif_ifd=pixif.PixifImage.DATETIME_HEADER_LIMIT + 100))
+        image = pixif.PixifImage(path, set(['Year', 'Month', 'Name']))
+        self.assertEqual(image.datetime, datetime(2012, 1, 2, 10, 15, 30))
+
+
+class ConfigTestCase(TempDirTestCase):
+    def config(self, **options):
+        lines = ['[photos]', 'src = in', 'dst = out'] + ['{0} = {1}'.format(k, v) for k, v in sorted(options.items())]
+        return pixif.PixifConfig(filename=self.write('pixif.ini', '\n'.join(lines) + '\n'))
+
+    def test_choices(self):
+        self.assertEqual(self.config(collision='hash').errors(), [])
+        self.assertEqual(self.config(collision='hsah').errors(),
+                         ['[photos] collision must be one of skip, suffix, hash, not hsah'])
+        self.assertEqual(self.config(order='inodes').errors(),
+                         ['[photos] order must be one of walk, inode, extent, not inodes'])
+        self.assertEqual(self.config(namedates='preferred').errors(),
+                         ['[photos] namedates must be one of none, fallback, prefer, not preferred'])
+
+
+class NameDatesTestCase(TempDirTestCase):
+    def datetime(self, name):
+        path = self.write(name, 'not a photo')
+        # 2001-09-09 01:46:40 UTC, so a date from the name is told from the file's
+        os.utime(path, (1000000000, 1000000000))
+        return pixif.PixifImage(path, set(['Year', 'Name']), 'prefer').datetime
+
+    def test_patterns(self):
+        self.assertEqual(self.datetime('IMG_20120102_101530.jpg'), datetime(2012, 1, 2, 10, 15, 30))
+        self.assertEqual(self.datetime('2012-01-02 10.15.30.jpg'), datetime(2012, 1, 2, 10, 15, 30))
+
+    def test_longer_digit_runs_ignored(self):
+        file_date = datetime.fromtimestamp(1000000000)
+        self.assertEqual(self.datetime('DSC120120102_1015301.jpg'), file_date)
+        self.assertEqual(self.datetime('3f20120102-101530a9.jpg'), datetime(2012, 1, 2, 10, 15, 30))
+        self.assertEqual(self.datetime('920120102-1015309.jpg'), file_date)
+
+
+class ArchiveTestCase(TempDirTestCase):
+    MEMBERS = [('a.jpg', 'first'), ('sub/b.jpg', 'second photo'), ('c.png', 'third')]
+
+    def test_archive_with_catalog(self):
+        src = self.write_zip('src.zip', self.MEMBERS)
+        catalog = pixif.PixifCatalog(self.path('catalog.db'))
+
+        pixif.PixifCollection(src, self.path('out'), '{Name}', method='copy', catalog=catalog).execute()
+
+        self.assertEqual(self.files(self.path('out')), ['a.jpg', 'b.jpg', 'c.png'])
+        sizes = dict(catalog.db.execute('SELECT src, size FROM photos'))
+        self.assertEqual(sizes, dict((os.path.join(src, name), len(data)) for name, data in self.MEMBERS))
+        catalog.close()
+
+    def test_archive_inside_directory_source(self):
+        self.write('in/d.jpg', 'directory photo')
+        archive = self.write_zip('in/photos.zip', self.MEMBERS)
+        sections = []
+
+        for src, dst in ((self.path('in'), 'out'), (archive, 'zipped')):
+            cfg = dict(pixif.PixifConfig.defaults, src=src, dst=self.path(dst), saveas='{Name}')
+            sections.append(cfg)
+
+        sources = pixif.PixifSources(sections)
+
+        for cfg in sections:
+            pixif.PixifCollection(images=sources.get(cfg), **cfg).execute()
+
+        self.assertEqual(self.files(self.path('out')), ['d.jpg'])
+        self.assertEqual(self.files(self.path('zipped')), ['a.jpg', 'b.jpg', 'c.png'])
+
+
+class CatalogTestCase(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.write('in/a.jpg', jpeg_with_datetimes())
+        self.write('in/IMG_20130405_060708.jpg', 'named photo')
+        self.write('in/IMG_20120607_080910.jpg', 'another named photo')
+
+        catalog = pixif.PixifCatalog(self.path('catalog.db'))
+        pixif.PixifCollection(self.path('in'), self.path('out'), '{Year}/{Name}', method='copy', namedates='fallback',
+                              catalog=catalog).execute()
+        catalog.close()
+
+    def query(self, *opts):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            pixif.query(list(opts))
+            return sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+
+    def test_find(self):
+        catalog = pixif.PixifCatalog(self.path('catalog.db'))
+        self.assertEqual(catalog.find([('Year', '2012')]), [
+            ('2012-01-02 10:15:30', self.path('out', '2012', 'a.jpg')),
+            ('2012-06-07 08:09:10', self.path('out', '2012', 'IMG_20120607_080910.jpg'))])
+        self.assertEqual(catalog.find([('Year', '2012'), ('Month', '06')]),
+                         [('2012-06-07 08:09:10', self.path('out', '2012', 'IMG_20120607_080910.jpg'))])
+        self.assertEqual(len(catalog.find([])), 3)
+        self.assertEqual(catalog.find([('Year', '1999')]), [])
+        catalog.close()
+
+    def test_query(self):
+        self.assertEqual(self.query(('--catalog', self.path('catalog.db')), ('--query', 'Year=2013')),
+                         ['2013-04-05 06:07:08\t' + self.path('out', '2013', 'IMG_20130405_060708.jpg')])
+        self.assertEqual(self.query(('--query', 'Year=2013')), ['ERROR: --query needs --catalog'])
+
+
+class ReadonceTestCase(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.limit = pixif.PixifImage.HEADER_RETAIN_LIMIT
+
+    def tearDown(self):
+        pixif.PixifImage.HEADER_RETAIN_LIMIT = self.limit
+        TempDirTestCase.tearDown(self)
+
+    def test_headers_bounded_and_released(self):
+        for i in range(10):
+            self.write('in/{0}.jpg'.format(i), str(i) * 1000)
+
+        # room for the headers of three photos
+        pixif.PixifImage.HEADER_RETAIN_LIMIT = 3500
+        images = pixif.PixifCollection.find_images(self.path('in'), set(['Name']), readonce='4K')
+        self.assertEqual(len([image for image in images if image.header]), 3)
+
+        pixif.PixifCollection(self.path('in'), self.path('out'), '{Name}', method='copy', images=images).execute()
+
+        self.assertFalse([image for image in images if image.header])
+        for i in range(10):
+            with open(self.path('out', '{0}.jpg'.format(i)), 'rb') as f:
+                self.assertEqual(f.read(), str(i) * 1000)
+
+
+class CollisionsTestCase(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.write('out/a.jpg', 'existing')
+
+    def run_policy(self, collision, journal=None):
+        logger = pixif.PixifLogger('photos', self.path('pixif.log'))
+        pixif.PixifCollection(self.path('in'), self.path('out'), '{Name}', method='copy', logger=logger,
+                              collision=collision, journal=journal).execute()
+        return dict((line.split('\t')[3], line.split('\t')[2]) for line in logger.logs)
+
+    def contents(self):
+        contents = {}
+        for name in self.files(self.path('out')):
+            with open(self.path('out', name), 'rb') as f:
+                contents[name] = f.read()
+        return contents
+
+    def test_skip(self):
+        self.write('in/a.jpg', 'new')
+        logs = self.run_policy('skip')
+
+        self.assertEqual(self.contents(), {'a.jpg': 'existing'})
+        self.assertEqual(logs[self.path('in', 'a.jpg')], '(warning) could not process image because file already exists')
+
+    def test_suffix(self):
+        for head in ('x', 'y'):
+            self.write('in/{0}/a.jpg'.format(head), head)
+        self.write('out/a-1.jpg', 'earlier suffixed')
+
+        self.run_policy('suffix')
+        contents = self.contents()
+        self.assertEqual(sorted(contents), ['a-1.jpg', 'a-2.jpg', 'a-3.jpg', 'a.jpg'])
+        self.assertEqual((contents['a.jpg'], contents['a-1.jpg']), ('existing', 'earlier suffixed'))
+        self.assertEqual(sorted([contents['a-2.jpg'], contents['a-3.jpg']]), ['x', 'y'])
+
+    def test_hash(self):
+        # identical to the existing file, to a suffixed copy of it, and to neither
+        self.write('out/a-1.jpg', 'copied before')
+        self.write('in/x/a.jpg', 'existing')
+        self.write('in/y/a.jpg', 'copied before')
+        self.write('in/z/a.jpg', 'new')
+        logs = self.run_policy('hash')
+
+        self.assertEqual(self.contents(), {'a.jpg': 'existing', 'a-1.jpg': 'copied before', 'a-2.jpg': 'new'})
+        for head in ('x', 'y'):
+            self.assertEqual(logs[self.path('in', head, 'a.jpg')],
+                             '(info) skipped image because an identical file already exists')
+
+    def test_io_outside_lock(self):
+        # listing a directory and hashing a candidate leave the lock to the other transfers
+        busy, release = threading.Event(), threading.Event()
+
+        class SlowStorage(pixif.PixifStorage):
+            def wait(self, path):
+                if 'slow' in path:
+                    busy.set()
+                    release.wait(5)
+
+            def listdir(self, head):
+                self.wait(head)
+                return pixif.PixifStorage.listdir(self, head)
+
+            def identical(self, src, dst, digest):
+                self.wait(src)
+                return pixif.PixifStorage.identical(self, src, dst, digest)
+
+        src = self.write('in/slow/a.jpg', 'new')
+        collisions = pixif.PixifCollisions('hash', SlowStorage(self.path('out')))
+
+        for dst, other in ((self.path('out', 'slow', 'a.jpg'), 'b.jpg'), (self.path('out', 'a.jpg'), 'c.jpg')):
+            busy.clear()
+            release.clear()
+            thread = threading.Thread(target=collisions.resolve, args=(src, dst))
+            thread.start()
+            self.assertTrue(busy.wait(5))
+
+            self.assertTrue(collisions.lock.acquire(False))
+            collisions.lock.release()
+            self.assertEqual(collisions.resolve(self.path('in', other), self.path('out', other)), self.path('out', other))
+
+            release.set()
+            thread.join()
+
+    def test_resume_suffixed(self):
+        # an earlier run copied in/a.jpg to a suffixed name and was interrupted before clearing its journal
+        src = self.write('in/a.jpg', 'new')
+        self.write('out/a-1.jpg', 'new')
+        journal = pixif.PixifJournal(self.path('pixif.journal'))
+        journal.record(pixif.PixifJournal.COMMITTED, 'copy', src, self.path('out', 'a-1.jpg'))
+
+        journal = pixif.PixifJournal(self.path('pixif.journal'))
+        journal.recover()
+        self.assertTrue(journal.is_finished(src, self.path('out', 'a.jpg'), suffixed=True))
+        self.assertFalse(journal.is_finished(src, self.path('out', 'a.jpg')))
+
+        self.assertEqual(self.run_policy('suffix', journal), {})
+        self.assertEqual(self.contents(), {'a.jpg': 'existing', 'a-1.jpg': 'new'})
+
+
+class JournalTestCase(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.src = self.write('in/a.jpg', 'photo')
+        self.dst = self.path('out', 'a.jpg')
+        os.makedirs(self.path('out'))
+
+    def journal(self, *entries):
+        # a journal left by an interrupted run, read back as the next run does
+        journal = pixif.PixifJournal(self.path('pixif.journal'))
+        for state, method in entries:
+            journal.record(state, method, self.src, self.dst)
+
+        journal = pixif.PixifJournal(self.path('pixif.journal'))
+        return journal, [text for text, src, dst in journal.recover()]
+
+    def resume(self, journal, collision='skip'):
+        logger = pixif.PixifLogger('photos', self.path('pixif.log'))
+        pixif.PixifCollection(self.path('in'), self.path('out'), '{Name}', method='copy', journal=journal,
+                              logger=logger, collision=collision).execute()
+        return [line.split('\t')[2] for line in logger.logs]
+
+    def test_interrupted_copy(self):
+        self.write('out/a.jpg', 'pho')
+        self.write('out/.a.jpg.pixif-tmp', 'ph')
+        journal, actions = self.journal((pixif.PixifJournal.PLANNED, 'copy'), (pixif.PixifJournal.COPYING, 'copy'))
+
+        self.assertEqual(actions, ['(journal) removed temporary destination', '(journal) removed partial destination'])
+        self.assertFalse(journal.is_finished(self.src, self.dst))
+
+        self.assertEqual(self.resume(journal), ['(success) processed image using {0}'.format(shutil.copy2)])
+        self.assertEqual(self.files(self.path('out')), ['a.jpg'])
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), 'photo')
+
+    def test_interrupted_move_after_copy(self):
+        # copied across devices and committed, but the source wasn't removed yet
+        self.write('out/a.jpg', 'photo')
+        journal, actions = self.journal((pixif.PixifJournal.COPYING, 'move'), (pixif.PixifJournal.COMMITTED, 'move'))
+
+        self.assertEqual(actions, ['(journal) removed source of committed move'])
+        self.assertEqual(self.files(self.path('in')), [])
+        self.assertTrue(journal.is_finished(self.src, self.dst))
+
+    def test_interrupted_move_after_rename(self):
+        # renamed on the same device before the commit was journaled
+        os.rename(self.src, self.dst)
+        journal, actions = self.journal((pixif.PixifJournal.COPYING, 'move'))
+
+        self.assertEqual(actions, [])
+        self.assertTrue(journal.is_finished(self.src, self.dst))
+        self.assertEqual(self.files(self.path('out')), ['a.jpg'])
+
+    def test_committed_replay(self):
+        self.write('out/a.jpg', 'photo')
+        journal, actions = self.journal((pixif.PixifJournal.COPYING, 'copy'), (pixif.PixifJournal.COMMITTED, 'copy'))
+
+        self.assertEqual(actions, [])
+        self.assertTrue(journal.is_finished(self.src, self.dst))
+
+        # the finished copy isn't even looked at again, let alone suffixed
+        self.assertEqual(self.resume(journal, 'suffix'), [])
+        self.assertEqual(self.files(self.path('out')), ['a.jpg'])
+
+
+class CommitterTestCase(TempDirTestCase):
+    def test_group_commits_once_its_time_is_up(self):
+        dst = self.path('photo.jpg')
+        tmp = self.write(os.path.basename(pixif.temp_filename(dst)), 'photo')
+        committed = []
+
+        committer = pixif.PixifCommitter(files=100, ms=50)
+        committer.add(tmp, dst, lambda: committed.append(dst))
+
+        for attempt in range(100):
+            if committed:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(committed, [dst])
+        self.assertTrue(os.path.exists(dst))
+        self.assertFalse(os.path.exists(tmp))
+
+
+class ThrottleTestCase(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.now = 1000.0
+
+    def tearDown(self):
+        pixif.PixifControl.requested = False
+        TempDirTestCase.tearDown(self)
+
+    def clock(self):
+        return self.now
+
+    def bucket(self, rate, burst=1.0):
+        return pixif.PixifBucket(rate, burst, clock=self.clock)
+
+    def test_bucket_rate(self):
+        bucket = self.bucket(100)
+        bucket.take(150)
+        self.assertAlmostEqual(bucket.delay(), 0.5)
+
+        self.now += 0.25
+        self.assertAlmostEqual(bucket.delay(), 0.25)
+        self.now += 0.25
+        self.assertEqual(bucket.delay(), 0)
+
+        # an idle bucket only fills up to its burst
+        self.now += 60
+        bucket.take(100)
+        self.assertEqual(bucket.delay(), 0)
+        bucket.take(50)
+        self.assertAlmostEqual(bucket.delay(), 0.5)
+
+    def test_unlimited_bucket(self):
+        bucket = self.bucket(0)
+        bucket.take(10 ** 9)
+        self.assertEqual(bucket.delay(), 0)
+
+    def test_set_rate(self):
+        bucket = self.bucket(100, burst=2.0)
+        # a lower rate also lowers what the bucket holds
+        bucket.set_rate(10)
+        self.assertEqual(bucket.capacity(), 20)
+        bucket.take(30)
+        self.assertAlmostEqual(bucket.delay(), 1.0)
+
+        bucket.set_rate(10, burst=0.5)
+        self.assertEqual(bucket.capacity(), 5)
+
+    def test_transfers_take_from_parent(self):
+        parent = pixif.PixifThrottle()
+        parent.bytes = self.bucket(10)
+        child = pixif.PixifThrottle(parent=parent)
+        child.bytes = self.bucket(1000)
+
+        child.take_bytes(4)
+        self.assertEqual(parent.bytes.tokens, 6)
+        self.assertEqual(child.bytes.tokens, 996)
+        self.assertTrue(child.is_active())
+        self.assertFalse(pixif.PixifThrottle().is_active())
+
+    def test_control_reload(self):
+        self.write('control.ini', '[pixif]\nbps = 1K\n\n[photos]\nfps = 5\nburst = 2\n')
+        throttle = pixif.PixifThrottle()
+        section = pixif.PixifThrottle(parent=throttle)
+        control = pixif.PixifControl(self.path('control.ini'), {'pixif': throttle, 'photos': section})
+
+        # nothing is read until the file changes or a reload is requested
+        control.poll()
+        self.assertEqual(throttle.bytes.rate, 0)
+
+        pixif.PixifControl.request()
+        control.poll()
+        self.assertFalse(pixif.PixifControl.requested)
+        self.assertEqual((throttle.bytes.rate, throttle.files.rate), (1024, 0))
+        self.assertEqual((section.bytes.rate, section.files.rate, section.files.burst), (0, 5, 2.0))
+
+        self.write('control.ini', '[pixif]\nbps = 2K\n')
+        os.utime(self.path('control.ini'), (control.mtime + 10, control.mtime + 10))
+        control.poll()
+        # the change is only picked up once the poll interval is up
+        self.assertEqual(throttle.bytes.rate, 1024)
+        control.checked -= control.POLL_INTERVAL
+        control.poll()
+        self.assertEqual(throttle.bytes.rate, 2048)
+        self.assertEqual(section.files.rate, 5)
+
+
+class ThumbnailsTestCase(TempDirTestCase):
+    def write_tiff(self, name, strip_bytes):
+        # an image IFD and an uncompressed thumbnail IFD whose one strip claims strip_bytes
+        ifd0 = struct.pack('<HHHLLL', 1, 0x0100, 3, 1, 1, 26)
+        ifd1 = struct.pack('<H', 3) + struct.pack('<HHLL', 0x0103, 3, 1, 1) + struct.pack('<HHLL', 0x0111, 4, 1, 80) + \
+            struct.pack('<HHLL', 0x0117, 4, 1, strip_bytes) + struct.pack('<L', 0)
+        data = 'II*\x00' + struct.pack('<L', 8) + ifd0 + ifd1
+        return self.write(name, data + '\x00' * (80 - len(data)) + 'pixels')
+
+    def test_unreadable_thumbnail_logged(self):
+        self.write_tiff('in/good.tif', 6)
+        self.write_tiff('in/bogus.tif', 100 * 1024 * 1024)
+        logger = pixif.PixifLogger('thumbs', self.path('pixif.log'))
+
+        pixif.PixifCollection(self.path('in'), self.path('out'), '{Name}', method='thumbnails', logger=logger).execute()
+
+        self.assertEqual(self.files(self.path('out')), ['good.tif'])
+        logs = dict((line.split('\t')[3], line.split('\t')[2]) for line in logger.logs)
+        self.assertEqual(logs[self.path('in', 'good.tif')], '(success) exported thumbnail')
+        self.assertTrue(logs[self.path('in', 'bogus.tif')].startswith('(warning) could not export thumbnail'))
+
+
+if __name__ == '__main__':
+    unittest.main()